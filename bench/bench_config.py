@@ -0,0 +1,120 @@
+# Benchmark loading the config of many apps
+#
+# Usage: PYTHONPATH=. python bench/bench_config.py [options]
+#
+# For each app count, the app sections are written to include files of
+# `--apps-per-file` apps. Reports the time to start (read the config and
+# load the no-op workers of all the apps, with a shared pool), to reload
+# unchanged files and to reload after one file changed, per app. Startup
+# should grow linearly with the number of apps: the run fails (exit
+# status 1) when the time per app of the largest count is worse than the
+# smallest's by more than `--threshold`
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+import oi
+
+from ciex import core
+from ciex import util
+from ciex import compat
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import noop_workers  # noqa
+
+APP = '''
+[settings.app.app{0}]
+repo = git@example.com:apps/app{0}.git
+src_path = /tmp/ciex
+install_path = /tmp/ciex/installs
+worker_dirpath = {1}
+worker_modname = noop_workers
+worker_classname = NoopWorker
+worker_concurrency = 2
+command_timeouts = deploy:300, build:1800
+'''
+
+
+def write_config(path, apps, apps_per_file):
+    """ Write the include files of `apps` apps, return the main config """
+    dirpath = os.path.dirname(os.path.abspath(__file__))
+    for first in range(0, apps, apps_per_file):
+        name = os.path.join(path, 'apps{:05d}.conf'.format(first))
+        with open(name, 'w') as fh:
+            for i in range(first, min(apps, first + apps_per_file)):
+                fh.write(APP.format(i, dirpath))
+
+    config = compat.configparser.ConfigParser()
+    config['settings'] = {
+        'worker_pool': 'shared', 'include': os.path.join(path, '*.conf')}
+    return config
+
+
+def timed(function, *args):
+    begin = time.time()
+    function(*args)
+    return time.time() - begin
+
+
+def run(apps, apps_per_file):
+    """ Run one scenario and return its results """
+    path = tempfile.mkdtemp()
+    try:
+        program = oi.Program('bench', None)
+        program.config = write_config(path, apps, apps_per_file)
+        ci_core = core.Core(program)
+        startup = timed(ci_core.initialize)
+        assert len(program.state.apps_sts) == apps
+
+        reload_same = timed(ci_core.initialize)
+        time.sleep(0.01)
+        with open(os.path.join(path, 'apps00000.conf'), 'a') as fh:
+            fh.write('\n')
+        reload_one = timed(ci_core.initialize)
+        ci_core.task_router.close()
+    finally:
+        shutil.rmtree(path)
+
+    return {
+        'apps': apps, 'startup': startup,
+        'startup_us_per_app': startup / apps * 1e6,
+        'reload_same_us_per_app': reload_same / apps * 1e6,
+        'reload_one_us_per_app': reload_one / apps * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ciex config benchmark')
+    parser.add_argument('--apps', default='500,1000,5000',
+                        help='comma separated app counts '
+                        '(default 500,1000,5000)')
+    parser.add_argument('--apps-per-file', type=int, default=100)
+    parser.add_argument('--threshold', type=float, default=0.5,
+                        help='allowed growth of the time per app '
+                        '(default 0.5 = 50%%)')
+    args = parser.parse_args()
+
+    results = []
+    for apps in util.split_list(args.apps):
+        result = run(int(apps), args.apps_per_file)
+        results.append(result)
+        print('apps: {apps}, startup: {startup:.2f} s '
+              '({startup_us_per_app:.0f} us per app), reload: '
+              '{reload_same_us_per_app:.0f} us per app, '
+              '{reload_one_us_per_app:.0f} us per app after a change'
+              .format(**result))
+
+    first, last = results[0], results[-1]
+    growth = last['startup_us_per_app'] / first['startup_us_per_app'] - 1
+    if growth > args.threshold:
+        print('REGRESSION startup per app grew by {:.0%} from {} to {} '
+              'apps'.format(growth, first['apps'], last['apps']))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
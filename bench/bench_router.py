@@ -0,0 +1,198 @@
+# Benchmark the task pipeline: Core command -> TaskRouter -> CIWorker
+#
+# Usage: PYTHONPATH=. python bench/bench_router.py [options]
+#
+# For each app count, tasks are submitted through `Core.create_task` (what
+# the daemon commands call) at the given rate, and executed by no-op ci
+# workers sleeping `--step` seconds. Reports the throughput, the p50/p99
+# enqueue-to-start latency and the memory used per queued task.
+#
+# The throughput should barely depend on the number of apps: the run
+# fails (exit status 1) when the throughput of the largest app count is
+# lower than the smallest's by more than `--max-slowdown` times.
+#
+# With `--baseline results.json` the run also fails when a result is
+# worse than the baseline by more than `--threshold`; save a baseline
+# with `--save results.json`
+
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+
+import oi
+
+from ciex import core
+from ciex import util
+from ciex import compat
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import noop_workers  # noqa
+
+
+def new_core(apps, step, pool):
+    """ Create a core with `apps` apps using the no-op worker """
+    config = compat.configparser.ConfigParser()
+    config['settings'] = {'worker_pool': pool}
+    for i in range(apps):
+        config['settings.app.app{}'.format(i)] = {
+            'repo': 'none', 'src_path': '/tmp', 'install_path': '/tmp',
+            'worker_dirpath': os.path.dirname(os.path.abspath(__file__)),
+            'worker_modname': 'noop_workers',
+            'worker_classname': 'NoopWorker',
+            'step_duration': str(step),
+        }
+    program = oi.Program('bench', None)
+    program.config = config
+    ci_core = core.Core(program)
+    ci_core.initialize()
+    return ci_core
+
+
+def submit(ci_core, apps, tasks_per_app, rate):
+    """ Submit the tasks, at most `rate` per second (0: no limit) """
+    tasks = []
+    begin = time.time()
+    for n in range(tasks_per_app):
+        for i in range(apps):
+            if rate:
+                delay = begin + len(tasks) / float(rate) - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            ok, task = ci_core.create_task(
+                'app{}'.format(i), 'noop-{}'.format(n))
+            assert ok, task
+            tasks.append(task)
+    return tasks
+
+
+def run(apps, tasks_per_app, rate, step, pool):
+    """ Run one scenario and return its results """
+    ci_core = new_core(apps, step, pool)
+    for w in ci_core.program.state.ci_workers:
+        w.daemon = True
+        w.start()
+
+    begin = time.time()
+    tasks = submit(ci_core, apps, tasks_per_app, rate)
+    submitted = time.time() - begin
+    for _ in tasks:
+        noop_workers.done.acquire()
+    elapsed = time.time() - begin
+    ci_core.task_router.close()
+
+    latencies = sorted(t.taken - t.start for t in tasks)
+    return {
+        'apps': apps, 'tasks': len(tasks), 'rate': rate, 'step': step,
+        'pool': pool,
+        'submit_rate': len(tasks) / submitted,
+        'throughput': len(tasks) / elapsed,
+        'p50_ms': util.percentile(latencies, 50) * 1000,
+        'p99_ms': util.percentile(latencies, 99) * 1000,
+        'bytes_per_queued_task': queued_task_memory(apps, step, pool),
+    }
+
+
+def queued_task_memory(apps, step, pool, count=10000):
+    """ Memory allocated per queued task (workers not started) """
+    ci_core = new_core(apps, step, pool)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    tasks = submit(ci_core, apps, max(1, count // apps), 0)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    ci_core.task_router.close()
+    return used / float(len(tasks))
+
+
+# Result -> whether a higher value is better
+METRICS = {
+    'throughput': True, 'p50_ms': False, 'p99_ms': False,
+    'bytes_per_queued_task': False,
+}
+
+
+def scenario(result):
+    return tuple(result[k] for k in ('apps', 'tasks', 'rate', 'step', 'pool'))
+
+
+def regressions(results, baseline, threshold):
+    """ Compare results with the baseline (same scenarios only) """
+    baseline = {scenario(b): b for b in baseline}
+    found = []
+    for result in results:
+        base = baseline.get(scenario(result))
+        if base is None:
+            continue
+        for key, higher_is_better in METRICS.items():
+            new, old = result[key], base[key]
+            if higher_is_better:
+                worse = new < old * (1 - threshold)
+            else:
+                worse = new > old * (1 + threshold)
+            if worse:
+                found.append('apps={}: {} {:.2f} -> {:.2f}'.format(
+                    result['apps'], key, old, new))
+    return found
+
+
+def slowdown(results):
+    """ Return the smallest and largest app counts and how many times
+    lower the throughput of the largest is """
+    first = min(results, key=lambda r: r['apps'])
+    last = max(results, key=lambda r: r['apps'])
+    return first, last, first['throughput'] / last['throughput']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ciex task benchmark')
+    parser.add_argument('--apps', default='10,500',
+                        help='comma separated app counts (default 10,500)')
+    parser.add_argument('--tasks-per-app', type=int, default=20)
+    parser.add_argument('--rate', type=float, default=0,
+                        help='submitted tasks per second (0: no limit)')
+    parser.add_argument('--step', type=float, default=0,
+                        help='duration of each task in seconds')
+    parser.add_argument('--pool', choices=('app', 'shared'), default='app')
+    parser.add_argument('--baseline', help='results to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='allowed regression (default 0.2 = 20%%)')
+    parser.add_argument('--max-slowdown', type=float, default=5,
+                        help='allowed throughput ratio between the '
+                        'smallest and largest app counts (default 5)')
+    parser.add_argument('--save', help='write the results to this file')
+    args = parser.parse_args()
+
+    results = []
+    for apps in util.split_list(args.apps):
+        result = run(int(apps), args.tasks_per_app, args.rate, args.step,
+                     args.pool)
+        results.append(result)
+        print('apps: {apps}, tasks: {tasks}, '
+              'submitted: {submit_rate:.0f} tasks/sec, '
+              'throughput: {throughput:.0f} tasks/sec, '
+              'latency p50 {p50_ms:.2f} ms, p99 {p99_ms:.2f} ms, '
+              'memory: {bytes_per_queued_task:.0f} bytes per queued task'
+              .format(**result))
+
+    if args.save:
+        with open(args.save, 'w') as fh:
+            json.dump(results, fh, indent=2)
+    found = []
+    first, last, ratio = slowdown(results)
+    if ratio > args.max_slowdown:
+        found.append('throughput {:.1f} times lower with {} apps than with '
+                     '{} apps'.format(ratio, last['apps'], first['apps']))
+    if args.baseline:
+        with open(args.baseline) as fh:
+            found.extend(regressions(results, json.load(fh), args.threshold))
+    for line in found:
+        print('REGRESSION {}'.format(line))
+    if found:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,27 @@
+# Synthetic ci workers used by the benchmarks
+
+import time
+import threading
+
+from ciex.worker import CIWorker
+
+
+# Released once per finished task
+done = threading.Semaphore(0)
+
+
+class NoopWorker(CIWorker):
+    """ Every `noop-<n>` command sleeps `step_duration` seconds (an app
+    setting), so the benchmark can queue many distinct tasks per app """
+
+    def __getattr__(self, name):
+        if name.startswith('noop'):
+            return self.noop
+        raise AttributeError(name)
+
+    def noop(self, task):
+        duration = float(getattr(task.env, 'step_duration', 0))
+        if duration:
+            time.sleep(duration)
+        done.release()
+        return task.success()
@@ -0,0 +1,202 @@
+# Asyncio based task execution (python 3 only, imported on demand)
+
+import time
+import asyncio
+import inspect
+import logging
+import threading
+
+import oi.worker
+
+from . import context
+from . import metrics
+from . import process
+from . import pipeline
+from .worker import step_copy, step_error, start_timer, interrupted
+
+
+class AsyncEngine(oi.worker.Worker):
+    """ Run an event loop which executes the tasks of the apps whose
+    ci workers opted in the asyncio engine, at most `max_tasks` at once.
+
+    Operations yielding `Command` objects have their commands run as
+    asyncio subprocesses, coroutine operations are awaited and plain
+    operations are executed in a thread """
+
+    def __init__(self, program, task_router, executors, max_tasks=256,
+                 **kwargs):
+        super(AsyncEngine, self).__init__(program, **kwargs)
+        self.task_router = task_router
+        self.executors = executors  # app name -> ci worker instance
+        self.max_tasks = max_tasks
+        self.slots = threading.Semaphore(max_tasks)
+        self.retired = threading.Event()  # set to exit after the tasks
+        self.loop = None
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        # The router blocks, so wait for tasks in a separate thread
+        feeder = threading.Thread(target=self.feed)
+        feeder.daemon = True
+        feeder.start()
+        self.loop.run_forever()
+
+    def feed(self):
+        """ Take tasks from the router while there are free slots """
+        while True:
+            self.slots.acquire()
+            task = self.task_router.take_next(self.executors, self.retired)
+            if task is None:
+                self.slots.release()
+                break  # the engine was retired (core reloaded)
+            logging.debug('* %s got work for %s', self, task.app_name)
+            self.loop.call_soon_threadsafe(self.spawn, task)
+
+        # Wait for the running tasks, then stop the loop
+        for _ in range(self.max_tasks):
+            self.slots.acquire()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def spawn(self, task):
+        asyncio.ensure_future(self.handle(task))
+
+    async def handle(self, task):
+        """ Execute task and always hand it back to the router, so
+        the app's running slot is freed """
+        try:
+            result = await self.execute(self.executors[task.app_name], task)
+            if result is not task:
+                raise ValueError(
+                    'operation {} did not return the task'.format(
+                        task.command))
+        except Exception as e:
+            task.error = str(e)
+            task.failure()
+            logging.error('* Task %s failed: %s', task, e, exc_info=1)
+        finally:
+            try:
+                if task.finish is None:
+                    task.failure()
+                self.task_router.put_finished(task)
+            finally:
+                self.slots.release()
+
+    async def execute(self, worker, task):
+        """ Same as `CIWorker.execute`, without blocking the loop """
+        function = getattr(worker, task.command, None)
+        if task.command not in worker.pipelines and \
+                not inspect.isgeneratorfunction(function) and \
+                not asyncio.iscoroutinefunction(function):
+            # Executed (and timed) by the worker, in a thread
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(None, worker.execute, task)
+
+        begin = time.time()
+        if task.control is None:
+            task.control = process.TaskControl()
+        timer = start_timer(task)
+        try:
+            result = await self.operate(worker, task, function)
+        finally:
+            if timer is not None:
+                timer.cancel()
+            metrics.operation_duration.observe(
+                (task.app_name, task.command), time.time() - begin)
+        if task.control.reason is not None:
+            task.interrupted(task.control.reason)
+        return result
+
+    async def operate(self, worker, task, function):
+        if task.command in worker.pipelines:
+            return await self.run_pipeline(worker, task)
+        if inspect.isgeneratorfunction(function):
+            try:
+                return await self.drive(task, function(task))
+            except Exception as e:
+                task.error = str(e)
+                task.failure()
+                logging.error('* Task %s failed: %s', task, e, exc_info=1)
+            return task
+        return await function(task)
+
+    async def run_pipeline(self, worker, task):
+        """ Same as `CIWorker.run_pipeline`, with the steps running as
+        asyncio tasks """
+        try:
+            run = pipeline.Pipeline(
+                worker.pipelines[task.command]).new_run(task)
+        except ValueError as e:
+            task.error = str(e)
+            return task.failure()
+
+        parallel = getattr(task.env, 'parallel_steps', 4)
+        running = set()
+        while True:
+            for step in run.ready()[:parallel - len(run.running)]:
+                run.begin(step.name)
+                running.add(asyncio.ensure_future(
+                    self.run_step(worker, task, step)))
+            if run.done():
+                break
+            done, running = await asyncio.wait(
+                running, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                run.end(*future.result())
+        return run.finish(task)
+
+    async def run_step(self, worker, task, step):
+        step_task = step_copy(task, step)
+        try:
+            await self.execute(worker, step_task)
+        except Exception as e:
+            step_task.error = str(e)
+            step_task.failure()
+        return step.name, step_error(step_task)
+
+    async def drive(self, task, steps):
+        """ Same as `CIWorker.drive`, with asyncio subprocesses """
+        code = None
+        while True:
+            try:
+                command = steps.send(code)
+            except StopIteration:
+                break
+            if interrupted(task):
+                steps.close()
+                break
+            env = command.env
+            if env is None:
+                env = context.command_env(task)
+            code = await self.sh(
+                command.line, command.cwd, env, output=task.output,
+                control=task.control)
+
+        if task.finish is None:
+            task.success()
+        return task
+
+    async def sh(self, line, cwd=None, env=None, output=None, control=None):
+        """ Same as `CIWorker.sh`, with an asyncio subprocess """
+        if output is None:
+            proc = await asyncio.create_subprocess_shell(
+                line, cwd=cwd, env=env, start_new_session=True)
+        else:
+            output.write('$ {}\n'.format(line).encode())
+            proc = await asyncio.create_subprocess_shell(
+                line, cwd=cwd, env=env, stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.STDOUT, start_new_session=True)
+        if control is not None:
+            control.add(proc.pid)
+        try:
+            if output is not None:
+                while True:
+                    chunk = await proc.stdout.read(65536)
+                    if not chunk:
+                        break
+                    output.write(chunk)
+            return await proc.wait()
+        finally:
+            if control is not None:
+                control.remove(proc.pid)
@@ -0,0 +1,175 @@
+# Content addressed release artifacts
+
+import os
+import stat
+import time
+import shutil
+import hashlib
+import logging
+
+
+def file_key(path, mode):
+    """ Content hash of a file, with its permission bits (hardlinks
+    share them) """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return '{}-{:o}'.format(digest.hexdigest(), stat.S_IMODE(mode))
+
+
+class ArtifactStore(object):
+    """ The releases of an app, stored under `path`:
+
+    - `objects/`: each distinct file once, named by its content hash
+    - `release/<tag>/`: the release's tree, hardlinked to the objects
+    - `current`: symlink to the active release, swapped atomically
+    - `releases`: the stored tags, oldest first, one per line """
+
+    def __init__(self, path):
+        super(ArtifactStore, self).__init__()
+        self.path = path
+        self.objects_path = os.path.join(path, 'objects')
+        self.releases_path = os.path.join(path, 'release')
+        self.current_path = os.path.join(path, 'current')
+        self.index_path = os.path.join(path, 'releases')
+
+    def release_path(self, tag):
+        return os.path.join(self.releases_path, tag)
+
+    def has(self, tag):
+        return os.path.isdir(self.release_path(tag))
+
+    def add(self, tag, src):
+        """ Store the `src` directory as release `tag`. Files already
+        in the store (from other releases) are only linked """
+        if self.has(tag):
+            return self.release_path(tag)
+        tmp = os.path.join(self.releases_path, '.{}.tmp'.format(tag))
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+
+        for root, dirs, files in os.walk(src):
+            dest_root = os.path.join(tmp, os.path.relpath(root, src))
+            for name in dirs:
+                path = os.path.join(root, name)
+                if os.path.islink(path):
+                    os.symlink(
+                        os.readlink(path), os.path.join(dest_root, name))
+                else:
+                    os.mkdir(os.path.join(dest_root, name))
+            for name in files:
+                path = os.path.join(root, name)
+                dest = os.path.join(dest_root, name)
+                if os.path.islink(path):
+                    os.symlink(os.readlink(path), dest)
+                else:
+                    os.link(self.store_object(path), dest)
+
+        os.rename(tmp, self.release_path(tag))
+        self.write_index(self.releases() + [tag])
+        return self.release_path(tag)
+
+    def store_object(self, path):
+        """ Copy a file in the objects (unless it's there already) and
+        return the object's path """
+        key = file_key(path, os.stat(path).st_mode)
+        obj = os.path.join(self.objects_path, key[:2], key)
+        if not os.path.exists(obj):
+            directory = os.path.dirname(obj)
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            tmp = '{}.{}.tmp'.format(obj, os.getpid())
+            shutil.copy2(path, tmp)
+            os.rename(tmp, obj)
+        return obj
+
+    def releases(self):
+        """ Return the stored release tags, oldest first """
+        if not os.path.exists(self.index_path):
+            return []
+        with open(self.index_path) as fh:
+            tags = [line.strip() for line in fh]
+        return [t for t in tags if t and self.has(t)]
+
+    def write_index(self, tags):
+        tmp = self.index_path + '.tmp'
+        with open(tmp, 'w') as fh:
+            fh.write(''.join(t + '\n' for t in tags))
+        os.rename(tmp, self.index_path)
+
+    def current(self):
+        """ Return the tag of the active release (or None) """
+        if not os.path.islink(self.current_path):
+            return None
+        return os.path.basename(os.readlink(self.current_path))
+
+    def previous(self):
+        """ Return the release stored before the active one (or None) """
+        releases = self.releases()
+        current = self.current()
+        if current not in releases:
+            return None
+        i = releases.index(current)
+        return releases[i - 1] if i else None
+
+    def activate(self, tag):
+        """ Make `tag` the active release: a symlink swap """
+        if not self.has(tag):
+            raise ValueError('no release {}'.format(tag))
+        tmp = self.current_path + '.tmp'
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        os.symlink(os.path.join('release', tag), tmp)
+        os.rename(tmp, self.current_path)
+
+    def gc(self, keep=5):
+        """ Remove all but the `keep` most recent releases (the active
+        and previous ones are always kept), then the objects no release
+        links to anymore """
+        protected = {self.current(), self.previous()}
+        releases = self.releases()
+        old = [t for t in releases[:max(0, len(releases) - keep)]
+               if t not in protected]
+        for tag in old:
+            logging.debug('* Removing release %s', tag)
+            shutil.rmtree(self.release_path(tag))
+        if old:
+            self.write_index([t for t in releases if t not in old])
+
+        removed = 0
+        if not os.path.exists(self.objects_path):
+            return removed
+        for root, _, files in os.walk(self.objects_path):
+            for name in files:
+                path = os.path.join(root, name)
+                if not name.endswith('.tmp') and os.stat(path).st_nlink == 1:
+                    os.remove(path)
+                    removed += 1
+        return removed
+
+    def info(self):
+        """ Return the releases with their creation time, and the active
+        release """
+        return {
+            'current': self.current(),
+            'releases': [
+                {'tag': t, 'created': os.stat(self.release_path(t)).st_mtime}
+                for t in self.releases()],
+        }
+
+
+def release_tag(commit=None):
+    """ The tag of a new release: the commit it's built from, or the
+    current time """
+    return commit[:12] if commit else time.strftime('%Y%m%d%H%M%S')
+
+
+def app_store(env):
+    """ Return the artifact store of an app, or None if its settings
+    have no `install_path` """
+    path = getattr(env, 'install_path', None)
+    if not path:
+        return None
+    return ArtifactStore(os.path.join(path, env.name))
@@ -0,0 +1,169 @@
+# Build cache
+
+import os
+import time
+import shutil
+import hashlib
+import logging
+import subprocess
+
+
+def repo_head(repo_path):
+    """ Return the commit hash checked out in `repo_path` (or None) """
+    try:
+        out = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=repo_path,
+            stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.decode().strip()
+
+
+def lockfiles_hash(repo_path, lockfiles):
+    """ Hash the dependency lockfiles found in `repo_path` """
+    digest = hashlib.sha256()
+    for name in lockfiles:
+        path = os.path.join(repo_path, name)
+        digest.update(name.encode())
+        if os.path.exists(path):
+            with open(path, 'rb') as fh:
+                digest.update(fh.read())
+    return digest.hexdigest()
+
+
+def build_key(repo_path, lockfiles):
+    """ Key of a build: repo HEAD plus the lockfiles hash (None outside
+    of a git repo) """
+    head = repo_head(repo_path)
+    if head is None:
+        return None
+    return '{}-{}'.format(head, lockfiles_hash(repo_path, lockfiles))
+
+
+def dir_size(path):
+    """ Size in bytes of all the files under `path` """
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class BuildCache(object):
+    """ Build cache of a single app, stored under `path`:
+
+    - `last_build` holds the key (commit + lockfiles hash) of the last
+      successful build, so building the same key again can be skipped
+    - `deps/<lockfiles hash>/` holds copies of the dependency dirs, so
+      they can be reused when only the app code changed
+
+    Dependency entries are evicted, least recently used first, when
+    they take more than `max_bytes` """
+
+    marker = '.ciex-deps-key'  # written in the repo's dependency dirs
+
+    def __init__(self, path, max_bytes):
+        super(BuildCache, self).__init__()
+        self.path = path
+        self.max_bytes = max_bytes
+        self.deps_path = os.path.join(path, 'deps')
+
+    def is_built(self, key):
+        """ Was `key` the last successful build """
+        path = os.path.join(self.path, 'last_build')
+        if key is None or not os.path.exists(path):
+            return False
+        with open(path) as fh:
+            return fh.read().strip() == key
+
+    def mark_built(self, key):
+        """ Remember `key` as the last successful build """
+        if key is None:
+            return
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        tmp = os.path.join(self.path, 'last_build.tmp')
+        with open(tmp, 'w') as fh:
+            fh.write(key)
+        os.rename(tmp, os.path.join(self.path, 'last_build'))
+
+    def restore_deps(self, repo_path, lockfiles, deps_dirs):
+        """ Make sure the repo's dependency dirs match its lockfiles,
+        copying them from the cache if needed. Return True if they do
+        (so fetching dependencies can be skipped) """
+        key = lockfiles_hash(repo_path, lockfiles)
+        entry = os.path.join(self.deps_path, key)
+        if all(self.deps_key(repo_path, d) == key for d in deps_dirs):
+            self.touch(entry)
+            return True
+        if not os.path.exists(entry):
+            return False
+
+        for name in deps_dirs:
+            target = os.path.join(repo_path, name)
+            if os.path.exists(target):
+                shutil.rmtree(target)
+            shutil.copytree(os.path.join(entry, name), target, symlinks=True)
+        self.touch(entry)
+        logging.debug('* Restored cached deps %s for %s', key, repo_path)
+        return True
+
+    def save_deps(self, repo_path, lockfiles, deps_dirs):
+        """ Store the repo's dependency dirs in the cache """
+        key = lockfiles_hash(repo_path, lockfiles)
+        for name in deps_dirs:
+            target = os.path.join(repo_path, name)
+            if os.path.isdir(target):
+                with open(os.path.join(target, self.marker), 'w') as fh:
+                    fh.write(key)
+
+        entry = os.path.join(self.deps_path, key)
+        if os.path.exists(entry):
+            self.touch(entry)
+            return
+        tmp = entry + '.tmp'
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+        for name in deps_dirs:
+            source = os.path.join(repo_path, name)
+            if os.path.isdir(source):
+                shutil.copytree(
+                    source, os.path.join(tmp, name), symlinks=True)
+        os.rename(tmp, entry)
+        self.evict()
+
+    def deps_key(self, repo_path, name):
+        """ Lockfiles hash the repo's dependency dir was made for """
+        try:
+            with open(os.path.join(repo_path, name, self.marker)) as fh:
+                return fh.read().strip()
+        except (IOError, OSError):
+            return None
+
+    def touch(self, entry):
+        """ Mark a cache entry as recently used """
+        if os.path.exists(entry):
+            now = time.time()
+            os.utime(entry, (now, now))
+
+    def evict(self):
+        """ Remove the least recently used deps until under `max_bytes` """
+        entries = []
+        for name in os.listdir(self.deps_path):
+            entry = os.path.join(self.deps_path, name)
+            if name.endswith('.tmp') or not os.path.isdir(entry):
+                continue
+            entries.append((os.stat(entry).st_mtime, entry, dir_size(entry)))
+
+        total = sum(e[2] for e in entries)
+        # Keep at least the most recent entry
+        for _, entry, size in sorted(entries)[:-1]:
+            if total <= self.max_bytes:
+                break
+            logging.debug('* Evicting cached deps %s', entry)
+            shutil.rmtree(entry)
+            total -= size
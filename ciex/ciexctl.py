@@ -1,10 +1,70 @@
 # ciex command line interface
 
+import os
+import sys
+import time
+
 import oi
 
+from . import util
+from . import fleet as fleet_
+
+
+def tail(ctl, app_name, interval=0.5):
+    """ Follow the output of the last task of `app_name`, asking the
+    daemon only for the output after what was already shown """
+    offset = 0
+    while True:
+        res, err = ctl.client.call('log', app_name, offset)
+        if err:
+            return 'Err: {}'.format(err)
+        sys.stdout.write(res['data'])
+        sys.stdout.flush()
+        offset = res['offset']
+        if res['done']:
+            return res['task']
+        if not res['data']:
+            time.sleep(float(interval))
+
+
+def fleet(ctl, command, *args):
+    """ Run a command on the daemons listed in `CIEX_FLEET` (addresses,
+    comma separated or one per line in a file). `key=value` arguments
+    are options: mode (all, rolling, canary), batch_size, max_failures,
+    canary, concurrency """
+    addresses = fleet_.read_addresses(os.environ.get('CIEX_FLEET', ''))
+    if not addresses:
+        return 'Err: no daemons, set CIEX_FLEET'
+    options = util.parse_options(a for a in args if '=' in a)
+    args = [a for a in args if '=' not in a]
+    concurrency = int(options.pop('concurrency', 64))
+    try:
+        report = fleet_.Fleet(addresses, concurrency).run(
+            command, *args, **options)
+    except ValueError as e:
+        return 'Err: {}'.format(e)
+
+    for address in addresses:
+        result = report['results'].get(address)
+        if result is None:
+            print('{}  skipped'.format(address))
+        else:
+            print('{}  {}  {:.3f}s  {}'.format(
+                address, 'ok' if result['ok'] else 'FAILED',
+                result['elapsed'], result['err'] or result['res']))
+    return '{} ok, {} failed, {} skipped{} in {:.3f}s'.format(
+        report['ok'], report['failed'], report['skipped'],
+        ' (aborted)' if report['aborted'] else '', report['elapsed'])
+
 
 def main():
-    ctl = oi.CtlProgram('ctl program', 'ipc:///tmp/ciex.sock')
+    ctl = oi.CtlProgram('ctl program', util.daemon_address())
+    ctl.add_command(
+        'tail', tail, 'follow the output of the last task <appname>')
+    ctl.add_command(
+        'fleet', fleet,
+        'run a command on the fleet <command> [args] [mode=<mode>] '
+        '[batch_size=<n>] [max_failures=<n>] [canary=<n>]')
     ctl.run()
 
 
@@ -3,13 +3,18 @@
 import oi
 
 from . import core
+from . import util
 from . import worker
 
 
+BATCH_HELP = ' [max_parallel=<n>]'
+
+
 def main():
-    program = oi.Program('my program', 'ipc:///tmp/ciex.sock')
-    program.workers.append(worker.CIControlWorker(program))
+    program = oi.Program('my program', util.daemon_address())
     ci_core = core.Core(program)
+    # Initialized when the daemon starts, once the config is read
+    program.workers.append(worker.CIControlWorker(program, ci_core))
 
     program.add_command(
         'reload', ci_core.reload,
@@ -17,32 +22,70 @@ def main():
 
     program.add_command(
         'start', ci_core.start,
-        'start app <appname>')
+        'start app <appname|pattern|all> ...' + BATCH_HELP)
 
     program.add_command(
         'stop', ci_core.stop,
-        'stop app <appname>')
+        'stop app <appname|pattern|all> ...' + BATCH_HELP)
 
     program.add_command(
         'deploy', ci_core.deploy,
-        'deploy remote repo <appname>')
+        'deploy remote repo <appname|pattern|all> ...' + BATCH_HELP)
 
     program.add_command(
         'build', ci_core.build,
-        'make build <appname>')
+        'make build <appname|pattern|all> ...' + BATCH_HELP)
 
     program.add_command(
         'upgrade', ci_core.upgrade,
-        'upgrade the app <appname>')
+        'upgrade the app <appname|pattern|all> ...' + BATCH_HELP)
 
     program.add_command(
         'downgrade', ci_core.downgrade,
-        'downgrade the app <appname>')
+        'downgrade the app <appname|pattern|all> ...' + BATCH_HELP)
+
+    program.add_command(
+        'cancel', ci_core.cancel,
+        'cancel the queued and running tasks of the app <appname>')
+
+    program.add_command(
+        'pipeline', ci_core.pipeline,
+        'run a pipeline of the app <appname> <pipeline>')
+
+    program.add_command(
+        'steps', ci_core.steps,
+        'show the step timings of the last task <appname>')
+
+    program.add_command(
+        'releases', ci_core.releases,
+        'show the stored releases of the app <appname>')
 
     program.add_command(
         'last', ci_core.last,
         'show last task <appname>')
 
+    program.add_command(
+        'log', ci_core.log,
+        'read the last task output <appname> [offset]')
+
+    program.add_command(
+        'history', ci_core.history,
+        'show finished tasks [app=<appname>] [command=<command>] '
+        '[status=<status>] [since=<seconds>] [limit=<n>] [page=<n>]')
+
+    program.add_command(
+        'stats', ci_core.stats,
+        'show task counts and p50/p95 durations [app=<appname>] '
+        '[command=<command>] [since=<seconds>]')
+
+    program.add_command(
+        'waits', ci_core.waits,
+        'show queue wait times [appname]')
+
+    program.add_command(
+        'metrics', ci_core.metrics,
+        'show the daemon metrics')
+
     program.add_command(
         'list', ci_core.list,
         'list app names')
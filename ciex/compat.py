@@ -6,11 +6,41 @@ except ImportError:
     from urllib.parse import urlparse
 
 try:
-    from Queue import Queue
+    from Queue import Queue, Empty
 except ImportError:
-    from queue import Queue
+    from queue import Queue, Empty
 
 try:
     import configparser
 except ImportError:
     import ConfigParser as configparser
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+try:
+    from importlib import reload
+except ImportError:
+    reload = reload  # builtin on python 2
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+try:
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from SocketServer import ThreadingMixIn
+
+try:
+    string_types = (basestring,)
+except NameError:
+    string_types = (str,)
+
+try:
+    from http.client import HTTPConnection, HTTPSConnection
+except ImportError:
+    from httplib import HTTPConnection, HTTPSConnection
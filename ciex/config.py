@@ -0,0 +1,74 @@
+# Config files: the main one and the files it includes
+
+import os
+import glob
+import logging
+
+from . import compat
+
+
+class Section(dict):
+    """ The options of a config section, read once: a `SectionProxy`
+    looks up and interpolates the value on every access """
+
+    def __init__(self, name, options=()):
+        super(Section, self).__init__(options)
+        self.name = name
+
+    def __repr__(self):
+        return '<Section: {}>'.format(self.name)
+
+
+def read_sections(parser):
+    """ Return the sections of a config parser as `Section`s """
+    return [Section(name, parser.items(name)) for name in parser.sections()]
+
+
+def expand(patterns):
+    """ Return the files matching the paths or glob `patterns`, in
+    order, without duplicates """
+    paths, seen = [], set()
+    for pattern in patterns:
+        for path in sorted(glob.glob(os.path.expanduser(pattern))):
+            if path not in seen and os.path.isfile(path):
+                seen.add(path)
+                paths.append(path)
+    return paths
+
+
+class ConfigFiles(object):
+    """ Included config files. The result of parsing a file is cached
+    until the file's modification time or size changes, so reloading
+    a config split in many files only parses the files which changed """
+
+    def __init__(self):
+        super(ConfigFiles, self).__init__()
+        self.cache = {}  # path -> (mtime, size, result)
+
+    def load(self, path, parse):
+        """ Return `parse(sections)` for the sections of the file at
+        `path`. When the file can't be read, the result of its last
+        good version is kept (if any) and the error raised otherwise """
+        stat = os.stat(path)
+        cached = self.cache.get(path)
+        if cached is not None and cached[:2] == (stat.st_mtime, stat.st_size):
+            return cached[2]
+
+        parser = compat.configparser.ConfigParser()
+        try:
+            parser.read(path)
+            sections = read_sections(parser)
+        except compat.configparser.Error as e:
+            if cached is None:
+                raise
+            logging.error('* Keeping the last version of %s: %s', path, e)
+            return cached[2]
+
+        result = parse(sections)
+        self.cache[path] = (stat.st_mtime, stat.st_size, result)
+        return result
+
+    def forget(self, paths):
+        """ Drop the files not in `paths` from the cache """
+        for path in set(self.cache) - set(paths):
+            del self.cache[path]
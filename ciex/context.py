@@ -1,30 +1,56 @@
+# Where and with which environment the commands of a task run. Commands
+# get their `cwd` and `env` passed to their subprocess: the daemon's own
+# working directory is shared by all the worker threads and never changed
+
 import os
-from contextlib import contextmanager
+
+from . import toolchain as toolchain_
 
 
-@contextmanager
 def src_path(task):
-    """ Change to app src parent directory """
-    yield os.chdir(task.env.src_path)
+    """ Path of the parent directory of the app's repo """
+    return task.env.src_path
+
+
+def repo_path(task):
+    """ Path of the app's local repo """
+    return os.path.join(task.env.src_path, task.app_name)
+
+
+def release_path(task, tag):
+    """ Path of a release's directory """
+    return os.path.join(task.env.install_path, task.app_name, 'release', tag)
+
+
+def build_release_path(task):
+    """ Path of the release made by the last build (not versioned) """
+    return os.path.join(
+        task.env.src_path, task.app_name, 'rel', task.app_name)
+
+
+def current_release_path(task):
+    """ Path of the active release (a symlink to one of the releases) """
+    return os.path.join(task.env.install_path, task.app_name, 'current')
 
 
-@contextmanager
-def local_repo(task):
-    """ Change to local repo directory """
-    path = os.path.join(task.env.src_path, task.app_name)
-    yield os.chdir(path)
+def release_bin_path(task):
+    """ Path of the release main bin directory: the active release's,
+    or the last build's when no release was activated """
+    if getattr(task.env, 'install_path', None):
+        path = current_release_path(task)
+        if os.path.islink(path):
+            return os.path.join(path, 'bin')
+    return os.path.join(build_release_path(task), 'bin')
 
 
-@contextmanager
-def local_release(task, tag):
-    """ Go to a release's directory """
-    path = os.path.join(task.env.install_path, task.app_name, 'release', tag)
-    yield os.chdir(path)
+def toolchain(task):
+    """ The app's toolchain, resolved once per settings """
+    return toolchain_.for_app(task.env)
 
 
-@contextmanager
-def local_release_bin(task):
-    """ Local release main bin directory (not versioned) """
-    path = os.path.join(
-        task.env.src_path, task.app_name, 'rel', task.app_name, 'bin')
-    yield os.chdir(path)
+def command_env(task, **variables):
+    """ Environment of a task's commands: the app's toolchain (the
+    daemon's environment by default), plus `variables`, the variables
+    of its prepared prefix and the app's `command_env` setting (which
+    wins) """
+    return toolchain(task).environment(variables)
@@ -3,25 +3,9 @@ import functools
 import logging
 
 
-from ciex.worker import CIWorker
+from ciex.worker import CIWorker, Command
 from ciex import context
-
-
-def with_path(attr_or_function):
-    """ Change working dir to `path` if path is not callable,
-    or path(task) if path is callabele """
-    def decorator(fun):
-        @functools.wraps(fun)
-        def wrapper(self, *args, **kwargs):
-            if callable(attr_or_function):
-                path = attr_or_function(*args)
-            else:
-                task = args[0]
-                path = getattr(task.env, path)
-            os.chdir(path)
-            return fun(self, *args, **kwargs)
-        return wrapper
-    return decorator
+from ciex import mirror
 
 
 def ensure_path(fn):
@@ -30,8 +14,12 @@ def ensure_path(fn):
         @functools.wraps(fun)
         def wrapper(self, *args, **kwargs):
             path = fn(*args, **kwargs)
-            if not os.path.exists(path):
+            try:
                 os.makedirs(path)
+            except OSError:
+                # Created meanwhile by the worker of another app
+                if not os.path.isdir(path):
+                    raise
             return fun(self, *args, **kwargs)
         return wrapper
     return decorator
@@ -40,53 +28,106 @@ def ensure_path(fn):
 class ElixirCIWorker(CIWorker):
     """ Do work required to upgrade, downgrade the app """
 
+    lockfiles = ('mix.lock',)
+    deps_dirs = ('deps',)
+    toolchain_env = {'MIX_HOME': 'mix', 'HEX_HOME': 'hex'}
+
     def start_(self, task):
-        with context.local_release_bin(task):
-            code = os.system('./{} start'.format(task.app_name))
-            assert code is 0
-        return task.success()
+        code = yield Command(
+            './{} start'.format(task.app_name), context.release_bin_path(task))
+        assert code == 0
+        task.success()
 
     def stop(self, task):
-        with context.local_release_bin(task):
-            code = os.system('./{} stop'.format(task.app_name))
-            assert code is 0
-        return task.success()
+        code = yield Command(
+            './{} stop'.format(task.app_name), context.release_bin_path(task))
+        assert code == 0
+        task.success()
 
     # Ensure install folder exists on the machine
-    @ensure_path(lambda task: os.path.join(task.env.src_path))
+    @ensure_path(context.src_path)
     def deploy(self, task):
         """ Create dir if necessary and clone repo """
 
-        with context.src_path(task) as code:
-            logging.debug('* Cloning ...')
-            code = os.system('git clone {}'.format(task.env.repo))
-            logging.debug('* git clone: {}'.format(code))
+        logging.debug('* Cloning ...')
+        for command in mirror.deploy_commands(task):
+            code = yield command
+            logging.debug('* %s: %s', command.line, code)
             assert code == 0
-            return task.success()
+        task.success()
 
     def pull(self, task):
         """ Pull changes remote repository """
 
-        with context.local_repo(taks):
-            code = os.system('git pull')
-            logging.debug('* git pull: {}'.format(code))
+        for command in mirror.pull_commands(task):
+            code = yield command
+            logging.debug('* %s: %s', command.line, code)
             assert code == 0
-        return task.success()
+        task.success()
 
     def build(self, task):
-        """ Make release """
-
-        with context.local_repo(task):
-            os.system('mix deps.get')
-            os.environ['MIX_ENV'] = 'prod'
-            os.system('mix release')
+        """ Make release. With a build cache, skip it if this commit and
+        lockfile were already built, and reuse the cached deps when
+        only the app code changed. With a remote cache, download the
+        release another daemon built instead of building it. The app's
+        toolchain prefix is prepared first, once per lockfiles """
+
+        cwd = context.repo_path(task)
+        release = context.build_release_path(task)
+        cache = self.build_cache(task)
+        remote = self.remote_cache(task)
+        key, have_deps = None, False
+        if cache is not None or remote is not None:
+            key = self.build_key(task)
+        if cache is not None:
+            if cache.is_built(key):
+                logging.debug('* %s already built %s', task.app_name, key)
+                task.success()
+                return
+        if remote is not None and key is not None and \
+                self.fetch_release(remote, key, release):
+            self.store_release(task, release)
+            if cache is not None:
+                cache.mark_built(key)
+            task.success()
+            return
+        setup = self.toolchain_setup(task)
+        if setup is not None:
+            code = yield setup
+            assert code == 0, 'toolchain setup failed'
+            self.toolchain_ready(task)
+
+        if cache is not None:
+            have_deps = cache.restore_deps(cwd, self.lockfiles, self.deps_dirs)
+
+        if not have_deps:
+            code = yield Command('mix deps.get', cwd)
+            assert code == 0
+        code = yield Command(
+            'mix release', cwd, context.command_env(task, MIX_ENV='prod'))
+        assert code == 0
+
+        self.store_release(task, release)
+        if remote is not None and key is not None:
+            self.publish_release(remote, key, release)
+        if cache is not None:
+            cache.save_deps(cwd, self.lockfiles, self.deps_dirs)
+            cache.mark_built(key)
+        task.success()
+
+    def upgrade(self, task):
+        """ Activate the last stored release """
+        store = self.artifact_store(task)
+        releases = store.releases() if store is not None else []
+        assert releases, 'no release stored'
+        if store.current() != releases[-1]:
+            store.activate(releases[-1])
         return task.success()
 
-    def upgrade(self, task, tag):
-        """ Upgrade app """
-        pass
-
-    def downgrade(self, task, tag):
-        """ Downgrade app """
-        with context.local_bin(task):
-            os.system('./{} upgrade "{}"'.format(task.app_name, tag))
+    def downgrade(self, task):
+        """ Activate the release active before the current one """
+        store = self.artifact_store(task)
+        previous = store.previous() if store is not None else None
+        assert previous, 'no previous release'
+        store.activate(previous)
+        return task.success()
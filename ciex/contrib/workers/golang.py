@@ -5,4 +5,6 @@ from ciex.worker import CIWorker
 
 
 class GolangCIWorker(CIWorker):
-    pass
+    lockfiles = ('go.sum',)
+    deps_dirs = ('vendor',)
+    toolchain_env = {'GOPATH': 'go', 'GOCACHE': 'cache'}
@@ -2,22 +2,146 @@
 
 import time
 import enum
+import uuid
+import heapq
+import fnmatch
 import logging
 import functools
+import threading
+import collections
+import multiprocessing
 
 from . import error
 from . import compat
+from . import config
+from . import artifacts
 from . import util
+from . import journal
+from . import history
+from . import tasklog
+from . import metrics
+from . import process
+from . import resources
+from . import toolchain
+from . import webhook
+from . import worker
+
+
+def parse_timeouts(value):
+    """ Parse `command:seconds` items (e.g. `build:1800, deploy:300`) """
+    timeouts = {}
+    for item in util.split_list(value):
+        command, _, seconds = item.partition(':')
+        timeouts[command.strip()] = float(seconds)
+    return timeouts
+
+
+def parse_count(name, value, minimum=0):
+    """ Parse an integer option of a command, at least `minimum` """
+    value = str(value)
+    if not value.isdigit() or int(value) < minimum:
+        raise ValueError('{} must be an integer >= {}'.format(name, minimum))
+    return int(value)
+
+
+def parse_env(value):
+    """ Parse `name=value` items (e.g. `MIX_ENV=prod, PORT=4000`) """
+    env = {}
+    for item in util.split_list(value):
+        name, sep, variable = item.partition('=')
+        if not sep or not name.strip():
+            raise ValueError('bad environment variable {}'.format(item))
+        env[name.strip()] = variable.strip()
+    return env
 
 
 class AppSetting(object):
     """ An AppSetting object contains the information related
-    to a single app's configuration described in the "--config" file """
+    to a single app's configuration described in the "--config" file.
+
+    The options used by the core are parsed into slots, the others
+    (repo, src_path, etc) are read from `options` """
+
+    __slots__ = (
+        'name', 'options', 'worker_concurrency', 'parallel_commands',
+        'max_queue', 'coalesce', 'weight', 'parallel_steps', 'lazy',
+        'timeout', 'command_timeouts', 'command_env', 'command_cpu',
+        'command_memory')
 
     def __init__(self, name, **kwargs):
         super(AppSetting, self).__init__()
         self.name = name
-        self.__dict__.update(kwargs)
+        self.options = kwargs  # the section's options (strings)
+
+        # Number of tasks allowed to run at the same time for this app
+        self.worker_concurrency = int(kwargs.get('worker_concurrency', 1))
+
+        # Commands which may overlap with other tasks of the same app
+        # (`*` means all commands), the others run exclusively
+        self.parallel_commands = util.split_list(
+            kwargs.get('parallel_commands', ''))
+
+        # Max number of queued tasks (0 means no limit) and whether a
+        # command identical to a queued one is merged into it
+        self.max_queue = int(kwargs.get('max_queue', 0))
+        self.coalesce = kwargs.get('coalesce', 'true').lower() == 'true'
+
+        # Share of the shared workers given to this app
+        self.weight = float(kwargs.get('weight', 1))
+
+        # Number of pipeline steps of a task allowed to run at once
+        self.parallel_steps = int(kwargs.get('parallel_steps', 4))
+
+        # Load the worker on the first task of the app (rarely used apps)
+        self.lazy = kwargs.get('lazy', 'false').lower() == 'true'
+
+        # Seconds after which the commands of a task are killed (0 means
+        # no timeout), by default and per command (e.g. `build:1800`)
+        self.timeout = float(kwargs.get('timeout', 0))
+        self.command_timeouts = parse_timeouts(
+            kwargs.get('command_timeouts', ''))
+
+        # Environment variables added to the commands of the app's tasks
+        self.command_env = parse_env(kwargs.get('command_env', ''))
+
+        # Cpu slots and memory (MB) taken from the daemon's budget while
+        # a command runs (e.g. `build:4`, `*` for the other commands)
+        self.command_cpu = parse_timeouts(kwargs.get('command_cpu', ''))
+        self.command_memory = parse_timeouts(
+            kwargs.get('command_memory_mb', ''))
+
+    def __getattr__(self, name):
+        if name == 'options':
+            raise AttributeError(name)
+        try:
+            return self.options[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __repr__(self):
+        return '<AppSetting {}>'.format(self.name)
+
+    def __eq__(self, other):
+        return isinstance(other, AppSetting) and all(
+            getattr(self, k) == getattr(other, k) for k in self.__slots__)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def timeout_for(self, command):
+        """ Return the timeout of `command` in seconds (0 for none) """
+        return self.command_timeouts.get(command, self.timeout)
+
+    def cost_of(self, command):
+        """ Return the (cpu slots, memory MB) cost of `command` """
+        cpu, memory = self.command_cpu, self.command_memory
+        return (cpu.get(command, cpu.get('*', 0)),
+                memory.get(command, memory.get('*', 0)))
+
+    def is_parallel(self, command):
+        """ Check if `command` can run next to other tasks of this app """
+        return '*' in self.parallel_commands or \
+            command in self.parallel_commands
 
     @classmethod
     def validate(cls, section):
@@ -32,6 +156,97 @@ class AppSetting(object):
                 raise error.AppSettingError(
                     '{} missing from section {}'.format(key, section))
 
+        concurrency = section.get('worker_concurrency', '1').strip('"').strip()
+        if not concurrency.isdigit() or int(concurrency) < 1:
+            raise error.AppSettingError(
+                'worker_concurrency must be a positive integer in {}'.format(
+                    section))
+
+        parallel_steps = section.get('parallel_steps', '1').strip('"').strip()
+        if not parallel_steps.isdigit() or int(parallel_steps) < 1:
+            raise error.AppSettingError(
+                'parallel_steps must be a positive integer in {}'.format(
+                    section))
+
+        max_queue = section.get('max_queue', '0').strip('"').strip()
+        if not max_queue.isdigit():
+            raise error.AppSettingError(
+                'max_queue must be a non negative integer in {}'.format(
+                    section))
+
+        max_mb = section.get('build_cache_max_mb', '1').strip('"').strip()
+        if not max_mb.isdigit():
+            raise error.AppSettingError(
+                'build_cache_max_mb must be an integer in {}'.format(section))
+
+        keep = section.get('release_keep', '5').strip('"').strip()
+        if not keep.isdigit() or int(keep) < 1:
+            raise error.AppSettingError(
+                'release_keep must be a positive integer in {}'.format(
+                    section))
+
+        for key, default in [('coalesce', 'true'), ('lazy', 'false'),
+                             ('inherit_env', 'true')]:
+            value = section.get(key, default).strip('"').strip()
+            if value.lower() not in ('true', 'false'):
+                raise error.AppSettingError(
+                    '{} must be true or false in {}'.format(key, section))
+
+        try:
+            weight = float(section.get('weight', '1').strip('"'))
+        except ValueError:
+            weight = 0
+        if weight <= 0:
+            raise error.AppSettingError(
+                'weight must be a positive number in {}'.format(section))
+
+        try:
+            timeout = float(section.get('timeout', '0').strip('"'))
+            parse_timeouts(section.get('command_timeouts', '').strip('"'))
+        except ValueError:
+            timeout = -1
+        if timeout < 0:
+            raise error.AppSettingError(
+                'timeout must be a number of seconds and command_timeouts '
+                'look like build:1800, deploy:300 in {}'.format(section))
+
+        try:
+            costs = list(parse_timeouts(
+                section.get('command_cpu', '').strip('"')).values())
+            costs.extend(parse_timeouts(
+                section.get('command_memory_mb', '').strip('"')).values())
+        except ValueError:
+            costs = [-1]
+        if any(cost < 0 for cost in costs):
+            raise error.AppSettingError(
+                'command_cpu and command_memory_mb must look like build:4, '
+                '*:1 in {}'.format(section))
+
+        try:
+            parse_env(section.get('command_env', '').strip('"'))
+        except ValueError:
+            raise error.AppSettingError(
+                'command_env must look like MIX_ENV=prod, PORT=4000 '
+                'in {}'.format(section))
+
+        try:
+            versions = toolchain.parse_versions(
+                section.get('toolchain_versions', '').strip('"'))
+        except ValueError:
+            versions = None
+        if versions is None or (versions and not section.get(
+                'toolchain_root', '').strip('"').strip()):
+            raise error.AppSettingError(
+                'toolchain_versions must look like erlang:26.2, '
+                'elixir:1.15.7 and need a toolchain_root in {}'.format(
+                    section))
+
+        engine = section.get('worker_engine', 'thread').strip('"').strip()
+        if engine not in ('thread', 'asyncio'):
+            raise error.AppSettingError(
+                'worker_engine must be thread or asyncio in {}'.format(
+                    section))
+
     @classmethod
     def new(cls, section):
         """ Create a new AppSetting object from a config section """
@@ -47,22 +262,40 @@ class TaskStatus(enum.Enum):
     pending = 0
     success = 1
     failure = 2
+    timeout = 3
+    cancelled = 4
 
 
 class Task(object):
-    """ Work to be executed by the CI Workers """
+    """ Work to be executed by the CI Workers. Queues and histories can
+    hold many of them, hence the slots; `env` is shared with the other
+    tasks of the app (the app's `AppSetting`) """
+
+    __slots__ = (
+        'id', 'app_name', 'command', 'status', 'error', 'env', 'start',
+        'taken', 'finish', 'output', 'steps', 'batch', 'control', 'cost',
+        'blocked')
 
     def __init__(self, app_name, command, status=None, error=None,
-                 env=None, start=None, finish=None):
+                 env=None, start=None, finish=None, task_id=None,
+                 taken=None, steps=None):
         super(Task, self).__init__()
+        self.id = task_id or uuid.uuid4().hex
         self.app_name = app_name
         self.command = command
         self.status = status or TaskStatus.pending
-        self.error = None
+        self.error = error
 
         self.env = env
         self.start = start or time.time()
-        self.finish = None
+        self.taken = taken  # when a worker took the task from the queue
+        self.finish = finish
+        self.output = None  # TaskLog with the output of its commands
+        self.steps = steps  # timings of the steps of a pipeline task
+        self.batch = None  # Batch the task was submitted with, if any
+        self.control = None  # process.TaskControl, once running
+        self.cost = None  # resources held from the budget, once running
+        self.blocked = None  # budget admissions when it first didn't fit
 
     def __str__(self):
         t = '<Task(app_name={}, command={}, status={}, error={}, start={}, finish={})>'
@@ -70,6 +303,25 @@ class Task(object):
             self.app_name, self.command, self.status,
             self.error, self.start, self.finish)
 
+    def to_record(self, event):
+        """ Return a plain dict describing the task (for the journal) """
+        return {
+            'event': event, 'id': self.id, 'app_name': self.app_name,
+            'command': self.command, 'status': self.status.name,
+            'error': self.error, 'start': self.start, 'taken': self.taken,
+            'finish': self.finish, 'steps': self.steps,
+        }
+
+    @classmethod
+    def from_record(cls, record):
+        """ Create a task from a journal record """
+        return cls(
+            record['app_name'], record['command'],
+            TaskStatus[record['status']], record['error'],
+            start=record['start'], finish=record['finish'],
+            task_id=record['id'], taken=record['taken'],
+            steps=record.get('steps'))
+
     def finished(self):
         """ Mark finish timestamp """
         self.finish = time.time()
@@ -90,48 +342,486 @@ class Task(object):
         self.status = TaskStatus.failure
         return self.finished()
 
+    def interrupted(self, reason):
+        """ Mark task as stopped by a `timeout` or `cancelled` """
+        self.status = TaskStatus[reason]
+        self.error = 'timed out' if reason == 'timeout' else 'cancelled'
+        return self.finished()
+
+
+class Batch(object):
+    """ Tasks submitted together, at most `limit` of them running at
+    once (0 means no limit) """
+
+    __slots__ = ('limit', 'running')
+
+    def __init__(self, limit=0):
+        super(Batch, self).__init__()
+        self.limit = limit
+        self.running = 0
+
+    def full(self):
+        return bool(self.limit) and self.running >= self.limit
+
+
+class WaitStats(object):
+    """ Queue wait times (enqueue to start) of one kind of task """
+
+    def __init__(self, size=1000):
+        super(WaitStats, self).__init__()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = collections.deque(maxlen=size)  # most recent waits
+
+    def add(self, wait):
+        self.count += 1
+        self.total += wait
+        self.max = max(self.max, wait)
+        self.samples.append(wait)
+
+    def summary(self):
+        """ Return count, mean, max and p50/p95 of the recent waits """
+        samples = sorted(self.samples)
+        return {
+            'count': self.count,
+            'mean': self.total / self.count,
+            'max': self.max,
+            'p50': util.percentile(samples, 50),
+            'p95': util.percentile(samples, 95),
+        }
+
+
+# Lower is more urgent: these commands go before the queued builds, etc
+DEFAULT_PRIORITIES = {'stop': 0, 'downgrade': 0}
+DEFAULT_PRIORITY = 1
+
 
 class TaskRouter(object):
-    """ Control the task going in / going out """
+    """ Control the task going in / going out.
+
+    Each app queue is ordered by command priority (FIFO for the same
+    priority). Workers shared by several apps (`take_next`) serve the
+    most urgent task first, then share the work between apps in
+    proportion to their `weight` (stride scheduling).
+
+    The apps with queued tasks are kept in a heap by that order, so
+    shared workers don't go through every app. Waiting workers are
+    grouped by the apps they serve, and a new or finished task only
+    wakes one worker of the groups serving its app """
 
-    def __init__(self, apps_sts, new, last):
+    def __init__(self, apps_sts, new, last, journal=None, history=None,
+                 logs=None):
         super(TaskRouter, self).__init__()
         self.apps_sts = apps_sts  # apps settings
         self.new = new  # app task queues
         self.last = last  # app last
+        self.journal = journal  # optional persistent task journal
+        self.history = history  # optional finished tasks history
+        self.logs = logs  # optional task output logs
+        self.running = {name: [] for name in apps_sts}  # app running tasks
+        self.cond = threading.Condition()
+        self.closed = False
+        self.app_waiters = {}  # app name -> waiters of `take_new`
+        self.pool_waiters = {}  # id(names) -> waiters of `take_next`
+
+        self.priorities = dict(DEFAULT_PRIORITIES)  # command -> priority
+        self.passes = {name: 0.0 for name in apps_sts}  # fair share pass
+        self.vtime = 0.0  # pass of the last app served
+        self.waits = {}  # (app name, command) -> WaitStats
+        self.budget = resources.Budget()  # cpu and memory of the host
+
+        # Heap of (priority, pass, order, app name) of the apps with
+        # queued tasks; entries which are not in `ready_keys` any more
+        # are outdated and skipped
+        self.ready = []
+        self.ready_keys = {}  # app name -> its current entry
+        self.order = {name: i for i, name in enumerate(apps_sts)}
+        for name in new:
+            self._ready(name)
 
     @classmethod
-    def new(cls, apps_sts):
+    def new(cls, apps_sts, journal=None):
         """ Create a new TaskRouter object from app configs """
 
         new, last = {}, {}
 
         for s in apps_sts.values():
-            new[s.name] = compat.Queue()
+            new[s.name] = collections.deque()
             # Add default blank tasks
             last[s.name] = Task(s.name, 'nothing', TaskStatus.success)
 
-        return cls(apps_sts, new, last)
+        return cls(apps_sts, new, last, journal)
+
+    def log(self, event, task):
+        """ Append a task event to the journal, if any """
+        if self.journal is not None:
+            return self.journal.append(task.to_record(event))
+
+    def restore(self, queued, last=()):
+        """ Put back queued tasks and last tasks (e.g. after a restart
+        or a reload) without journaling them again """
+        with self.cond:
+            for task in last:
+                if task.app_name in self.last:
+                    task.env = self.apps_sts[task.app_name]
+                    self.last[task.app_name] = task
+            for task in queued:
+                if task.app_name in self.new:
+                    task.env = self.apps_sts[task.app_name]
+                    self._enqueue(task)
+            self._wake_all()
+
+    def update(self, apps_sts):
+        """ Switch to new app settings (on reload): the queues, running
+        and last tasks of the apps still configured are kept, those of
+        the removed apps are dropped """
+        with self.cond:
+            for name in set(self.apps_sts) - set(apps_sts):
+                for table in (self.new, self.last, self.running, self.passes):
+                    del table[name]
+                self.ready_keys.pop(name, None)
+            for name, s in apps_sts.items():
+                if name not in self.new:
+                    self.new[name] = collections.deque()
+                    self.last[name] = Task(name, 'nothing', TaskStatus.success)
+                    self.running[name] = []
+                    self.passes[name] = self.vtime
+                    self.order[name] = len(self.order)
+                for task in self.new[name]:
+                    task.env = s
+            self.apps_sts = apps_sts
+            self._wake_all()
+
+    def set_priorities(self, priorities):
+        """ Change the priorities of the commands (on reload) """
+        with self.cond:
+            self.priorities = priorities
+            self.ready_keys.clear()
+            for name in self.new:
+                self._ready(name)
+
+    def wake(self):
+        """ Wake up the workers waiting for tasks (e.g. retired ones) """
+        with self.cond:
+            self._wake_all()
+
+    def _wake_all(self):
+        """ Wake up all the waiting workers, when a change may let
+        tasks of any app run. Must be called with `cond` held """
+        for waiters in (self.app_waiters, self.pool_waiters):
+            for _, cond, _ in waiters.values():
+                cond.notify_all()
+
+    def _notify(self, app_name):
+        """ Wake up one worker of each group serving `app_name`, when
+        its next task may run. Must be called with `cond` held """
+        waiters = self.app_waiters.get(app_name)
+        if waiters is not None:
+            waiters[1].notify()
+        for names, cond, _ in self.pool_waiters.values():
+            if names is None or app_name in names:
+                cond.notify()
+
+    def _wait(self, waiters, key, names):
+        """ Wait in the group `key` of `waiters` (workers serving the
+        apps `names`) until notified. Must be called with `cond` held """
+        group = waiters.get(key)
+        if group is None:
+            group = waiters[key] = [
+                names, threading.Condition(self.cond), 0]
+        group[2] += 1
+        try:
+            group[1].wait(self.budget.wait_timeout)
+        finally:
+            group[2] -= 1
+            if not group[2]:
+                del waiters[key]
+
+    def priority(self, command):
+        """ Return the priority of `command` (lower is more urgent) """
+        return self.priorities.get(command, DEFAULT_PRIORITY)
+
+    def _enqueue(self, task):
+        """ Insert `task` in its app queue after the tasks with the same
+        or a more urgent priority. Must be called with `cond` held """
+        app_name = task.app_name
+        queue = self.new[app_name]
+        if not queue and not self.running[app_name]:
+            # An idle app doesn't keep credit for the time it was idle
+            self.passes[app_name] = max(self.passes[app_name], self.vtime)
+
+        priority = self.priority(task.command)
+        i = len(queue)
+        while i > 0 and self.priority(queue[i - 1].command) > priority:
+            i -= 1
+        queue.insert(i, task)
+        self._ready(app_name)
+        self._notify(app_name)
+
+    def _ready(self, app_name):
+        """ Update the entry of `app_name` in the ready heap, after its
+        queue or pass changed. Must be called with `cond` held """
+        queue = self.new.get(app_name)
+        if not queue:
+            self.ready_keys.pop(app_name, None)
+            return
+        entry = (self.priority(queue[0].command), self.passes[app_name],
+                 self.order[app_name], app_name)
+        if self.ready_keys.get(app_name) != entry:
+            self.ready_keys[app_name] = entry
+            heapq.heappush(self.ready, entry)
+            if len(self.ready) > 2 * len(self.ready_keys) + 64:
+                # Drop the outdated entries
+                self.ready = list(self.ready_keys.values())
+                heapq.heapify(self.ready)
 
     def approve_new(self, task):
-        """ Approve a new task"""
-        return self.last[task.app_name] != TaskStatus.pending
+        """ Approve a new task: no identical task is pending or queued
+        for the app and its queue is not full """
+        with self.cond:
+            return self.check_new(task) is None
+
+    def check_new(self, task, follow_up=False):
+        """ Return why `task` can't be queued (or None if it can). A
+        `follow_up` may be queued while an identical task is running.
+        Must be called with `cond` held """
+        app_name, command = task.app_name, task.command
+        if not follow_up and \
+                any(t.command == command for t in self.running[app_name]):
+            return 'There is a current pending task'
+        if any(t.command == command for t in self.new[app_name]):
+            return 'There is an identical queued task'
+        limit = self.apps_sts[app_name].max_queue
+        if limit and len(self.new[app_name]) >= limit:
+            return 'The task queue is full'
+        return None
+
+    def admit(self, task):
+        """ Put `task` on the new queue unless it's rejected (see
+        `check_new`). With coalescing enabled for the app, a task
+        identical to a queued one is merged into it. Return a tuple
+        (ok, task or reason); check and put happen under one lock """
+        return self.admit_all([task])[0]
+
+    def admit_all(self, tasks, follow_up=False):
+        """ Same as `admit` for many tasks at once, under one lock and
+        with one journal sync. Return the list of (ok, task or reason).
+
+        A `follow_up` task runs after an identical running one instead
+        of being rejected (e.g. to build the commit pushed during a
+        build); it is always merged into an identical queued task """
+        with self.cond:
+            results = [self._admit(task, follow_up) for task in tasks]
+        seqs = [seq for _, _, seq in results if seq is not None]
+        if seqs:
+            self.journal.sync(max(seqs))
+        return [(ok, res) for ok, res, _ in results]
+
+    def _admit(self, task, follow_up=False):
+        """ Return (ok, task or reason, journal seq). Must be called
+        with `cond` held """
+        if follow_up or self.apps_sts[task.app_name].coalesce:
+            for queued in self.new[task.app_name]:
+                if queued.command == task.command:
+                    metrics.tasks_coalesced.inc((task.app_name, task.command))
+                    return True, queued, None
+        reason = self.check_new(task, follow_up)
+        if reason is not None:
+            metrics.tasks_rejected.inc((task.app_name, task.command))
+            return False, reason, None
+        metrics.tasks_queued.inc((task.app_name, task.command))
+        seq = self.log('new', task)
+        self._enqueue(task)
+        return True, task, seq
+
+    def can_run(self, task):
+        """ Check if `task` can start now, given the tasks already
+        running for the same app. Must be called with `cond` held """
+        app = self.apps_sts[task.app_name]
+        running = self.running[task.app_name]
+
+        if task.batch is not None and task.batch.full():
+            return False
+        if len(running) >= app.worker_concurrency:
+            return False
+        if running and not (app.is_parallel(task.command) and all(
+                app.is_parallel(t.command) for t in running)):
+            return False
+        reserved = self.budget.reserved
+        if reserved is not None and reserved is not task:
+            # Drop the reservation of a task no longer waiting first in
+            # its queue (cancelled, removed or passed by a more urgent one)
+            queue = self.new.get(reserved.app_name)
+            if not queue or queue[0] is not reserved:
+                self.budget.reserved = None
+        return self.budget.admits(task, app.cost_of(task.command))
+
+    def runnable(self, app_name):
+        """ Check if the next task of `app_name` can start now """
+        queue = self.new.get(app_name)
+        return bool(queue) and self.can_run(queue[0])
 
     def put_new(self, task):
-        """ Put a task on the new queue (to be executed later) """
-        self.new[task.app_name].put(task)
+        """ Put a task on the new queue (to be executed later). With
+        a journal, return once the task is safely on disk """
+        with self.cond:
+            metrics.tasks_queued.inc((task.app_name, task.command))
+            seq = self.log('new', task)
+            self._enqueue(task)
+        if seq is not None:
+            self.journal.sync(seq)
 
-    def take_new(self, app_name):
-        """ Take a new task for `app_name` and put it on the last
-        executed (its status should be pending) """
-        task = self.new[app_name].get()
+    def _take(self, app_name):
+        """ Move the next task of `app_name` from its queue to running """
+        task = self.new[app_name].popleft()
+        task.taken = time.time()
+        task.control = process.TaskControl()
+        if task.batch is not None:
+            task.batch.running += 1
+        cost = self.apps_sts[app_name].cost_of(task.command)
+        if any(cost):
+            task.cost = cost
+            reserved = self.budget.reserved is task
+            self.budget.acquire(cost, task)
+            if reserved:
+                # The tasks kept waiting for it may fit next to it
+                self._wake_all()
+        if self.logs is not None:
+            task.output = self.logs.new(task)
+        self.running[app_name].append(task)
         self.last[app_name] = task
+        self.log('take', task)
+
+        key = (app_name, task.command)
+        if key not in self.waits:
+            self.waits[key] = WaitStats()
+        self.waits[key].add(task.taken - task.start)
+        metrics.task_wait.observe(key, task.taken - task.start)
+
+        # Fair share: the more weight, the less the pass grows
+        self.vtime = self.passes[app_name]
+        self.passes[app_name] += 1.0 / self.apps_sts[app_name].weight
+        self._ready(app_name)
         return task
 
+    def take_new(self, app_name, retired=None):
+        """ Take a new task for `app_name` and put it on the last
+        executed (its status should be pending). Return None once
+        the router is closed, the app removed or the `retired` event
+        of the worker is set """
+        with self.cond:
+            while True:
+                if self.closed or app_name not in self.new or \
+                        (retired is not None and retired.is_set()):
+                    return None
+                if self.runnable(app_name):
+                    return self._take(app_name)
+                self._wait(self.app_waiters, app_name, (app_name,))
+
+    def take_next(self, names=None, retired=None):
+        """ Take a new task from any app (or any of `names`) which can
+        run one (used by the shared worker pool and the asyncio engine).
+        The most urgent task goes first, then the app with the lowest
+        fair share pass. Return None once the router is closed or the
+        `retired` event of the worker is set """
+        with self.cond:
+            while not self.closed and \
+                    not (retired is not None and retired.is_set()):
+                best = self._best(names)
+                if best is not None:
+                    return self._take(best)
+                self._wait(self.pool_waiters, id(names), names)
+            return None
+
+    def _best(self, names=None):
+        """ Return the first app of the ready heap (among `names`) which
+        can run its next task, or None. Must be called with `cond` held """
+        best, passed = None, []
+        while self.ready:
+            entry = heapq.heappop(self.ready)
+            name = entry[-1]
+            if self.ready_keys.get(name) != entry:
+                continue  # outdated
+            passed.append(entry)
+            if (names is None or name in names) and self.runnable(name):
+                best = name
+                break
+        for entry in passed:
+            heapq.heappush(self.ready, entry)
+        return best
+
+    def cancel(self, app_name):
+        """ Cancel the queued and running tasks of `app_name`: queued
+        tasks are finished right away, the commands of running tasks
+        are killed. Return the number of queued and running tasks """
+        with self.cond:
+            queued = list(self.new[app_name])
+            self.new[app_name].clear()
+            self._ready(app_name)
+            running = list(self.running[app_name])
+            for task in queued:
+                self.put_finished(task.interrupted('cancelled'))
+            # A reservation of the budget for the app may be dropped
+            self._wake_all()
+        for task in running:
+            task.control.interrupt('cancelled')
+        return len(queued), len(running)
+
+    def queue_waits(self, app_name=None):
+        """ Return the queue wait time statistics per app and command """
+        with self.cond:
+            waits = {}
+            for (name, command), stats in self.waits.items():
+                if app_name is None or name == app_name:
+                    waits.setdefault(name, {})[command] = stats.summary()
+            return waits
+
+    def close(self):
+        """ Stop handing out tasks, so the workers of this router exit.
+        Return the tasks which were still queued """
+        with self.cond:
+            self.closed = True
+            queued = []
+            for queue in self.new.values():
+                queued.extend(queue)
+                queue.clear()
+            self.ready, self.ready_keys = [], {}
+            self._wake_all()
+        return queued
+
     def put_finished(self, task):
         """ Put an already executed task (task was executed) """
         assert task.status != TaskStatus.pending
-        self.last[task.app_name] = task
+        with self.cond:
+            running = self.running.get(task.app_name, ())
+            if task in running:
+                running.remove(task)
+            if task.batch is not None and task.taken is not None:
+                task.batch.running -= 1
+            released = task.cost is not None
+            if released:
+                self.budget.release(task.cost)
+                task.cost = None
+            self.log('done', task)
+            metrics.tasks_finished.inc(
+                (task.app_name, task.command, task.status.name))
+            if task.taken is not None and task.finish is not None:
+                metrics.task_duration.observe(
+                    (task.app_name, task.command), task.finish - task.taken)
+            if task.output is not None:
+                task.output.close()
+            if self.history is not None:
+                self.history.add(task)
+            # A newer task might have been taken in the meantime (or the
+            # app was removed by a reload)
+            last = self.last.get(task.app_name)
+            if last is not None and task.start >= last.start:
+                self.last[task.app_name] = task
+            if released or task.batch is not None:
+                self._wake_all()  # tasks of other apps may fit now
+            else:
+                self._notify(task.app_name)
 
 
 def maybe_init(fun):
@@ -141,63 +831,464 @@ def maybe_init(fun):
     We add the core command (build, upgrade, downgrade, etc) to the
     oi.Program, however, we don't have access to the program configuration
     until the program is actually started, therefore we need to
-    delay the initialization until we have the config """
+    delay the initialization until we have the config (the daemon's
+    control worker initializes it as soon as it starts) """
 
     @functools.wraps(fun)
     def wrapper(self, *args, **kwargs):
         if not self.initialized:
-            self.initialize()
+            self.ensure_initialized()
         return fun(self, *args, **kwargs)
     return wrapper
 
 
 class Core(object):
-    """ The `Core` object gets initialized when the very fist command
-    is launched. It will read the config file, load ci workers, create
-    task queue, etc. """
+    """ The `Core` object gets initialized when the daemon starts (or
+    by the very first command). It will read the config file, load ci
+    workers, create task queue, etc. """
 
     def __init__(self, program):
         self.program = program
         self.initialized = False
+        self.journal = None
+        self.task_history = None
+        self.task_logs = None
+        self.lock = threading.RLock()
+        self.app_workers = {}  # app name -> (settings, worker class, workers)
+        self.executors = {}  # app name -> ci worker used by the shared pool
+        self.async_executors = {}  # app name -> ci worker used by asyncio
+        self.engines = []  # shared pool workers and asyncio engine
+        self.metrics_server = None
+        self.webhook = None
+        self.repo_index = (None, {})  # apps settings, repo key -> apps
+        self.config_files = config.ConfigFiles()
+        self.config_errors = {}  # app name (or file) -> why it's disabled
+        self.program.state.setdefault('ci_ready', threading.Event())
+        metrics.registry.collectors['core'] = self.collect_metrics
 
     # == HELPERS =======================================================
 
+    def ensure_initialized(self):
+        """ Initialize the core, unless done already (by the daemon's
+        start or a command received meanwhile) """
+        with self.lock:
+            if not self.initialized:
+                self.initialize()
+
     def initialize(self):
-        """ Create the task router and load ci workers """
+        """ Create the task router and load ci workers. On reload the
+        task router is kept (with its queued and running tasks), and
+        only the workers of the apps whose settings or worker module
+        changed are replaced """
 
+        settings = self.load_settings(self.program.config)
         apps_sts = self.load_apps_sts(self.program.config)
-        self.program.state.apps_sts = apps_sts
-        self.program.state.task_router = TaskRouter.new(apps_sts)
-        self.program.state.ci_workers = self.load_ci_workers(apps_sts)
-        self.initialized = True
+        with self.lock:
+            if self.initialized:
+                router = self.task_router
+                if settings != self.program.state.settings:
+                    # The pool settings may have changed: start over
+                    for name in list(self.app_workers):
+                        self.unload_app_worker(name)
+                    self.retire(self.engines)
+                    self.engines = []
+                for name in set(self.app_workers) - set(apps_sts):
+                    self.unload_app_worker(name)
+                router.update(apps_sts)
+            else:
+                router = self.new_router(settings, apps_sts)
+            priorities = dict(DEFAULT_PRIORITIES)
+            priorities.update(self.load_priorities(settings))
+            router.set_priorities(priorities)
+            router.budget.configure(**self.load_budget(settings))
+            self.program.state.settings = settings
+            self.program.state.apps_sts = apps_sts
+
+            # Lazy apps get their worker with their first task
+            # A worker which can't be loaded is tried again on the next
+            # task of its app (like a lazy one), which fails until fixed
+            for s in apps_sts.values():
+                if not s.lazy or s.name in self.app_workers or \
+                        router.new[s.name]:
+                    try:
+                        self.load_app_worker(s)
+                    except Exception as e:
+                        logging.error(
+                            '* Cannot load the worker of %s: %s', s.name, e)
+                        self.config_errors[s.name] = str(e)
+            self.load_engines(settings)
+            self.program.state.ci_workers = self.ci_workers()
+            self.initialized = True
+            if self.metrics_server is None and \
+                    settings.get('metrics_address'):
+                host, port = settings['metrics_address'].rsplit(':', 1)
+                self.metrics_server = metrics.serve(host, int(port))
+            if self.webhook is None and settings.get('webhook_address'):
+                self.webhook = self.load_webhook(settings)
+
+        # Wake up the control worker so it starts the ci workers
+        self.program.state.ci_ready.set()
+
+    def new_router(self, settings, apps_sts):
+        """ Create the task router, with the tasks of the journal or of
+        the router of a previous core """
+        old_router = self.program.state.get('task_router')
+        router = TaskRouter.new(apps_sts)
+        if old_router is not None:
+            router.restore(old_router.close())
+        elif self.journal is None:
+            self.load_journal(settings, router)
+        router.journal = self.journal
+        if self.task_history is None:
+            self.task_history = self.load_history(settings)
+        router.history = self.task_history
+        if self.task_logs is None:
+            self.task_logs = tasklog.TaskLogs(
+                settings.get('log_path'),
+                keep=int(settings.get('log_keep', 100)),
+                max_memory=int(settings.get('log_memory_kb', 256)) * 1024)
+        router.logs = self.task_logs
+        self.program.state.task_router = router
+        return router
+
+    def load_webhook(self, settings):
+        """ Start receiving push webhooks on `webhook_address` """
+        receiver = webhook.WebhookReceiver(
+            self.webhook_targets, self.webhook_trigger,
+            delay=float(settings.get('webhook_debounce', 5)),
+            max_delay=float(settings.get('webhook_max_delay', 60)),
+            secret=settings.get('webhook_secret') or None)
+        host, port = settings['webhook_address'].rsplit(':', 1)
+        receiver.serve(host, int(port))
+        return receiver
+
+    def webhook_targets(self, repos, branch):
+        """ Return the (app name, command) of the apps whose `repo` has
+        one of the `repos` keys, for a push to `branch`. An app can only
+        follow one branch (`webhook_branch`) and run another command than
+        `build` (`webhook_command`, e.g. a pipeline) """
+        apps_sts, index = self.repo_index
+        if apps_sts is not self.program.state.apps_sts:
+            apps_sts, index = self.program.state.apps_sts, {}
+            for s in apps_sts.values():
+                repo = getattr(s, 'repo', None)
+                if repo:
+                    index.setdefault(webhook.repo_key(repo), []).append(s)
+            self.repo_index = (apps_sts, index)
+
+        targets = []
+        for key in repos:
+            for s in index.get(key, ()):
+                wanted = getattr(s, 'webhook_branch', None)
+                if not wanted or wanted == branch:
+                    targets.append(
+                        (s.name, getattr(s, 'webhook_command', 'build')))
+        return targets
+
+    def webhook_trigger(self, app_name, command, commit):
+        """ Queue the task of a (debounced) push. A push during a build
+        queues one more build, so the newest commit always gets built """
+        if app_name not in self.program.state.apps_sts:
+            return
+        ok, res = self.create_tasks([app_name], command, follow_up=True)[0]
+        logging.info(
+            '* Push of %s to %s: %s %s', commit, app_name, command, res)
+
+    def load_settings(self, config_parser):
+        """ Read the global daemon settings (the `settings` section) """
+        if not config_parser.has_section('settings'):
+            return {}
+        section = config_parser['settings']
+        settings = {k: v.strip('"').strip() for k, v in section.items()}
+        self.validate_settings(settings)
+        return settings
+
+    def load_priorities(self, settings):
+        """ Read `command_priorities` (e.g. `stop:0, build:5`) """
+        priorities = {}
+        for item in util.split_list(settings.get('command_priorities', '')):
+            command, _, priority = item.partition(':')
+            priorities[command.strip()] = int(priority)
+        return priorities
+
+    def load_budget(self, settings):
+        """ Read the cpu and memory budget of the tasks: `cpu_budget`
+        (default the number of cpus), `memory_budget_mb` (`auto` for
+        the cgroup or host memory) and whether to `resource_probe` the
+        host's load average and available memory """
+        cpu = settings.get('cpu_budget')
+        memory = settings.get('memory_budget_mb', '0')
+        if memory == 'auto':
+            memory = resources.memory_limit_mb() or 0
+        probe = settings.get('resource_probe', 'false').lower() == 'true'
+        return {
+            'cpu': multiprocessing.cpu_count() if cpu is None else float(cpu),
+            'memory': float(memory),
+            'probe': resources.host_probe if probe else None,
+        }
+
+    def validate_settings(self, settings):
+        """ Ensure the global settings have valid values """
+
+        try:
+            self.load_priorities(settings)
+        except ValueError:
+            raise error.AppSettingError(
+                'command_priorities must look like stop:0, build:5 '
+                'in {}'.format(settings))
+
+        if settings.get('worker_pool', 'app') not in ('app', 'shared'):
+            raise error.AppSettingError(
+                'worker_pool must be app or shared in {}'.format(settings))
+
+        try:
+            float(settings.get('journal_commit_interval', 0))
+            float(settings.get('history_max_age', 0))
+        except ValueError:
+            raise error.AppSettingError(
+                'journal_commit_interval and history_max_age must be '
+                'numbers in {}'.format(settings))
+
+        address = settings.get('metrics_address')
+        if address is not None:
+            host, _, port = address.rpartition(':')
+            if not host or not port.isdigit():
+                raise error.AppSettingError(
+                    'metrics_address must look like 127.0.0.1:9200 '
+                    'in {}'.format(settings))
+
+        address = settings.get('webhook_address')
+        if address is not None:
+            host, _, port = address.rpartition(':')
+            if not host or not port.isdigit():
+                raise error.AppSettingError(
+                    'webhook_address must look like 0.0.0.0:9300 '
+                    'in {}'.format(settings))
+
+        try:
+            float(settings.get('webhook_debounce', 0))
+            float(settings.get('webhook_max_delay', 0))
+        except ValueError:
+            raise error.AppSettingError(
+                'webhook_debounce and webhook_max_delay must be numbers '
+                'of seconds in {}'.format(settings))
+
+        try:
+            budget = self.load_budget(settings)
+        except ValueError:
+            budget = {'cpu': -1, 'memory': -1}
+        if min(budget['cpu'], budget['memory']) < 0 or \
+                settings.get('resource_probe', 'false').lower() not in (
+                    'true', 'false'):
+            raise error.AppSettingError(
+                'cpu_budget and memory_budget_mb (or auto) must be '
+                'positive numbers and resource_probe true or false in '
+                '{}'.format(settings))
+
+        # A pool size of 0 means one worker per cpu
+        for key, minimum in [('worker_pool_size', 0), ('async_max_tasks', 1),
+                             ('batch_max_parallel', 0),
+                             ('history_memory_size', 1),
+                             ('history_max_rows', 1),
+                             ('log_keep', 1), ('log_memory_kb', 1),
+                             ('journal_compact_records', 1)]:
+            value = settings.get(key, str(minimum))
+            if not value.isdigit() or int(value) < minimum:
+                raise error.AppSettingError(
+                    '{} must be an integer >= {} in {}'.format(
+                        key, minimum, settings))
+
+    def load_journal(self, settings, router):
+        """ Replay the task journal (`journal_path` setting) into the
+        task router, then compact it and open it for appending (it
+        is compacted again by its writer as it grows).
+        Tasks which were running when the daemon stopped are marked as
+        failed, since there is no way to know how far they got """
+
+        path = settings.get('journal_path')
+        if not path:
+            return
+
+        begin = time.time()
+        interval = float(settings.get('journal_commit_interval', 0.005))
+        self.journal = journal.TaskJournal(
+            path, interval,
+            int(settings.get('journal_compact_records', 10000)))
+        queued, running, last = self.journal.replay()
+
+        queued = [Task.from_record(r) for r in queued]
+        last = [Task.from_record(r) for r in last.values()]
+        for record in running:
+            task = Task.from_record(record)
+            task.error = 'interrupted by a daemon restart'
+            last.append(task.failure())
+        last.sort(key=lambda t: t.start)
+        router.restore(queued, last)
+
+        records = [t.to_record('done') for t in last]
+        records += [t.to_record('new') for t in queued]
+        self.journal.compact(records)
+        self.journal.open()
+        logging.debug(
+            '* Replayed %s queued and %s last tasks in %.3fs',
+            len(queued), len(last), time.time() - begin)
+
+    def load_history(self, settings):
+        """ Create the task history, stored in `history_path` if set """
+        return history.TaskHistory(
+            settings.get('history_path'),
+            memory_size=int(settings.get('history_memory_size', 1000)),
+            max_rows=int(settings.get('history_max_rows', 1000000)),
+            max_age=float(settings.get('history_max_age', 30 * 24 * 3600)))
 
     def load_apps_sts(self, config_parser):
-        """ Read the configuration for each app """
+        """ Read the configuration for each app, from the main config
+        and the files it includes (`include` in the `settings` section:
+        paths or glob patterns, e.g. `/etc/ciex/apps.d/*.conf`).
+
+        A broken app section only disables that app, the reasons are
+        kept in `config_errors`. Included files are only parsed again
+        once they changed """
 
         logging.debug('* Reading config file')
-        apps_sts = {}
-        parser = config_parser
-        for section in parser.sections():
-            if section.startswith('settings.app'):
-                s = AppSetting.new(parser[section])
-                apps_sts[s.name] = s
-        logging.debug('* Configurations: {}'.format(apps_sts))
+        apps_sts, errors = self.read_apps(config.read_sections(config_parser))
+        patterns = ''
+        if config_parser.has_section('settings'):
+            patterns = config_parser['settings'].get('include', '')
+        paths = config.expand(util.split_list(patterns.strip('"')))
+        for path in paths:
+            try:
+                file_apps, file_errors = self.config_files.load(
+                    path, self.read_apps)
+            except (OSError, IOError, compat.configparser.Error) as e:
+                logging.error('* Cannot read config file %s: %s', path, e)
+                errors[path] = str(e)
+                continue
+            errors.update(file_errors)
+            for name, s in file_apps.items():
+                if name in apps_sts:
+                    errors[name] = 'also defined in {}, ignored there'.format(
+                        path)
+                    logging.error('* App %s defined again in %s', name, path)
+                    continue
+                apps_sts[name] = s
+        self.config_files.forget(paths)
+        self.config_errors = errors
+        logging.debug('* Configured %s apps', len(apps_sts))
         return apps_sts
 
-    def load_ci_workers(self, apps_sts):
-        """ Load python worker classes """
-        logging.debug('* Loading custom app workers ...')
+    def read_apps(self, sections):
+        """ Create the settings of the apps of config `sections`; return
+        them and the errors of the broken sections """
+        apps_sts, errors = {}, {}
+        for section in sections:
+            if not section.name.startswith('settings.app.'):
+                continue
+            try:
+                s = AppSetting.new(section)
+            except (error.AppSettingError, ValueError) as e:
+                name = section.name.replace('settings.app.', '')
+                logging.error('* App %s disabled: %s', name, e)
+                errors[name] = str(e)
+                continue
+            apps_sts[s.name] = s
+        return apps_sts, errors
+
+    def load_app_worker(self, s):
+        """ Load the ci worker of app `s`, unless it is loaded and
+        neither the app's settings nor its worker module changed.
+
+        By default every app gets its own pool of `worker_concurrency`
+        workers. With `worker_pool = shared` in the settings section,
+        a single pool of `worker_pool_size` workers (defaults to the
+        number of cpus) executes the tasks of all apps.
+
+        Apps using the asyncio engine are always executed by a single
+        `AsyncEngine` running up to `async_max_tasks` tasks at once """
+        worker_class = util.load_worker(
+            s.worker_dirpath,
+            s.worker_modname,
+            s.worker_classname
+        )
+        loaded = self.app_workers.get(s.name)
+        if loaded is not None:
+            if loaded[0] == s and loaded[1] is worker_class:
+                return
+            self.unload_app_worker(s.name)
+        logging.debug('* Loading worker of %s', s.name)
+
+        settings = self.program.state.get('settings', {})
+        engine = getattr(s, 'worker_engine', None) or worker_class.engine
         workers = []
+        if engine == 'asyncio' or settings.get('worker_pool') == 'shared':
+            executors = self.async_executors if engine == 'asyncio' \
+                else self.executors
+            with self.task_router.cond:
+                executors[s.name] = worker_class(
+                    self.program, s.name, self.task_router)
+                self.task_router.wake()
+        else:
+            for _ in range(s.worker_concurrency):
+                instance = worker_class(
+                    self.program, s.name, self.task_router)
+                workers.append(instance)
+        self.app_workers[s.name] = (s, worker_class, workers)
 
-        for s in apps_sts.values():
-            worker_class = util.load_worker(
-                s.worker_dirpath,
-                s.worker_modname,
-                s.worker_classname
-            )
-            instance = worker_class(self.program, s.name, self.task_router)
-            workers.append(instance)
-        return workers
+    def unload_app_worker(self, app_name):
+        """ Retire the ci workers of an app: they exit after their
+        current task """
+        _, _, workers = self.app_workers.pop(app_name)
+        with self.task_router.cond:
+            self.executors.pop(app_name, None)
+            self.async_executors.pop(app_name, None)
+        self.retire(workers)
+
+    def load_engines(self, settings):
+        """ Create the shared worker pool and the asyncio engine, if
+        needed and not created yet """
+        kinds = {type(w) for w in self.engines}
+        if settings.get('worker_pool', 'app') == 'shared' and \
+                worker.CIPoolWorker not in kinds:
+            size = int(settings.get('worker_pool_size', 0)) or \
+                multiprocessing.cpu_count()
+            self.engines.extend(
+                worker.CIPoolWorker(
+                    self.program, self.task_router, self.executors)
+                for _ in range(size))
+        if self.async_executors and not any(
+                w.__class__.__name__ == 'AsyncEngine' for w in self.engines):
+            from . import aioworker
+            max_tasks = int(settings.get('async_max_tasks', 256))
+            self.engines.append(aioworker.AsyncEngine(
+                self.program, self.task_router, self.async_executors,
+                max_tasks))
+
+    def retire(self, workers):
+        """ Let `workers` exit once done with their current task """
+        for w in workers:
+            w.retired.set()
+        self.task_router.wake()
+
+    def ci_workers(self):
+        """ All the current ci workers """
+        workers = [w for _, _, ws in self.app_workers.values() for w in ws]
+        return workers + self.engines
+
+    def collect_metrics(self):
+        """ Refresh the gauges of the metrics """
+        router = self.program.state.get('task_router')
+        if router is None:
+            return
+        with router.cond:
+            depth = {(name,): len(q) for name, q in router.new.items()}
+            running = {(name,): len(r) for name, r in router.running.items()}
+            metrics.resources_used.reset({
+                ('cpu',): router.budget.cpu_used,
+                ('memory_mb',): router.budget.memory_used})
+        metrics.queue_depth.reset(depth)
+        metrics.tasks_running.reset(running)
+        metrics.workers.set((), sum(
+            getattr(w, 'max_tasks', 1) for w in self.ci_workers()))
 
     @property
     def task_router(self):
@@ -205,15 +1296,83 @@ class Core(object):
 
     def create_task(self, app_name, command):
         """ Create work for app's worker """
-        task = Task(app_name, command)
-        task.env = self.program.state.apps_sts[app_name]
+        return self.create_tasks([app_name], command)[0]
+
+    def create_tasks(self, app_names, command, batch=None, follow_up=False):
+        """ Create work for the workers of many apps. Tasks are checked
+        and queued under one lock (as `follow_up`s of the running ones,
+        see `TaskRouter.admit_all`); return the (ok, task or reason) of
+        each app """
+        tasks, results = [], []
+        for app_name in app_names:
+            env = self.program.state.apps_sts[app_name]
+            task = Task(env.name, command, env=env)
+            task.batch = batch
+            try:
+                if app_name not in self.app_workers:
+                    self.load_lazy_worker(env)
+            except Exception as e:
+                results.append(
+                    (False, 'Cannot load the worker: {}'.format(e)))
+                continue
+            tasks.append(task)
+            results.append(None)
+
+        # Unless an identical task exists, add tasks to new queue
+        admitted = iter(self.task_router.admit_all(tasks, follow_up))
+        return [r or next(admitted) for r in results]
+
+    def submit(self, command, args):
+        """ Create `command` tasks for the apps in `args`: app names,
+        glob patterns (e.g. `web-*`) or `all`. With `max_parallel=<n>`
+        at most n tasks of the batch run at once (default to the
+        `batch_max_parallel` setting, 0 means no limit).
+
+        A single app name gets a single (ok, message) response, other
+        requests a dict of app name -> (ok, message) """
+        options = util.parse_options(a for a in args if '=' in a)
+        targets = [a for a in args if '=' not in a]
+        if len(targets) == 1 and not options and \
+                targets[0] in self.program.state.apps_sts:
+            ok, res = self.create_task(targets[0], command)
+            return ok, str(res)
+
+        settings = self.program.state.settings
+        limit = options.pop('max_parallel', None) or \
+            settings.get('batch_max_parallel', '0')
+        if options or not limit.isdigit():
+            return 'Err: unknown options or invalid max_parallel'
+
+        results, app_names = {}, []
+        for target in targets:
+            matches = self.match_apps(target)
+            if not matches:
+                results[target] = (False, 'No such app')
+            app_names.extend(m for m in matches if m not in app_names)
+        if not app_names:
+            return results
+        batch = Batch(int(limit)) if len(app_names) > 1 else None
+        created = self.create_tasks(app_names, command, batch)
+        for app_name, (ok, res) in zip(app_names, created):
+            results[app_name] = (ok, str(res))
+        return results
 
-        # Unless a pending task exists, add task to new queue
-        ok = self.task_router.approve_new(task)
-        if ok:
-            self.task_router.put_new(task)
-            return True, task
-        return False, 'There is a current pending task'
+    def match_apps(self, pattern):
+        """ Return the names of the apps matching `pattern` """
+        names = sorted(self.program.state.apps_sts)
+        if pattern == 'all':
+            return names
+        return fnmatch.filter(names, pattern)
+
+    def load_lazy_worker(self, s):
+        """ Load the worker of a lazy app (on its first task) """
+        with self.lock:
+            if s.name in self.app_workers:
+                return
+            self.load_app_worker(s)
+            self.load_engines(self.program.state.settings)
+            self.program.state.ci_workers = self.ci_workers()
+        self.program.state.ci_ready.set()
 
     # == SUPPORTED COMMANDS ============================================
 
@@ -223,51 +1382,159 @@ class Core(object):
             self.initialize()
         except Exception as e:
             return 'Err: {}'.format(e)
+        if self.config_errors:
+            return 'ok, disabled: {}'.format('; '.join(
+                '{} ({})'.format(name, reason)
+                for name, reason in sorted(self.config_errors.items())))
         return 'ok'
 
     @maybe_init
-    def start(self, app_name):
-        """ start app """
+    def start(self, *args):
+        """ start apps (see `submit`) """
         # NOTE: worker's `start` method is for threading
         # therefore we will trigger the command `start_`
-        ok, res = self.create_task(app_name, 'start_')
-        return ok, str(res)
+        return self.submit('start_', args)
 
     @maybe_init
-    def stop(self, app_name):
-        """ stop app """
-        ok, res = self.create_task(app_name, 'stop')
-        return ok, str(res)
+    def stop(self, *args):
+        """ stop apps (see `submit`) """
+        return self.submit('stop', args)
 
     @maybe_init
-    def deploy(self, app_name):
-        """ clone remote repo """
-        ok, res = self.create_task(app_name, 'deploy')
-        return ok, str(res)
+    def deploy(self, *args):
+        """ clone remote repos (see `submit`) """
+        return self.submit('deploy', args)
 
     @maybe_init
-    def build(self, app_name):
-        """ build app """
-        ok, res = self.create_task(app_name, 'build')
-        return ok, str(res)
+    def build(self, *args):
+        """ build apps (see `submit`) """
+        return self.submit('build', args)
 
     @maybe_init
-    def upgrade(self, app_name):
-        """ upgrade app """
-        ok, res = self.create_task(app_name, 'upgrade')
-        return ok, str(res)
+    def upgrade(self, *args):
+        """ upgrade apps (see `submit`) """
+        return self.submit('upgrade', args)
 
     @maybe_init
-    def downgrade(self, app_name):
-        """ downgrade the app """
-        ok, res = self.create_task(app_name, 'downgrade')
+    def downgrade(self, *args):
+        """ downgrade the apps (see `submit`) """
+        return self.submit('downgrade', args)
+
+    @maybe_init
+    def cancel(self, app_name):
+        """ cancel the queued and running tasks of the app """
+        if app_name not in self.program.state.apps_sts:
+            return False, 'No such app'
+        queued, running = self.task_router.cancel(app_name)
+        return True, 'Cancelled {} queued and {} running tasks'.format(
+            queued, running)
+
+    @maybe_init
+    def pipeline(self, app_name, name):
+        """ run a pipeline of the app's worker """
+        env = self.program.state.apps_sts.get(app_name)
+        if env is None:
+            return False, 'No such app'
+        try:
+            self.load_lazy_worker(env)
+        except Exception as e:
+            return False, 'Cannot load the worker: {}'.format(e)
+        _, worker_class, _ = self.app_workers[app_name]
+        if name not in worker_class.pipelines:
+            return 'Err: {} has no pipeline {}'.format(app_name, name)
+        ok, res = self.create_task(app_name, name)
         return ok, str(res)
 
+    @maybe_init
+    def releases(self, app_name):
+        """ show the stored releases of the app and the active one """
+        setting = self.program.state.apps_sts.get(app_name)
+        if setting is None:
+            return False, 'No such app'
+        store = artifacts.app_store(setting)
+        if store is None:
+            return False, 'No install_path for {}'.format(app_name)
+        return True, store.info()
+
     @maybe_init
     def last(self, app_name):
         """ show last task for `app_name` """
         return str(self.program.state.task_router.last[app_name])
 
+    @maybe_init
+    def steps(self, app_name):
+        """ Show the step timings of the last task of `app_name` """
+        return self.program.state.task_router.last[app_name].steps
+
+    @maybe_init
+    def log(self, app_name, offset=0):
+        """ Read the output of the last task of `app_name` from `offset`.
+        Return a dict with the data, the next offset and whether the
+        task is done (no more output will come) """
+        task = self.program.state.task_router.last.get(app_name)
+        if task is None:
+            return 'Err: no such app {}'.format(app_name)
+        try:
+            offset = parse_count('offset', offset)
+        except ValueError as e:
+            return 'Err: {}'.format(e)
+        data, done = b'', True
+        if task.output is not None:
+            data, offset, done = task.output.read(offset)
+        return {
+            'task': str(task), 'data': data.decode('utf-8', 'replace'),
+            'offset': offset, 'done': done,
+        }
+
+    @maybe_init
+    def history(self, *args):
+        """ Show finished tasks, most recent first. Options (key=value):
+        app, command, status, since (seconds ago), limit, page """
+        try:
+            options = self.history_options(args, paging=True)
+            limit = parse_count('limit', options.pop('limit', 20), 1)
+            page = parse_count('page', options.pop('page', 1), 1)
+        except ValueError as e:
+            return 'Err: {}'.format(e)
+        return self.program.state.task_router.history.query(
+            limit=limit, offset=(page - 1) * limit, **options)
+
+    @maybe_init
+    def stats(self, *args):
+        """ Show task counts and p50/p95 durations per app. Options
+        (key=value): app, command, status, since (seconds ago) """
+        try:
+            options = self.history_options(args)
+        except ValueError as e:
+            return 'Err: {}'.format(e)
+        return self.program.state.task_router.history.stats(**options)
+
+    def history_options(self, args, paging=False):
+        """ Turn the history/stats command arguments into query filters
+        (plus `limit` and `page` when `paging`) """
+        options = util.parse_options(args)
+        known = {'app', 'command', 'status', 'since'}
+        if paging:
+            known |= {'limit', 'page'}
+        unknown = set(options) - known
+        if unknown:
+            raise ValueError('unknown options {}'.format(sorted(unknown)))
+        if 'app' in options:
+            options['app_name'] = options.pop('app')
+        if 'since' in options:
+            options['since'] = time.time() - float(options['since'])
+        return options
+
+    @maybe_init
+    def waits(self, app_name=None):
+        """ Show queue wait times per app and command """
+        return self.program.state.task_router.queue_waits(app_name)
+
+    @maybe_init
+    def metrics(self):
+        """ Show the daemon metrics (Prometheus text format) """
+        return metrics.registry.render()
+
     @maybe_init
     def list(self):
         """ List all registered apps """
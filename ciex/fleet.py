@@ -0,0 +1,145 @@
+# Send commands to a fleet of ciex daemons
+
+import os
+import time
+import threading
+
+from . import compat
+
+
+def read_addresses(value):
+    """ Read daemon addresses from a comma separated list, or from
+    a file with one address per line """
+    if '://' not in value and os.path.exists(value):
+        with open(value) as fh:
+            value = ','.join(
+                line.strip() for line in fh
+                if line.strip() and not line.startswith('#'))
+    return [a.strip() for a in value.split(',') if a.strip()]
+
+
+def new_client(address, timeout=3000):
+    """ Create a nanoservice client for a daemon """
+    from nanoservice import Client
+    client = Client(address)
+    client.socket._set_recv_timeout(timeout)
+    return client
+
+
+def succeeded(res, err):
+    """ Check a daemon's response. Task commands respond with a
+    tuple (ok, message), or a dict of them for many apps """
+    if err:
+        return False
+    if isinstance(res, dict):
+        return all(succeeded(r, None) for r in res.values())
+    if isinstance(res, (list, tuple)) and res and res[0] is False:
+        return False
+    return True
+
+
+class Fleet(object):
+    """ Call the same command on many daemons, at most `concurrency`
+    at once, in one of these modes:
+
+    - `all`: every daemon at once
+    - `rolling`: batches of `batch_size` daemons, stopping when a batch
+      has more than `max_failures` failures
+    - `canary`: the first `canary` daemons, then, if they all succeeded,
+      the others in rolling batches """
+
+    def __init__(self, addresses, concurrency=64, client_factory=new_client):
+        super(Fleet, self).__init__()
+        self.addresses = addresses
+        self.concurrency = concurrency
+        self.client_factory = client_factory
+        self.clients = {}  # address -> client (one caller at a time)
+
+    def client(self, address):
+        if address not in self.clients:
+            self.clients[address] = self.client_factory(address)
+        return self.clients[address]
+
+    def call_one(self, address, command, args):
+        """ Call a single daemon and time it """
+        begin = time.time()
+        try:
+            res, err = self.client(address).call(command, *args)
+        except Exception as e:
+            res, err = None, str(e)
+        return {
+            'ok': succeeded(res, err), 'res': res, 'err': err,
+            'elapsed': time.time() - begin,
+        }
+
+    def call(self, addresses, command, *args):
+        """ Call the daemons concurrently, return their results """
+        results = {}
+        queue = compat.Queue()
+        for address in addresses:
+            queue.put(address)
+
+        def work():
+            while True:
+                try:
+                    address = queue.get_nowait()
+                except compat.Empty:
+                    return
+                results[address] = self.call_one(address, command, args)
+
+        threads = [
+            threading.Thread(target=work)
+            for _ in range(min(self.concurrency, len(addresses)))
+        ]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        return results
+
+    def run(self, command, *args, **options):
+        """ Run `command` on the fleet (see the class doc for the
+        options: mode, batch_size, max_failures, canary). Return a
+        report with each daemon's result and the timings """
+        mode = options.get('mode', 'all')
+        batch_size = int(options.get('batch_size', 10))
+        max_failures = int(options.get('max_failures', 0))
+        canary = int(options.get('canary', 1))
+
+        addresses = list(self.addresses)
+        if mode == 'all':
+            batches = [addresses]
+        elif mode == 'rolling':
+            batches = self.split(addresses, batch_size)
+        elif mode == 'canary':
+            batches = [addresses[:canary]]
+            batches += self.split(addresses[canary:], batch_size)
+        else:
+            raise ValueError('unknown mode {}'.format(mode))
+
+        begin = time.time()
+        report = {
+            'results': {}, 'batches': [], 'aborted': False,
+        }
+        for i, batch in enumerate(b for b in batches if b):
+            batch_begin = time.time()
+            results = self.call(batch, command, *args)
+            report['results'].update(results)
+            failures = sum(1 for r in results.values() if not r['ok'])
+            report['batches'].append({
+                'size': len(batch), 'failures': failures,
+                'elapsed': time.time() - batch_begin,
+            })
+            allowed = 0 if mode == 'canary' and i == 0 else max_failures
+            if mode != 'all' and failures > allowed:
+                report['aborted'] = True
+                break
+
+        results = report['results'].values()
+        report['ok'] = sum(1 for r in results if r['ok'])
+        report['failed'] = len(report['results']) - report['ok']
+        report['skipped'] = len(addresses) - len(report['results'])
+        report['elapsed'] = time.time() - begin
+        return report
+
+    def split(self, addresses, size):
+        return [
+            addresses[i:i + size] for i in range(0, len(addresses), size)]
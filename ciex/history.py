@@ -0,0 +1,208 @@
+# Task history
+
+import time
+import sqlite3
+import threading
+import collections
+
+from . import util
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id TEXT PRIMARY KEY, app_name TEXT, command TEXT, status TEXT,
+    error TEXT, start REAL, taken REAL, finish REAL, duration REAL
+);
+CREATE INDEX IF NOT EXISTS tasks_app_start ON tasks (app_name, start);
+CREATE INDEX IF NOT EXISTS tasks_app_command_start
+    ON tasks (app_name, command, start);
+CREATE INDEX IF NOT EXISTS tasks_status_finish ON tasks (status, finish);
+CREATE INDEX IF NOT EXISTS tasks_finish ON tasks (finish);
+CREATE INDEX IF NOT EXISTS tasks_app_duration ON tasks (app_name, duration);
+"""
+
+FIELDS = (
+    'id', 'app_name', 'command', 'status', 'error',
+    'start', 'taken', 'finish', 'duration'
+)
+
+
+def to_row(task):
+    """ Return the history row of a finished task. Its duration is the
+    time from start to finish (like the `task_duration` metric), without
+    the queue wait; 0 for a task which never started """
+    taken = task.finish if task.taken is None else task.taken
+    return (
+        task.id, task.app_name, task.command, task.status.name, task.error,
+        task.start, task.taken, task.finish, task.finish - taken
+    )
+
+
+class TaskHistory(object):
+    """ Finished tasks, queryable by app, command, status and time.
+
+    The most recent `memory_size` tasks are kept in a ring buffer. With
+    a `path`, all tasks are also stored in an indexed sqlite database,
+    written in batches and compacted every `compact_every` inserts,
+    dropping tasks older than `max_age` seconds or beyond `max_rows` """
+
+    def __init__(self, path=None, memory_size=1000, max_rows=1000000,
+                 max_age=30 * 24 * 3600, batch_size=100,
+                 compact_every=10000):
+        super(TaskHistory, self).__init__()
+        self.recent = collections.deque(maxlen=memory_size)
+        self.lock = threading.Lock()
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self.batch_size = batch_size
+        self.compact_every = compact_every
+        self.pending = []  # rows waiting to be written
+        self.inserted = 0  # rows written since the last compaction
+        self.db = None
+
+        if path:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            self.db.execute('PRAGMA journal_mode = WAL')
+            self.db.executescript(SCHEMA)
+
+    def add(self, task):
+        """ Record a finished task """
+        row = to_row(task)
+        with self.lock:
+            self.recent.append(row)
+            if self.db is None:
+                return
+            self.pending.append(row)
+            if len(self.pending) >= self.batch_size:
+                self._flush()
+
+    def _flush(self):
+        """ Write the pending rows. Must be called with `lock` held """
+        if not self.pending:
+            return
+        with self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO tasks VALUES (?,?,?,?,?,?,?,?,?)',
+                self.pending)
+        self.inserted += len(self.pending)
+        self.pending = []
+        if self.inserted >= self.compact_every:
+            self._compact()
+
+    def flush(self):
+        """ Write the pending rows to disk """
+        with self.lock:
+            if self.db is not None:
+                self._flush()
+
+    def _compact(self):
+        """ Apply the retention policy and give the space back """
+        with self.db:
+            self.db.execute(
+                'DELETE FROM tasks WHERE finish < ?',
+                (time.time() - self.max_age,))
+            self.db.execute(
+                'DELETE FROM tasks WHERE rowid IN (SELECT rowid FROM tasks '
+                'ORDER BY finish DESC LIMIT -1 OFFSET ?)', (self.max_rows,))
+        self.db.execute('PRAGMA incremental_vacuum')
+        self.inserted = 0
+
+    def compact(self):
+        """ Apply the retention policy on disk """
+        with self.lock:
+            if self.db is not None:
+                self._flush()
+                self._compact()
+
+    def close(self):
+        """ Flush and close the database """
+        with self.lock:
+            if self.db is not None:
+                self._flush()
+                self.db.close()
+                self.db = None
+
+    # == QUERIES =======================================================
+
+    def filters(self, app_name=None, command=None, status=None,
+                since=None, until=None):
+        """ Build the sql `where` clause and the matching python filter """
+        conds = [
+            ('app_name = ?', app_name, lambda r: r[1] == app_name),
+            ('command = ?', command, lambda r: r[2] == command),
+            ('status = ?', status, lambda r: r[3] == status),
+            ('finish >= ?', since, lambda r: r[7] >= since),
+            ('finish < ?', until, lambda r: r[7] < until),
+        ]
+        conds = [c for c in conds if c[1] is not None]
+        where = ' AND '.join(c[0] for c in conds) or '1'
+        params = [c[1] for c in conds]
+
+        def match(row):
+            return all(c[2](row) for c in conds)
+        return where, params, match
+
+    def query(self, limit=50, offset=0, **filters):
+        """ Return the matching tasks (as dicts), most recent first """
+        where, params, match = self.filters(**filters)
+        with self.lock:
+            if self.db is None:
+                rows = [r for r in reversed(self.recent) if match(r)]
+                rows = rows[offset:offset + limit]
+            else:
+                self._flush()
+                rows = self.db.execute(
+                    'SELECT * FROM tasks WHERE {} ORDER BY start DESC '
+                    'LIMIT ? OFFSET ?'.format(where),
+                    params + [limit, offset]).fetchall()
+        return [dict(zip(FIELDS, r)) for r in rows]
+
+    def stats(self, app_name=None, **filters):
+        """ Return counts, success rate and p50/p95 durations per app """
+        names = [app_name] if app_name else self.app_names()
+        return {name: self.app_stats(name, **filters) for name in names}
+
+    def app_names(self):
+        """ Return the names of the apps with history """
+        with self.lock:
+            if self.db is None:
+                return sorted(set(r[1] for r in self.recent))
+            self._flush()
+            rows = self.db.execute('SELECT DISTINCT app_name FROM tasks')
+            return sorted(r[0] for r in rows)
+
+    def app_stats(self, app_name, **filters):
+        """ Return the statistics for a single app """
+        where, params, match = self.filters(app_name=app_name, **filters)
+        with self.lock:
+            if self.db is None:
+                rows = [r for r in self.recent if match(r)]
+                statuses = collections.Counter(r[3] for r in rows)
+                durations = sorted(r[8] for r in rows)
+            else:
+                self._flush()
+                statuses = collections.Counter(dict(self.db.execute(
+                    'SELECT status, COUNT(*) FROM tasks WHERE {} '
+                    'GROUP BY status'.format(where), params)))
+                durations = None
+
+            count = sum(statuses.values())
+            stats = {
+                'count': count,
+                'success': statuses['success'],
+                'failure': count - statuses['success'],
+            }
+            for p in (50, 95):
+                if not count:
+                    stats['p{}'.format(p)] = None
+                elif durations is not None:
+                    stats['p{}'.format(p)] = util.percentile(durations, p)
+                else:
+                    # Walk the (app_name, duration) index to the percentile
+                    row = self.db.execute(
+                        'SELECT duration FROM tasks WHERE {} ORDER BY '
+                        'duration LIMIT 1 OFFSET ?'.format(where),
+                        params + [util.percentile_index(count, p)])
+                    stats['p{}'.format(p)] = row.fetchone()[0]
+        return stats
@@ -0,0 +1,203 @@
+# Persistent task journal
+
+import os
+import time
+import logging
+import threading
+import collections
+
+import msgpack
+
+
+# Records are stored as msgpack arrays of these fields, the event
+# being stored as its index in EVENTS
+FIELDS = (
+    'event', 'id', 'app_name', 'command', 'status', 'error', 'start',
+    'taken', 'finish', 'steps')
+EVENTS = ('new', 'take', 'done')
+
+
+def pack(record):
+    """ Encode a record (dict) in the compact binary format """
+    values = [record.get(f) for f in FIELDS]
+    values[0] = EVENTS.index(values[0])
+    return msgpack.packb(values, use_bin_type=True)
+
+
+def unpack(values):
+    """ Decode the array of a record """
+    record = dict(zip(FIELDS, values))
+    record['event'] = EVENTS[record['event']]
+    return record
+
+
+class TaskJournal(object):
+    """ An append-only log of the task router events (`new`, `take`
+    and `done` records). Records are written by a background thread
+    and fsync-ed in batches, so many writers share the cost of one
+    fsync (group commit).
+
+    Records are msgpack arrays (see `FIELDS`). The journal keeps the
+    latest record of the queued and running tasks and the last finished
+    record of each app (the live records); once the file holds more
+    than `compact_ratio` times as many records as there are live ones
+    (and at least `compact_records`), the writer replaces it with the
+    live records """
+
+    compact_ratio = 4
+
+    def __init__(self, path, commit_interval=0.005, compact_records=10000):
+        super(TaskJournal, self).__init__()
+        self.path = path
+        self.commit_interval = commit_interval  # time to gather a batch
+        self.compact_records = compact_records
+        self.live = collections.OrderedDict()  # task id -> packed record
+        self.last = {}  # app name -> packed record of its last done task
+        self.records = 0  # number of records in the file
+        self.fh = None
+        self.cond = threading.Condition()
+        self.buffer = []  # records waiting to be written
+        self.seq = 0  # number of records appended
+        self.synced = 0  # number of records written and fsync-ed
+        self.closed = False
+        self.writer = None
+
+    def open(self):
+        """ Open the journal for appending and start the writer """
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.fh = open(self.path, 'ab')
+        self.writer = threading.Thread(target=self.write_loop)
+        self.writer.daemon = True
+        self.writer.start()
+        return self
+
+    def track(self, record, packed):
+        """ Update the live records with `record`. Must be called with
+        `cond` held """
+        if record['event'] == 'done':
+            self.live.pop(record['id'], None)
+            self.last[record['app_name']] = packed
+        else:
+            self.live[record['id']] = packed
+
+    def append(self, record):
+        """ Queue a record for writing and return its sequence number """
+        packed = pack(record)
+        with self.cond:
+            self.track(record, packed)
+            self.buffer.append(packed)
+            self.seq += 1
+            self.cond.notify_all()
+            return self.seq
+
+    def sync(self, seq):
+        """ Wait until the record `seq` is safely on disk """
+        with self.cond:
+            while self.synced < seq and not self.closed:
+                self.cond.wait()
+
+    def write_loop(self):
+        """ Write the buffered records in batches, one fsync per batch """
+        while True:
+            with self.cond:
+                while not self.buffer and not self.closed:
+                    self.cond.wait()
+                if self.closed and not self.buffer:
+                    return
+
+            # Let concurrent writers join this batch
+            time.sleep(self.commit_interval)
+            with self.cond:
+                batch, self.buffer = self.buffer, []
+                seq = self.seq
+                live = None
+                records = self.records + len(batch)
+                if records >= self.compact_records and records > \
+                        self.compact_ratio * (len(self.live) + len(self.last)):
+                    # The live records include the batch's
+                    live = list(self.last.values()) + list(self.live.values())
+
+            if live is None:
+                self.fh.write(b''.join(batch))
+                self.fh.flush()
+                os.fsync(self.fh.fileno())
+                self.records = records
+            else:
+                self.fh.close()
+                self.rewrite(live)
+                self.fh = open(self.path, 'ab')
+                logging.debug(
+                    '* Compacted the journal from %s to %s records',
+                    records, len(live))
+
+            with self.cond:
+                self.synced = seq
+                self.cond.notify_all()
+
+    def close(self):
+        """ Write the remaining records and stop the writer """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        if self.writer is not None:
+            self.writer.join()
+        if self.fh is not None:
+            self.fh.close()
+
+    def replay(self):
+        """ Read the journal and return the state it describes:
+        the queued task records (in order), the in-flight ones and the
+        last finished record for each app. A truncated last line (from
+        a crash in the middle of a write) is ignored """
+
+        tasks = {}  # task id -> latest record, in order of creation
+        if not os.path.exists(self.path):
+            return [], [], {}
+
+        for record in self.read():
+            tasks[record['id']] = record
+
+        queued, running, last = [], [], {}
+        for record in tasks.values():
+            event = record['event']
+            if event == 'new':
+                queued.append(record)
+            elif event == 'take':
+                running.append(record)
+            else:
+                last[record['app_name']] = record
+        return queued, running, last
+
+    def read(self):
+        """ Yield the records of the journal file """
+        with open(self.path, 'rb') as fh:
+            unpacker = msgpack.Unpacker(fh, raw=False)
+            try:
+                for values in unpacker:
+                    yield unpack(values)
+            except Exception as e:
+                # Unreadable data: keep the records before it
+                logging.warning('* Skipping bad journal data: %s', e)
+
+    def compact(self, records):
+        """ Atomically replace the journal with `records` (before it is
+        opened), which become the live records """
+        with self.cond:
+            self.live.clear()
+            self.last.clear()
+            for record in records:
+                self.track(record, pack(record))
+            live = list(self.last.values()) + list(self.live.values())
+        self.rewrite(live)
+
+    def rewrite(self, packed):
+        """ Atomically replace the journal file with `packed` records """
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as fh:
+            fh.write(b''.join(packed))
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.rename(tmp, self.path)
+        self.records = len(packed)
@@ -0,0 +1,204 @@
+# Daemon metrics, in the Prometheus text format
+
+import bisect
+import logging
+import threading
+
+from . import compat
+
+
+# Upper bounds (seconds) of the histogram buckets
+DEFAULT_BUCKETS = (
+    0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+
+def format_labels(names, values, extra=''):
+    items = ['{}="{}"'.format(n, str(v).replace('"', '\\"'))
+             for n, v in zip(names, values)]
+    if extra:
+        items.append(extra)
+    return '{' + ','.join(items) + '}' if items else ''
+
+
+class Counter(object):
+    """ A value which only goes up, one per set of label values """
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        super(Counter, self).__init__()
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.values = {}  # label values -> value
+
+    def inc(self, labels=(), value=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + value
+
+    def get(self, labels=()):
+        return self.values.get(labels, 0)
+
+    def samples(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        for labels, value in items:
+            yield self.name + format_labels(self.labels, labels), value
+
+
+class Gauge(Counter):
+    """ A value which can go up and down """
+
+    kind = 'gauge'
+
+    def set(self, labels=(), value=0):
+        with self.lock:
+            self.values[labels] = value
+
+    def reset(self, values):
+        """ Replace all the values (e.g. when refreshed by a collector) """
+        with self.lock:
+            self.values = dict(values)
+
+
+class Histogram(object):
+    """ Counts of observed values per bucket, plus their sum """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__()
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counts = {}  # label values -> count per bucket (+Inf last)
+        self.sums = {}  # label values -> sum of the observed values
+
+    def observe(self, labels, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.counts.get(labels)
+            if counts is None:
+                counts = self.counts[labels] = [0] * (len(self.buckets) + 1)
+                self.sums[labels] = 0.0
+            counts[i] += 1
+            self.sums[labels] += value
+
+    def count(self, labels=()):
+        return sum(self.counts.get(labels, ()))
+
+    def samples(self):
+        with self.lock:
+            items = sorted((k, list(v)) for k, v in self.counts.items())
+            sums = dict(self.sums)
+        for labels, counts in items:
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                yield self.name + '_bucket' + format_labels(
+                    self.labels, labels, 'le="{}"'.format(bound)), total
+            yield self.name + '_sum' + format_labels(
+                self.labels, labels), sums[labels]
+            yield self.name + '_count' + format_labels(
+                self.labels, labels), total
+
+
+class Registry(object):
+    """ The metrics of the daemon. Collectors are called before the
+    metrics are rendered, to refresh the gauges """
+
+    def __init__(self):
+        super(Registry, self).__init__()
+        self.metrics = []
+        self.collectors = {}  # name -> function
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self.add(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        """ Return the metrics in the Prometheus text format """
+        for name, collector in list(self.collectors.items()):
+            try:
+                collector()
+            except Exception as e:
+                logging.error('* Metrics collector %s failed: %s', name, e)
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            for sample, value in metric.samples():
+                lines.append('{} {}'.format(sample, value))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+tasks_queued = registry.counter(
+    'ciex_tasks_queued_total', 'Tasks put on a queue', ('app', 'command'))
+tasks_rejected = registry.counter(
+    'ciex_tasks_rejected_total', 'Tasks refused by the queue',
+    ('app', 'command'))
+tasks_coalesced = registry.counter(
+    'ciex_tasks_coalesced_total', 'Tasks merged into a queued one',
+    ('app', 'command'))
+tasks_finished = registry.counter(
+    'ciex_tasks_finished_total', 'Finished tasks',
+    ('app', 'command', 'status'))
+task_wait = registry.histogram(
+    'ciex_task_wait_seconds', 'Time from enqueue to start',
+    ('app', 'command'))
+task_duration = registry.histogram(
+    'ciex_task_duration_seconds', 'Time from start to finish',
+    ('app', 'command'))
+operation_duration = registry.histogram(
+    'ciex_operation_duration_seconds',
+    'Duration of the ci operations (commands and pipeline steps)',
+    ('app', 'operation'))
+queue_depth = registry.gauge(
+    'ciex_queue_depth', 'Queued tasks', ('app',))
+tasks_running = registry.gauge(
+    'ciex_tasks_running', 'Running tasks', ('app',))
+resources_used = registry.gauge(
+    'ciex_resources_used', 'Cpu slots and memory held by running tasks',
+    ('resource',))
+workers = registry.gauge(
+    'ciex_workers', 'Ci workers (threads and asyncio engine slots)')
+
+
+class MetricsHandler(compat.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug('* Metrics request: ' + format, *args)
+
+
+def serve(host, port):
+    """ Serve the metrics over HTTP (in a daemon thread) """
+    server = compat.HTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
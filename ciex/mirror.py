@@ -0,0 +1,57 @@
+# Shared bare repository mirrors
+
+import os
+import hashlib
+
+from . import compat
+from . import context
+from .worker import Command
+
+
+def mirror_path(root, repo):
+    """ Path of the bare mirror of `repo` (shared by all the apps
+    pointing to the same repo url) """
+    name = hashlib.sha1(repo.encode()).hexdigest()[:16]
+    return os.path.join(root, name + '.git')
+
+
+def update_command(root, repo):
+    """ Create or incrementally fetch the mirror of `repo`. Updates of
+    the same mirror are serialized with `flock`, also across daemons """
+    path = mirror_path(root, repo)
+    script = (
+        'if [ -d {path} ]; then git --git-dir={path} fetch -q --prune; '
+        'else git clone -q --mirror {repo} {path}; fi'
+    ).format(path=compat.quote(path), repo=compat.quote(repo))
+    return Command('mkdir -p {root} && flock {lock} sh -c {script}'.format(
+        root=compat.quote(root), lock=compat.quote(path + '.lock'),
+        script=compat.quote(script)))
+
+
+def deploy_commands(task):
+    """ Commands which clone the app's repo into its src path. With a
+    `mirror_path` setting, the clone shares the objects of a local
+    mirror and uses it as origin, instead of cloning over the network """
+    root = getattr(task.env, 'mirror_path', None)
+    if not root:
+        return [Command(
+            'git clone {}'.format(compat.quote(task.env.repo)),
+            task.env.src_path)]
+
+    path = mirror_path(root, task.env.repo)
+    return [
+        update_command(root, task.env.repo),
+        Command('git clone -q --shared {} {}'.format(
+            compat.quote(path), compat.quote(task.app_name)),
+            task.env.src_path),
+    ]
+
+
+def pull_commands(task):
+    """ Commands which pull the latest changes in the app's repo,
+    fetching them into the mirror first if there is one """
+    commands = [Command('git pull -q', context.repo_path(task))]
+    root = getattr(task.env, 'mirror_path', None)
+    if root:
+        commands.insert(0, update_command(root, task.env.repo))
+    return commands
@@ -0,0 +1,113 @@
+# Pipelines: tasks made of a graph of steps
+
+import time
+import collections
+
+
+# A step of a pipeline: the ci operation it executes (defaults to
+# `name`) once the steps in `after` succeeded
+Step = collections.namedtuple('Step', 'name operation after')
+Step.__new__.__defaults__ = (None, ())
+
+
+class Pipeline(object):
+    """ A DAG of steps. Steps whose dependencies succeeded may run in
+    parallel, a failed step cancels the steps depending on it """
+
+    def __init__(self, steps):
+        super(Pipeline, self).__init__()
+        self.steps = collections.OrderedDict()
+        for step in steps:
+            if step.name in self.steps:
+                raise ValueError('duplicate step {}'.format(step.name))
+            self.steps[step.name] = step._replace(
+                operation=step.operation or step.name,
+                after=tuple(step.after))
+
+        self.dependents = {name: [] for name in self.steps}
+        for step in self.steps.values():
+            for name in step.after:
+                if name not in self.steps:
+                    raise ValueError(
+                        'step {} runs after unknown step {}'.format(
+                            step.name, name))
+                self.dependents[name].append(step.name)
+        self.check_cycles()
+
+    def check_cycles(self):
+        """ Raise ValueError unless the steps form a DAG """
+        waiting = {name: len(s.after) for name, s in self.steps.items()}
+        ready = [name for name, count in waiting.items() if not count]
+        visited = 0
+        while ready:
+            visited += 1
+            for name in self.dependents[ready.pop()]:
+                waiting[name] -= 1
+                if not waiting[name]:
+                    ready.append(name)
+        if visited != len(self.steps):
+            raise ValueError('the steps have a cycle')
+
+    def new_run(self, task):
+        """ Start a run of the pipeline for `task` """
+        return PipelineRun(self, task)
+
+
+class PipelineRun(object):
+    """ The progress of a pipeline for a task. Its step timings are
+    stored as `task.steps` """
+
+    def __init__(self, pipeline, task):
+        super(PipelineRun, self).__init__()
+        self.pipeline = pipeline
+        self.waiting = {
+            name: set(step.after) for name, step in pipeline.steps.items()}
+        self.running = set()
+        self.failed = []
+        self.timings = collections.OrderedDict(
+            (name, {'name': name, 'status': 'waiting', 'start': None,
+                    'finish': None, 'error': None})
+            for name in pipeline.steps)
+        task.steps = list(self.timings.values())
+
+    def ready(self):
+        """ Return the steps which can start now """
+        return [self.pipeline.steps[name]
+                for name, after in self.waiting.items() if not after]
+
+    def begin(self, name):
+        """ Mark step `name` as running """
+        del self.waiting[name]
+        self.running.add(name)
+        self.timings[name].update(status='running', start=time.time())
+
+    def end(self, name, error=None):
+        """ Mark step `name` as finished, and failed if there is an
+        `error`. A failure cancels the steps depending on it """
+        self.running.discard(name)
+        self.timings[name].update(
+            status='failure' if error else 'success',
+            finish=time.time(), error=error)
+        if error:
+            self.failed.append(name)
+            self.cancel(name)
+            return
+        for dependent in self.pipeline.dependents[name]:
+            self.waiting[dependent].discard(name)
+
+    def cancel(self, name):
+        for dependent in self.pipeline.dependents[name]:
+            if self.waiting.pop(dependent, None) is not None:
+                self.timings[dependent]['status'] = 'cancelled'
+                self.cancel(dependent)
+
+    def done(self):
+        return not self.running and not self.ready()
+
+    def finish(self, task):
+        """ Mark the task as succeeded unless a step failed """
+        if self.failed:
+            task.error = 'step {} failed: {}'.format(
+                self.failed[0], self.timings[self.failed[0]]['error'])
+            return task.failure()
+        return task.success()
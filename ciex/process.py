@@ -0,0 +1,66 @@
+# Interrupting the commands of a task (timeouts, cancellation)
+
+import os
+import sys
+import signal
+import threading
+
+
+# Popen arguments running a command in its own process group, so it
+# can be killed with all its children
+if sys.version_info[0] >= 3:
+    NEW_SESSION = {'start_new_session': True}
+else:
+    NEW_SESSION = {'preexec_fn': os.setsid}
+
+
+def kill_group(pid):
+    """ Kill the process group led by `pid` """
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except OSError:
+        pass  # already gone
+
+
+class TaskControl(object):
+    """ The running commands of a task (process group ids), and why
+    the task was interrupted (`timeout` or `cancelled`), if it was.
+    Shared by the steps of a pipeline """
+
+    __slots__ = ('lock', 'pids', 'reason')
+
+    def __init__(self):
+        super(TaskControl, self).__init__()
+        self.lock = threading.Lock()
+        self.pids = set()
+        self.reason = None
+
+    def add(self, pid):
+        """ Track a command. It is killed right away if the task was
+        already interrupted """
+        with self.lock:
+            if self.reason is None:
+                self.pids.add(pid)
+                return
+        kill_group(pid)
+
+    def remove(self, pid):
+        with self.lock:
+            self.pids.discard(pid)
+
+    def interrupt(self, reason):
+        """ Kill the running commands and prevent new ones """
+        with self.lock:
+            if self.reason is None:
+                self.reason = reason
+            pids = list(self.pids)
+        for pid in pids:
+            kill_group(pid)
+
+    def start_timer(self, timeout):
+        """ Interrupt the task after `timeout` seconds (unless the
+        returned timer is cancelled) """
+        timer = threading.Timer(timeout, self.interrupt, ('timeout',))
+        timer.daemon = True
+        timer.start()
+        return timer
@@ -0,0 +1,316 @@
+# Build outputs shared between daemons
+#
+# Serve a directory as an HTTP store with:
+#
+#     python -m ciex.remotecache /var/cache/ciex 0.0.0.0:9400
+
+import io
+import os
+import sys
+import shutil
+import hashlib
+import logging
+import tarfile
+import tempfile
+import threading
+
+from . import compat
+
+
+CHUNK = 1024 * 1024  # bytes read or written at once
+
+
+def copy_chunks(src, dst, length=None):
+    """ Copy file object `src` to `dst` in chunks (at most `length`
+    bytes). Return the number of bytes copied """
+    total = 0
+    while length is None or total < length:
+        size = CHUNK if length is None else min(CHUNK, length - total)
+        chunk = src.read(size)
+        if not chunk:
+            break
+        dst.write(chunk)
+        total += len(chunk)
+    return total
+
+
+def safe_name(name):
+    """ Check a store entry name (`app/key.tar.gz`) """
+    parts = name.split('/')
+    if not name or name.startswith('/') or \
+            any(p in ('', '.', '..') for p in parts):
+        raise ValueError('bad entry name {}'.format(name))
+    return name
+
+
+class FileStore(object):
+    """ Store on a filesystem (e.g. an NFS mount shared by the hosts) """
+
+    def __init__(self, path):
+        super(FileStore, self).__init__()
+        self.path = path
+
+    def read(self, name, fh):
+        """ Write the entry `name` to `fh`; return False if missing """
+        try:
+            src = open(os.path.join(self.path, safe_name(name)), 'rb')
+        except (IOError, OSError):
+            return False
+        with src:
+            copy_chunks(src, fh)
+        return True
+
+    def write(self, name, fh):
+        """ Store the content of `fh` as entry `name` """
+        path = os.path.join(self.path, safe_name(name))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'wb') as dst:
+            copy_chunks(fh, dst)
+        os.rename(tmp, path)
+
+
+class HTTPStore(object):
+    """ Store served over HTTP: entries are read with GET and written
+    with PUT of `<url>/<name>` (see `CacheHandler`) """
+
+    def __init__(self, url, timeout=60):
+        super(HTTPStore, self).__init__()
+        parsed = compat.urlparse(url)
+        self.https = parsed.scheme == 'https'
+        self.host = parsed.netloc
+        self.prefix = parsed.path.rstrip('/')
+        self.timeout = timeout
+
+    def connection(self):
+        cls = compat.HTTPSConnection if self.https else compat.HTTPConnection
+        return cls(self.host, timeout=self.timeout)
+
+    def read(self, name, fh):
+        conn = self.connection()
+        try:
+            conn.request('GET', '{}/{}'.format(self.prefix, safe_name(name)))
+            res = conn.getresponse()
+            if res.status == 404:
+                return False
+            if res.status != 200:
+                raise IOError('GET {} failed: {} {}'.format(
+                    name, res.status, res.reason))
+            copy_chunks(res, fh)
+            return True
+        finally:
+            conn.close()
+
+    def write(self, name, fh):
+        fh.seek(0, os.SEEK_END)
+        size = fh.tell()
+        fh.seek(0)
+        conn = self.connection()
+        try:
+            # http.client sends file objects block by block
+            conn.request(
+                'PUT', '{}/{}'.format(self.prefix, safe_name(name)), fh,
+                {'Content-Length': str(size)})
+            res = conn.getresponse()
+            res.read()
+            if res.status not in (200, 201, 204):
+                raise IOError('PUT {} failed: {} {}'.format(
+                    name, res.status, res.reason))
+        finally:
+            conn.close()
+
+
+def store_for(url):
+    """ Return the store of a `remote_cache` setting: an http(s) url,
+    or a directory (optionally as a file:// url) """
+    if url.startswith(('http://', 'https://')):
+        return HTTPStore(url)
+    if url.startswith('file://'):
+        url = url[len('file://'):]
+    return FileStore(url)
+
+
+def pack(src, path):
+    """ Write the directory `src` as a gzipped tarball at `path` """
+    with tarfile.open(path, 'w:gz') as tar:
+        for name in sorted(os.listdir(src)):
+            tar.add(os.path.join(src, name), arcname=name)
+
+
+def inside(name):
+    """ Check that a tarball path stays inside the extracted directory """
+    path = os.path.normpath(name)
+    return not (os.path.isabs(path) or path == '..' or
+                path.startswith('..' + os.sep))
+
+
+def unpack(path, dest):
+    """ Replace the directory `dest` with the content of a tarball. The
+    tarball comes from a shared store: entries (and symlink targets)
+    leading out of `dest`, and entries other than files, directories
+    and symlinks, are refused """
+    tmp = dest + '.tmp'
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    with tarfile.open(path, 'r:gz') as tar:
+        for member in tar.getmembers():
+            if not inside(member.name) or \
+                    not (member.isfile() or member.isdir() or
+                         member.issym()) or \
+                    (member.issym() and not inside(os.path.join(
+                        os.path.dirname(member.name), member.linkname))):
+                raise ValueError('unsafe tarball entry {}'.format(
+                    member.name))
+        if hasattr(tarfile, 'data_filter'):
+            tar.extractall(tmp, filter='data')
+        else:
+            tar.extractall(tmp)
+    if os.path.exists(dest):
+        shutil.rmtree(dest)
+    os.rename(tmp, dest)
+
+
+class RemoteCache(object):
+    """ Release tarballs of an app's builds in a store, keyed by build
+    key (commit + lockfiles hash). A tarball is published before its
+    sha256, so a reader either finds both or sees a miss """
+
+    def __init__(self, store, app_name):
+        super(RemoteCache, self).__init__()
+        self.store = store
+        self.app_name = app_name
+
+    def name(self, key):
+        return '{}/{}.tar.gz'.format(self.app_name, key)
+
+    def digest(self, key):
+        """ Return the sha256 of the release of `key` (None if missing) """
+        digest = io.BytesIO()
+        if not self.store.read(self.name(key) + '.sha256', digest):
+            return None
+        return digest.getvalue().decode().strip()
+
+    def fetch(self, key, dest):
+        """ Download, verify and unpack the release of `key` into the
+        directory `dest`. Return False if the store doesn't have it """
+        expected = self.digest(key)
+        if expected is None:
+            return False
+
+        with tempfile.NamedTemporaryFile(suffix='.tar.gz') as tmp:
+            digest = hashlib.sha256()
+            if not self.store.read(self.name(key), HashingWriter(tmp, digest)):
+                return False
+            tmp.flush()
+            if digest.hexdigest() != expected:
+                raise ValueError('release {} of {} is corrupted'.format(
+                    key, self.app_name))
+            unpack(tmp.name, dest)
+        return True
+
+    def publish(self, key, src):
+        """ Upload the release of `key` from the directory `src`, unless
+        another daemon did already. Return whether it was uploaded """
+        if self.digest(key) is not None:
+            return False
+        with tempfile.NamedTemporaryFile(suffix='.tar.gz') as tmp:
+            pack(src, tmp.name)
+            digest = hashlib.sha256()
+            with open(tmp.name, 'rb') as fh:
+                for chunk in iter(lambda: fh.read(CHUNK), b''):
+                    digest.update(chunk)
+                fh.seek(0)
+                self.store.write(self.name(key), fh)
+        self.store.write(self.name(key) + '.sha256',
+                         io.BytesIO(digest.hexdigest().encode()))
+        return True
+
+
+class HashingWriter(object):
+    """ Hash the chunks written to a file object """
+
+    def __init__(self, fh, digest):
+        super(HashingWriter, self).__init__()
+        self.fh = fh
+        self.digest = digest
+
+    def write(self, chunk):
+        self.digest.update(chunk)
+        self.fh.write(chunk)
+
+
+class CacheHandler(compat.BaseHTTPRequestHandler):
+    """ GET and PUT the entries of a directory (`server.root`) """
+
+    def path_of(self):
+        try:
+            return os.path.join(
+                self.server.root, safe_name(self.path.lstrip('/')))
+        except ValueError:
+            self.send_error(400)
+            return None
+
+    def do_GET(self):
+        path = self.path_of()
+        if path is None:
+            return
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        with open(path, 'rb') as fh:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header(
+                'Content-Length', str(os.fstat(fh.fileno()).st_size))
+            self.end_headers()
+            copy_chunks(fh, self.wfile)
+
+    def do_PUT(self):
+        path = self.path_of()
+        if path is None:
+            return
+        length = int(self.headers.get('Content-Length') or 0)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass  # created by another request meanwhile
+        tmp = '{}.{}.tmp'.format(path, threading.current_thread().ident)
+        with open(tmp, 'wb') as fh:
+            received = copy_chunks(self.rfile, fh, length=length)
+        if received != length:
+            os.remove(tmp)
+            self.send_error(400)
+            return
+        os.rename(tmp, path)
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logging.debug('* Cache request: ' + format, *args)
+
+
+class CacheServer(compat.ThreadingMixIn, compat.HTTPServer):
+
+    daemon_threads = True
+
+
+def serve(root, host, port):
+    """ Serve the directory `root` as an HTTP store (in a daemon
+    thread) """
+    server = CacheServer((host, port), CacheHandler)
+    server.root = root
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    address, _, port = sys.argv[2].rpartition(':')
+    main_server = CacheServer((address, int(port)), CacheHandler)
+    main_server.root = sys.argv[1]
+    main_server.serve_forever()
@@ -0,0 +1,180 @@
+# Admission of tasks by the cpu and memory they need
+
+import os
+import time
+
+
+def read_words(path):
+    """ Return the words of a (proc or cgroup) file, None if missing """
+    try:
+        with open(path) as fh:
+            return fh.read().split()
+    except (IOError, OSError):
+        return None
+
+
+def loadavg(proc='/proc'):
+    """ Return the 1 minute load average of the host (None if unknown) """
+    words = read_words(os.path.join(proc, 'loadavg'))
+    return float(words[0]) if words else None
+
+
+def meminfo(proc='/proc'):
+    """ Return the `MemTotal` and `MemAvailable` of the host in MB """
+    total = available = None
+    try:
+        with open(os.path.join(proc, 'meminfo')) as fh:
+            for line in fh:
+                name, _, value = line.partition(':')
+                if name == 'MemTotal':
+                    total = int(value.split()[0]) / 1024.0
+                elif name == 'MemAvailable':
+                    available = int(value.split()[0]) / 1024.0
+    except (IOError, OSError):
+        pass
+    return total, available
+
+
+def cgroup_memory(cgroup='/sys/fs/cgroup'):
+    """ Return the memory limit and usage in MB of the daemon's cgroup
+    (v2 or v1), (None, None) without a limit """
+    for limit_file, usage_file in [
+            ('memory.max', 'memory.current'),
+            ('memory/memory.limit_in_bytes', 'memory/memory.usage_in_bytes')]:
+        limit = read_words(os.path.join(cgroup, limit_file))
+        usage = read_words(os.path.join(cgroup, usage_file))
+        if limit and usage and limit[0].isdigit():
+            # cgroup v1 reports a huge number when there is no limit
+            if int(limit[0]) >= 2 ** 60:
+                break
+            return int(limit[0]) / 2 ** 20, int(usage[0]) / 2 ** 20
+    return None, None
+
+
+def memory_limit_mb(proc='/proc', cgroup='/sys/fs/cgroup'):
+    """ Return the memory the daemon's tasks may use: the cgroup limit,
+    else the memory of the host (None if unknown) """
+    limit, _ = cgroup_memory(cgroup)
+    total, _ = meminfo(proc)
+    if limit is None:
+        return total
+    return limit if total is None else min(limit, total)
+
+
+def memory_available_mb(proc='/proc', cgroup='/sys/fs/cgroup'):
+    """ Return the memory still available to the daemon's tasks """
+    limit, usage = cgroup_memory(cgroup)
+    _, available = meminfo(proc)
+    if limit is not None:
+        left = max(0.0, limit - usage)
+        available = left if available is None else min(left, available)
+    return available
+
+
+def host_probe():
+    """ Return the load average and available memory (MB) of the host """
+    return loadavg(), memory_available_mb()
+
+
+class Budget(object):
+    """ Cpu slots and memory (MB) shared by the running tasks of the
+    daemon (0 means no limit). A task holds its command's cost from the
+    time it is taken until it finishes, and is only taken if its cost
+    fits next to the costs held. With a `probe`, the load average and
+    available memory of the host (sampled every `interval` seconds at
+    most) are also considered, for the work done outside the daemon.
+
+    A task costing more than the whole budget still runs, alone: with
+    nothing held, a cost only counts up to `alone_share` of the budget.
+    A task passed over by `reserve_after` admissions of other costs gets
+    the budget reserved: no other cost is admitted until it fits.
+    Used with the task router's lock held """
+
+    alone_share = 0.5
+    reserve_after = 8
+
+    def __init__(self, cpu=0, memory=0, probe=None, interval=1.0):
+        super(Budget, self).__init__()
+        self.cpu_used = 0.0
+        self.memory_used = 0.0
+        self.holders = 0  # running tasks holding a cost
+        self.admissions = 0  # costs acquired so far
+        self.reserved = None  # the task the budget is kept for
+        self.sample = (None, None)
+        self.sampled = 0
+        self.configure(cpu, memory, probe, interval)
+
+    def configure(self, cpu=0, memory=0, probe=None, interval=1.0):
+        """ Change the limits; the costs held are kept """
+        self.cpu = cpu
+        self.memory = memory
+        self.probe = probe
+        self.interval = interval
+        self.sampled = 0
+
+    @property
+    def wait_timeout(self):
+        """ How long a waiting worker should wait before checking again
+        (the host load changes without the router knowing) """
+        return self.interval if self.probe is not None else None
+
+    def host_load(self):
+        """ Return the (cached) load average and available memory """
+        if self.probe is None:
+            return None, None
+        now = time.time()
+        if now - self.sampled >= self.interval:
+            self.sample = self.probe()
+            self.sampled = now
+        return self.sample
+
+    def fits(self, cost):
+        """ Check if a (cpu, memory) cost can be acquired now """
+        cpu, memory = cost
+        if not (cpu or memory):
+            return True
+        if not self.holders:
+            if self.cpu:
+                cpu = min(cpu, self.cpu * self.alone_share)
+            if self.memory:
+                memory = min(memory, self.memory * self.alone_share)
+        load, available = self.host_load()
+        if cpu and self.cpu:
+            busy = self.cpu_used if load is None else max(self.cpu_used, load)
+            if busy + cpu > self.cpu:
+                return False
+        if memory:
+            if self.memory and self.memory_used + memory > self.memory:
+                return False
+            if available is not None and memory > available:
+                return False
+        return True
+
+    def admits(self, task, cost):
+        """ Check if `task` can acquire its cost now, reserving the
+        budget for it once it was passed over too many times (the
+        `blocked` attribute of the task records since when) """
+        if not any(cost):
+            return True
+        if self.reserved is not None and self.reserved is not task:
+            return False
+        if self.fits(cost):
+            return True
+        if task.blocked is None:
+            task.blocked = self.admissions
+        elif self.admissions - task.blocked >= self.reserve_after:
+            self.reserved = task
+        return False
+
+    def acquire(self, cost, task=None):
+        self.cpu_used += cost[0]
+        self.memory_used += cost[1]
+        self.holders += 1
+        self.admissions += 1
+        if task is not None and task is self.reserved:
+            self.reserved = None
+
+    def release(self, cost):
+        self.cpu_used -= cost[0]
+        self.memory_used -= cost[1]
+        self.holders -= 1
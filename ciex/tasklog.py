@@ -0,0 +1,106 @@
+# Task output logs
+
+import os
+import tempfile
+import threading
+import collections
+
+
+class TaskLog(object):
+    """ The output of a task's commands. The most recent output is kept
+    in memory as a list of chunks (at most `max_memory` bytes), older
+    chunks are spilled to the file at `path`. Readers use offsets, so
+    following a running task only transfers the new output """
+
+    def __init__(self, path, max_memory=256 * 1024):
+        super(TaskLog, self).__init__()
+        self.path = path
+        self.max_memory = max_memory
+        self.lock = threading.Lock()
+        self.chunks = collections.deque()  # in memory chunks
+        self.memory = 0  # bytes in memory
+        self.start = 0  # offset of the first chunk in memory
+        self.size = 0  # total bytes written
+        self.done = False
+
+    def write(self, data):
+        """ Append output data (bytes) """
+        if not data:
+            return
+        with self.lock:
+            self.chunks.append(data)
+            self.memory += len(data)
+            self.size += len(data)
+            if self.memory > self.max_memory:
+                self._spill()
+
+    def _spill(self):
+        """ Move the oldest chunks to disk. Must be called with `lock` """
+        with open(self.path, 'ab') as fh:
+            while self.memory > self.max_memory // 2:
+                chunk = self.chunks.popleft()
+                fh.write(chunk)
+                self.memory -= len(chunk)
+                self.start += len(chunk)
+
+    def read(self, offset=0, limit=64 * 1024):
+        """ Return (data, next offset, done) for output from `offset` """
+        with self.lock:
+            offset = max(0, min(offset, self.size))
+            if offset < self.start:
+                with open(self.path, 'rb') as fh:
+                    fh.seek(offset)
+                    data = fh.read(min(limit, self.start - offset))
+            else:
+                data, position = [], self.start
+                for chunk in self.chunks:
+                    end = position + len(chunk)
+                    if end > offset:
+                        data.append(chunk[max(0, offset - position):])
+                    position = end
+                data = b''.join(data)[:limit]
+            next_offset = offset + len(data)
+            return data, next_offset, self.done and next_offset == self.size
+
+    def close(self):
+        """ The task finished, no more output will be written """
+        with self.lock:
+            self.done = True
+
+    def remove(self):
+        """ Drop the log and its spill file """
+        with self.lock:
+            self.chunks.clear()
+            if self.start and os.path.exists(self.path):
+                os.remove(self.path)
+
+
+class TaskLogs(object):
+    """ The logs of the most recent tasks (at most `keep` of them),
+    spilling to files in `path` """
+
+    def __init__(self, path=None, keep=100, max_memory=256 * 1024):
+        super(TaskLogs, self).__init__()
+        self.path = path or os.path.join(tempfile.gettempdir(), 'ciex-logs')
+        self.keep = keep
+        self.max_memory = max_memory
+        self.lock = threading.Lock()
+        self.logs = collections.OrderedDict()  # task id -> TaskLog
+
+    def new(self, task):
+        """ Create the log of `task` """
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        log = TaskLog(
+            os.path.join(self.path, task.id + '.log'), self.max_memory)
+        with self.lock:
+            self.logs[task.id] = log
+            while len(self.logs) > self.keep:
+                _, old = self.logs.popitem(last=False)
+                old.remove()
+        return log
+
+    def get(self, task_id):
+        """ Return the log of a task (or None) """
+        with self.lock:
+            return self.logs.get(task_id)
@@ -0,0 +1,175 @@
+# Toolchains: the environment of the commands of an app (variables, PATH
+# and language versions), resolved once from the app's settings, and an
+# isolated prefix where `toolchain_setup` installs what the builds need,
+# prepared once per lockfiles hash
+
+import os
+import shutil
+import hashlib
+import logging
+import threading
+
+from . import error
+from . import util
+from . import buildcache
+
+
+# Variables kept from the daemon's environment with `inherit_env = false`
+BASIC_VARIABLES = (
+    'PATH', 'HOME', 'USER', 'LOGNAME', 'SHELL', 'LANG', 'LC_ALL',
+    'LC_CTYPE', 'TZ', 'TMPDIR', 'TERM', 'SSH_AUTH_SOCK')
+
+READY = '.ciex-ready'  # written in a prefix once its setup succeeded
+
+
+def parse_versions(value):
+    """ Parse `tool:version` items (e.g. `erlang:26.2, elixir:1.15.7`) """
+    versions = []
+    for item in util.split_list(value):
+        tool, _, version = item.partition(':')
+        if not tool.strip() or not version.strip():
+            raise ValueError('bad toolchain version {}'.format(item))
+        versions.append((tool.strip(), version.strip()))
+    return versions
+
+
+class Toolchain(object):
+    """ The environment of an app's commands: the daemon's environment
+    (only its basic variables with `inherit_env = false`), `PATH`
+    prefixed with the bin directories of the `toolchain_versions`
+    (`<toolchain_root>/<tool>/<version>/bin`, the layout of asdf or mise
+    installs) and of `toolchain_path`, then the variables given by the
+    operations, those of the prepared prefix and `command_env` """
+
+    keep = 3  # prefixes kept per app, the least recently used go first
+
+    def __init__(self, setting):
+        super(Toolchain, self).__init__()
+        self.setting = setting
+        self.app_name = getattr(setting, 'name', None)
+        self.setup = getattr(setting, 'toolchain_setup', None)
+        self.command_env = getattr(setting, 'command_env', None) or {}
+        self.base, self.fingerprint = self.resolve()
+        self.prefix_variables = {}  # of the last prepared prefix
+
+    def resolve(self):
+        """ Return the base environment and the fingerprint of the
+        toolchain (None without versions, paths nor setup) """
+        inherit = getattr(self.setting, 'inherit_env', 'true')
+        if inherit.lower() == 'true':
+            env = dict(os.environ)
+        else:
+            env = {k: os.environ[k] for k in BASIC_VARIABLES
+                   if k in os.environ}
+
+        paths = []
+        root = getattr(self.setting, 'toolchain_root', None)
+        versions = parse_versions(
+            getattr(self.setting, 'toolchain_versions', ''))
+        for tool, version in versions:
+            path = os.path.join(root or '', tool, version, 'bin')
+            if not root or not os.path.isdir(path):
+                raise error.AppSettingError(
+                    '{} {} of {} is not installed in {}'.format(
+                        tool, version, self.app_name, path))
+            paths.append(path)
+        paths.extend(util.split_list(
+            getattr(self.setting, 'toolchain_path', '')))
+        if paths:
+            env['PATH'] = os.pathsep.join(
+                paths + [env.get('PATH', os.defpath)])
+
+        if not (paths or self.setup):
+            return env, None
+        digest = hashlib.sha256()
+        for item in paths + [self.setup or '']:
+            digest.update(item.encode() + b'\0')
+        return env, digest.hexdigest()[:12]
+
+    def environment(self, variables=None, prefix_variables=None):
+        """ Return the environment of a command (with the variables of
+        the prefix in use, unless others are given) """
+        env = dict(self.base)
+        env.update(variables or {})
+        if prefix_variables is None:
+            prefix_variables = self.prefix_variables
+        env.update(prefix_variables)
+        env.update(self.command_env)
+        return env
+
+    def prefix_path(self, repo_path, lockfiles):
+        """ Return the prefix of the repo's lockfiles (None without a
+        `toolchain_setup`) """
+        install_path = getattr(self.setting, 'install_path', None)
+        if not self.setup or not install_path:
+            return None
+        key = hashlib.sha256('{}-{}'.format(
+            self.fingerprint,
+            buildcache.lockfiles_hash(repo_path, lockfiles)).encode())
+        return os.path.join(
+            self.toolchains_path(), key.hexdigest()[:16])
+
+    def toolchains_path(self):
+        return os.path.join(
+            self.setting.install_path, self.app_name, 'toolchains')
+
+    def prefix_env(self, prefix, variables):
+        """ Return the variables of `prefix`: `variables` with paths
+        relative to it (e.g. `MIX_HOME`), `CIEX_TOOLCHAIN_PREFIX` and
+        its bin directory first in `PATH` """
+        env = {k: os.path.join(prefix, v) for k, v in variables.items()}
+        env['CIEX_TOOLCHAIN_PREFIX'] = prefix
+        env['PATH'] = os.pathsep.join([
+            os.path.join(prefix, 'bin'), self.base.get('PATH', os.defpath)])
+        return env
+
+    def is_ready(self, prefix):
+        return os.path.exists(os.path.join(prefix, READY))
+
+    def ready(self, prefix):
+        """ Mark `prefix` as prepared, then remove the prefixes beyond
+        `keep` """
+        with open(os.path.join(prefix, READY), 'w'):
+            pass
+        self.gc()
+
+    def use(self, prefix, variables):
+        """ Give the variables of the prepared `prefix` to the commands
+        of the app from now on """
+        os.utime(os.path.join(prefix, READY), None)
+        self.prefix_variables = self.prefix_env(prefix, variables)
+
+    def clear(self, prefix):
+        """ Make `prefix` an empty directory, for its setup """
+        if os.path.exists(prefix):
+            shutil.rmtree(prefix)
+        os.makedirs(prefix)
+
+    def gc(self):
+        """ Remove the prepared prefixes beyond `keep` (the ones being
+        prepared have no marker yet) """
+        path = self.toolchains_path()
+        prefixes = []
+        for name in os.listdir(path):
+            marker = os.path.join(path, name, READY)
+            if os.path.exists(marker):
+                prefixes.append((os.path.getmtime(marker), name))
+        for _, name in sorted(prefixes, reverse=True)[self.keep:]:
+            logging.debug('* Removing toolchain %s of %s', name, self.app_name)
+            shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+
+
+_toolchains = {}  # app name -> Toolchain of its current settings
+_lock = threading.Lock()
+
+
+def for_app(setting):
+    """ Return the toolchain of an app, resolved again only once its
+    settings changed (a reload gives changed apps new settings) """
+    if setting is None:
+        return Toolchain(None)
+    with _lock:
+        toolchain = _toolchains.get(setting.name)
+        if toolchain is None or toolchain.setting is not setting:
+            toolchain = _toolchains[setting.name] = Toolchain(setting)
+        return toolchain
@@ -1,25 +1,88 @@
 # Utility functions
 
+import os
 import sys
+import logging
+import importlib
+
+from . import compat
 
 from ciex.contrib.workers.elixir import *
 from ciex.contrib.workers.golang import *
 
 
+DEFAULT_ADDRESS = 'ipc:///tmp/ciex.sock'
+
+
+def daemon_address():
+    """ The address of the daemon, `CIEX_ADDRESS` overrides the default
+    (e.g. tcp://0.0.0.0:5000 to accept commands from other hosts) """
+    return os.environ.get('CIEX_ADDRESS', DEFAULT_ADDRESS)
+
+
+def split_list(value):
+    """ Split a comma separated config value into a list of items """
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def percentile_index(count, p):
+    """ Index of the `p` percentile in a sorted list of `count` items """
+    return min(count - 1, int(count * p / 100.0))
+
+
+def percentile(values, p):
+    """ Return the `p` percentile of the sorted `values` """
+    return values[percentile_index(len(values), p)]
+
+
+def parse_options(args):
+    """ Parse command arguments given as `key=value` strings """
+    options = {}
+    for arg in args:
+        key, sep, value = arg.partition('=')
+        if not sep:
+            raise ValueError('expected key=value, got {}'.format(arg))
+        options[key.strip()] = value.strip()
+    return options
+
+
 def load_contrib_worker(worker_name):
     """ Load a local worker """
     return globals()[worker_name]
 
 
 def load_other_worker(worker_dirpath, worker_modname, worker_name):
-    """ Add path to sys.path and load worker """
+    """ Add path to sys.path and load worker. An already imported module
+    is only imported again if its file was modified since """
 
     if worker_dirpath not in sys.path:
         sys.path.append(worker_dirpath)
-    mod = __import__(worker_modname)
+    mod = sys.modules.get(worker_modname)
+    if mod is None:
+        mod = importlib.import_module(worker_modname)
+    elif module_mtimes.get(worker_modname, module_mtime(mod)) != \
+            module_mtime(mod):
+        logging.debug('* Reloading modified module %s', worker_modname)
+        mod = compat.reload(mod)
+    module_mtimes[worker_modname] = module_mtime(mod)
     return getattr(mod, worker_name)
 
 
+# Module name -> modification time of its file when it was loaded
+module_mtimes = {}
+
+
+def module_mtime(mod):
+    """ Modification time of a module's source file """
+    path = getattr(mod, '__file__', None) or ''
+    if path.endswith('.pyc'):
+        path = path[:-1]
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
 def load_worker(worker_dirpath, worker_modname, worker_name):
     """ Load worker class """
 
@@ -0,0 +1,207 @@
+# Trigger tasks from git push webhooks
+
+import hmac
+import json
+import time
+import hashlib
+import logging
+import threading
+
+from . import compat
+
+
+MAX_BODY = 5 * 1024 * 1024  # bytes
+
+
+def repo_key(url):
+    """ Normalize a repo url, so the ssh, https and web urls of a repo
+    match: `git@github.com:walkr/ciex.git` -> `github.com/walkr/ciex` """
+    url = url.strip()
+    if '://' in url:
+        parsed = compat.urlparse(url)
+        host, path = parsed.hostname or '', parsed.path
+    elif ':' in url:
+        host, _, path = url.rpartition('@')[2].partition(':')
+    else:
+        host, path = '', url
+    path = path.strip('/')
+    if path.endswith('.git'):
+        path = path[:-4]
+    return '{}/{}'.format(host, path).lower()
+
+
+def parse_push(payload):
+    """ Read a push event (GitHub, GitLab, Gitea) and return the keys of
+    the repo urls, the branch (None for tags and deleted branches) and
+    the pushed commit """
+    repos = set()
+    for name in ('repository', 'project'):
+        for key, value in (payload.get(name) or {}).items():
+            if (key.endswith('url') or key == 'homepage') and \
+                    isinstance(value, compat.string_types) and value:
+                repos.add(repo_key(value))
+
+    ref = payload.get('ref') or ''
+    commit = payload.get('checkout_sha') or payload.get('after')
+    branch = None
+    if ref.startswith('refs/heads/') and not payload.get('deleted') and \
+            commit and commit.strip('0'):
+        branch = ref[len('refs/heads/'):]
+    return repos, branch, commit
+
+
+def check_signature(secret, headers, body):
+    """ Check a GitHub (or Gitea) HMAC signature, or a GitLab token """
+    signature = headers.get('X-Hub-Signature-256') or \
+        headers.get('X-Gitea-Signature')
+    if signature:
+        digest = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+        return hmac.compare_digest(
+            signature.replace('sha256=', '', 1), digest)
+    token = headers.get('X-Gitlab-Token')
+    if token:
+        return hmac.compare_digest(token, secret)
+    return False
+
+
+class Debouncer(object):
+    """ Call `trigger(key, value)` with the last value pushed for a key,
+    once no value came for `delay` seconds, or at most `max_delay`
+    seconds after the first value (so a constant stream of pushes still
+    triggers) """
+
+    def __init__(self, trigger, delay, max_delay):
+        super(Debouncer, self).__init__()
+        self.trigger = trigger
+        self.delay = delay
+        self.max_delay = max(delay, max_delay)
+        self.cond = threading.Condition()
+        self.pending = {}  # key -> [due, deadline, value]
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def push(self, key, value):
+        now = time.time()
+        with self.cond:
+            entry = self.pending.get(key)
+            if entry is None:
+                self.pending[key] = [
+                    now + self.delay, now + self.max_delay, value]
+            else:
+                entry[0] = min(now + self.delay, entry[1])
+                entry[2] = value
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while True:
+                    if self.stopped:
+                        return
+                    now = time.time()
+                    due = [k for k, e in self.pending.items() if e[0] <= now]
+                    if due:
+                        break
+                    timeout = None
+                    if self.pending:
+                        timeout = min(
+                            e[0] for e in self.pending.values()) - now
+                    self.cond.wait(timeout)
+                fired = [(k, self.pending.pop(k)[2]) for k in due]
+            for key, value in fired:
+                try:
+                    self.trigger(key, value)
+                except Exception as e:
+                    logging.error('* Webhook trigger %s failed: %s', key, e)
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+
+
+class WebhookHandler(compat.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        receiver = self.server.receiver
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_BODY:
+            self.reply(413, {'error': 'payload too large'})
+            return
+        body = self.rfile.read(length)
+        if receiver.secret and \
+                not check_signature(receiver.secret, self.headers, body):
+            self.reply(403, {'error': 'bad signature'})
+            return
+        event = self.headers.get('X-GitHub-Event') or \
+            self.headers.get('X-Gitea-Event') or \
+            self.headers.get('X-Gitlab-Event') or 'push'
+        if event.lower() == 'ping':
+            self.reply(200, {'ok': True})
+            return
+        try:
+            payload = json.loads(body.decode('utf-8'))
+            repos, branch, commit = parse_push(payload)
+        except (ValueError, AttributeError) as e:
+            self.reply(400, {'error': 'bad payload: {}'.format(e)})
+            return
+        self.reply(202, {'apps': receiver.push(repos, branch, commit)})
+
+    def reply(self, code, data):
+        body = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug('* Webhook request: ' + format, *args)
+
+
+class WebhookServer(compat.ThreadingMixIn, compat.HTTPServer):
+    """ One thread per request, so slow clients don't hold the others """
+
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class WebhookReceiver(object):
+    """ Receive push webhooks over HTTP. `targets(repos, branch)` returns
+    the (app name, command) to run for a push, which are debounced then
+    passed to `trigger(app name, command, commit)` """
+
+    def __init__(self, targets, trigger, delay=5, max_delay=60, secret=None):
+        super(WebhookReceiver, self).__init__()
+        self.targets = targets
+        self.secret = secret
+        self.debouncer = Debouncer(
+            lambda key, commit: trigger(key[0], key[1], commit),
+            delay, max_delay)
+        self.server = None
+
+    def push(self, repos, branch, commit):
+        """ Schedule the tasks of a push, return their app names """
+        if not repos or branch is None:
+            return []
+        targets = self.targets(repos, branch)
+        for target in targets:
+            self.debouncer.push(target, commit)
+        return sorted(set(app_name for app_name, _ in targets))
+
+    def serve(self, host, port):
+        """ Serve the webhooks over HTTP (in a daemon thread) """
+        self.server = WebhookServer((host, port), WebhookHandler)
+        self.server.receiver = self
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self.server
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        self.debouncer.stop()
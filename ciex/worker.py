@@ -1,57 +1,372 @@
 # Continuous Integration Workers
 
+import os
+import copy
 import time
+import types
 import logging
+import threading
+import subprocess
+import collections
 
 import oi.worker
 
+from . import compat
+from . import context
+from . import metrics
+from . import process
+from . import pipeline
+from . import artifacts
+from . import buildcache
+from . import remotecache
+
+
+# A shell command yielded by a ci operation (see `CIWorker.drive`)
+Command = collections.namedtuple('Command', 'line cwd env')
+Command.__new__.__defaults__ = (None, None)
+
+
+def start_timer(task):
+    """ Start the timer interrupting `task` after the timeout of its
+    command, if it has one """
+    timeout = task.env.timeout_for(task.command) if task.env else 0
+    if not timeout:
+        return None
+    return task.control.start_timer(timeout)
+
+
+def interrupted(task):
+    """ Check if `task` was cancelled or timed out """
+    return task.control is not None and task.control.reason is not None
+
+
+def execute_task(worker, task):
+    """ Execute `task` with the ci `worker`. Any error fails the task,
+    so it can always be handed back to the router """
+    try:
+        worker.execute(task)
+    except Exception as e:
+        task.error = str(e)
+        task.failure()
+        logging.error('* Task %s failed: %s', task, e, exc_info=1)
+    if task.finish is None:
+        task.failure()
+    return task
+
+
+def step_copy(task, step):
+    """ A pending copy of `task` executing `step`'s operation """
+    step_task = copy.copy(task)
+    step_task.command = step.operation
+    step_task.error = None
+    step_task.finish = None
+    return step_task.pending()
+
+
+def step_error(step_task):
+    """ The error of a step executed by `step_task`, if it failed """
+    if step_task.status.name not in ('success', 'pending'):
+        return step_task.error or 'failed'
+    return None
+
 
 class CIControlWorker(oi.worker.Worker):
-    """ This worker will start all other ci workers """
+    """ This worker will start all other ci workers. Given the `core`,
+    it initializes it first, so the journal is replayed and the metrics
+    and webhook servers listen without waiting for a command """
+
+    def __init__(self, program, core=None, **kwargs):
+        super(CIControlWorker, self).__init__(program, **kwargs)
+        self.core = core
 
     def run(self):
+        ready = self.program.state.setdefault('ci_ready', threading.Event())
+        if self.core is not None:
+            try:
+                self.core.ensure_initialized()
+            except Exception as e:
+                # Tried again by the first command, which reports it
+                logging.error('* Cannot initialize the core: %s', e)
         while True:
             # Since the core's initialization might be delayed
-            # wait until ci workers are ready
-            if not self.program.state.get('ci_workers'):
-                time.sleep(0.1)
-                continue
+            # wait until it signals that ci workers are ready
+            ready.wait()
+            ready.clear()
 
-            # Start and wait workers
-            [w.start() for w in self.program.state.ci_workers]
-            [w.join() for w in self.program.state.ci_workers]
+            # Start the workers which were not started yet
+            for w in self.program.state.ci_workers:
+                if w.ident is None:
+                    w.start()
 
 
 class CIWorker(oi.worker.Worker):
-    """ Subclass this and write your own upgrade/downgrade routines """
+    """ Subclass this and write your own upgrade/downgrade routines.
+
+    An operation can either do its work and return the task, or
+    `yield` the shell commands it needs (as `Command` objects) and
+    receive their exit codes. The latter can also be executed by the
+    asyncio engine: set `engine = 'asyncio'` on the class, or
+    `worker_engine = asyncio` in the app's settings.
+
+    A command can also be a pipeline of operations, see `pipelines`.
+
+    On timeout or cancel, only the commands yielded by an operation (or
+    run with `sh(..., control=task.control)`) are killed; an operation
+    running its work by other means (e.g. `os.system`) goes on until it
+    returns, then its task is marked as timed out or cancelled """
+
+    engine = 'thread'
+
+    # Pipeline name -> the `pipeline.Step`s it is made of, e.g.
+    # {'ci': [Step('pull'), Step('lint', after=['pull']),
+    #         Step('test', after=['pull']),
+    #         Step('build', after=['lint', 'test'])]}
+    pipelines = {}
+
+    # Files describing the dependencies, and the directories where they
+    # are fetched (used by the build cache)
+    lockfiles = ()
+    deps_dirs = ()
+
+    # Variables pointing into the app's toolchain prefix (paths relative
+    # to it), e.g. where the package manager installs its tools
+    toolchain_env = {}
 
     def __init__(self, program, app_name, task_router, **kwargs):
         super(CIWorker, self).__init__(program, **kwargs)
         self.app_name = app_name
         self.task_router = task_router
+        self.cache = None
+        self.retired = threading.Event()  # set to exit after the task
+
+    def build_cache(self, task):
+        """ Return the app's build cache, or None if `build_cache_path`
+        is not set in the app's settings """
+        path = getattr(task.env, 'build_cache_path', None)
+        if not path:
+            return None
+        if self.cache is None:
+            max_mb = int(getattr(task.env, 'build_cache_max_mb', 1024))
+            self.cache = buildcache.BuildCache(
+                os.path.join(path, task.app_name), max_mb * 1024 * 1024)
+        return self.cache
+
+    def build_key(self, task):
+        """ Key of a build of the app's repo: its HEAD, the lockfiles
+        hash and the toolchain fingerprint, if any """
+        key = buildcache.build_key(context.repo_path(task), self.lockfiles)
+        fingerprint = context.toolchain(task).fingerprint
+        if key is None or fingerprint is None:
+            return key
+        return '{}-{}'.format(key, fingerprint)
+
+    def toolchain_setup(self, task):
+        """ Return the command preparing the app's toolchain prefix for
+        the repo's lockfiles (`toolchain_setup`), None if there is no
+        setup or the prefix is already prepared. The prefix is used by
+        the app's commands once prepared (see `toolchain_ready`) """
+        chain = context.toolchain(task)
+        prefix = chain.prefix_path(context.repo_path(task), self.lockfiles)
+        if prefix is None:
+            return None
+        if chain.is_ready(prefix):
+            chain.use(prefix, self.toolchain_env)
+            return None
+        logging.debug('* Preparing toolchain %s of %s', prefix, task.app_name)
+        chain.clear(prefix)
+        env = chain.environment(
+            prefix_variables=chain.prefix_env(prefix, self.toolchain_env))
+        return Command(chain.setup, context.repo_path(task), env)
+
+    def toolchain_ready(self, task):
+        """ Use the toolchain prefix prepared by `toolchain_setup` """
+        chain = context.toolchain(task)
+        prefix = chain.prefix_path(context.repo_path(task), self.lockfiles)
+        chain.ready(prefix)
+        chain.use(prefix, self.toolchain_env)
+
+    def remote_cache(self, task):
+        """ Return the app's build cache shared between daemons, or None
+        if `remote_cache` (a directory or an http url) is not set in the
+        app's settings """
+        url = getattr(task.env, 'remote_cache', None)
+        if not url:
+            return None
+        return remotecache.RemoteCache(
+            remotecache.store_for(url), task.app_name)
+
+    def artifact_store(self, task):
+        """ Return the app's release store, or None if `install_path` is
+        not set in the app's settings """
+        return artifacts.app_store(task.env)
+
+    def fetch_release(self, remote, key, path):
+        """ Download the release of build `key` into `path`. A missing,
+        corrupted or unreachable release means building it """
+        try:
+            found = remote.fetch(key, path)
+        except Exception as e:
+            logging.warning('* Cannot fetch release %s: %s', key, e)
+            return False
+        logging.debug('* Release %s %s', key, 'fetched' if found else 'miss')
+        return found
+
+    def publish_release(self, remote, key, path):
+        """ Upload the release of build `key` for the other daemons; a
+        failed upload doesn't fail the build """
+        try:
+            remote.publish(key, path)
+        except Exception as e:
+            logging.warning('* Cannot publish release %s: %s', key, e)
+
+    def store_release(self, task, path):
+        """ Store the release built in `path`, tagged with the repo's
+        commit, then remove the releases beyond `release_keep` """
+        store = self.artifact_store(task)
+        if store is None:
+            return None
+        tag = artifacts.release_tag(
+            buildcache.repo_head(context.repo_path(task)))
+        store.add(tag, path)
+        store.gc(int(getattr(task.env, 'release_keep', 5)))
+        logging.debug('* Stored release %s of %s', tag, task.app_name)
+        return tag
 
     def execute(self, task):
-        function = getattr(self, task.command)
+        """ Execute the operation (or pipeline) of `task`, and record
+        its duration. The commands of the task are killed once its
+        timeout expires (see `AppSetting.timeout_for`) or it is
+        cancelled, and the task is marked accordingly """
+        begin = time.time()
+        if task.control is None:
+            task.control = process.TaskControl()
+        timer = start_timer(task)
+        try:
+            result = self.operate(task)
+        finally:
+            if timer is not None:
+                timer.cancel()
+            metrics.operation_duration.observe(
+                (task.app_name, task.command), time.time() - begin)
+        if task.control.reason is not None:
+            task.interrupted(task.control.reason)
+        return result
 
+    def operate(self, task):
+        if task.command in self.pipelines:
+            return self.run_pipeline(task)
         try:
-            return function(task)
+            result = getattr(self, task.command)(task)
+            if isinstance(result, types.GeneratorType):
+                return self.drive(task, result)
+            return result
         except Exception as e:
             task.error = str(e)
             task.failure()
-            logging.error('* Task {} failed: {}'.format(task, e), exc_info=1)
+            logging.error('* Task %s failed: %s', task, e, exc_info=1)
         return task
 
+    def drive(self, task, steps):
+        """ Run the commands yielded by the `steps` generator, sending
+        back their exit codes. The task succeeds unless marked otherwise.
+        Commands without an `env` get `context.command_env(task)` """
+        code = None
+        while True:
+            try:
+                command = steps.send(code)
+            except StopIteration:
+                break
+            if interrupted(task):
+                steps.close()
+                break
+            env = command.env
+            if env is None:
+                env = context.command_env(task)
+            code = self.sh(
+                command.line, command.cwd, env, output=task.output,
+                control=task.control)
+
+        if task.finish is None:
+            task.success()
+        return task
+
+    def run_pipeline(self, task):
+        """ Run the steps of a pipeline, at most `parallel_steps` (an app
+        setting) at once, each one in its own thread """
+        try:
+            run = pipeline.Pipeline(self.pipelines[task.command]).new_run(task)
+        except ValueError as e:
+            task.error = str(e)
+            return task.failure()
+
+        parallel = getattr(task.env, 'parallel_steps', 4)
+        results = compat.Queue()
+
+        def run_step(step):
+            results.put((step.name, self.run_step(task, step)))
+
+        while True:
+            for step in run.ready()[:parallel - len(run.running)]:
+                run.begin(step.name)
+                thread = threading.Thread(target=run_step, args=(step,))
+                thread.daemon = True
+                thread.start()
+            if run.done():
+                break
+            run.end(*results.get())
+        return run.finish(task)
+
+    def run_step(self, task, step):
+        """ Execute the operation of a pipeline step on a copy of the
+        task (so it cannot finish the task). Return the error, if any """
+        step_task = step_copy(task, step)
+        try:
+            self.execute(step_task)
+        except Exception as e:
+            step_task.error = str(e)
+            step_task.failure()
+        return step_error(step_task)
+
+    def sh(self, line, cwd=None, env=None, output=None, control=None):
+        """ Run a shell command and return its exit code. Its stdout
+        and stderr are written to the `output` task log, if any. The
+        command runs in its own process group, which `control` (a
+        `process.TaskControl`) kills if the task is interrupted """
+        if output is None:
+            proc = subprocess.Popen(
+                line, shell=True, cwd=cwd, env=env, **process.NEW_SESSION)
+        else:
+            output.write('$ {}\n'.format(line).encode())
+            proc = subprocess.Popen(
+                line, shell=True, cwd=cwd, env=env, stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT, **process.NEW_SESSION)
+        if control is not None:
+            control.add(proc.pid)
+        try:
+            if output is not None:
+                fd = proc.stdout.fileno()
+                while True:
+                    chunk = os.read(fd, 65536)
+                    if not chunk:
+                        break
+                    output.write(chunk)
+                proc.stdout.close()
+            return proc.wait()
+        finally:
+            if control is not None:
+                control.remove(proc.pid)
+
     def run(self):
         """ Check work from the queue and do processing """
 
         # self.set_cwd(self.app_name)
         while True:
-            logging.debug('* {} is getting a new task'.format(self))
-            task = self.task_router.take_new(self.app_name)
-            logging.debug('* Got work for {}'.format(self.app_name))
-            task = self.execute(task)
-            self.task_router.put_finished(task)
-            time.sleep(0.1)
+            logging.debug('* %s is getting a new task', self)
+            task = self.task_router.take_new(self.app_name, self.retired)
+            if task is None:
+                break  # the worker was retired (core reloaded)
+            logging.debug('* Got work for %s', self.app_name)
+            self.task_router.put_finished(execute_task(self, task))
 
     # -- NOTE ------------------------------------------
 
@@ -61,3 +376,27 @@ class CIWorker(oi.worker.Worker):
     # - start
     # - etc ...
     # See `ciex.contrib.workers` for more details
+
+
+class CIPoolWorker(oi.worker.Worker):
+    """ A worker from the shared pool. It takes tasks of any app from
+    the task router and executes them with that app's ci worker """
+
+    def __init__(self, program, task_router, executors, **kwargs):
+        super(CIPoolWorker, self).__init__(program, **kwargs)
+        self.task_router = task_router
+        self.executors = executors  # app name -> ci worker instance
+        self.retired = threading.Event()  # set to exit after the task
+
+    def run(self):
+        """ Take tasks from any app and do processing. The executors of
+        the apps may change (core reloaded), so `executors` is only
+        modified while holding the router's `cond` """
+
+        while True:
+            task = self.task_router.take_next(self.executors, self.retired)
+            if task is None:
+                break  # the worker was retired (core reloaded)
+            logging.debug('* %s got work for %s', self, task.app_name)
+            self.task_router.put_finished(
+                execute_task(self.executors[task.app_name], task))
@@ -49,6 +49,7 @@ setup(
     long_description=read_long_description(readme_file),
     install_requires=[
         'oi',
+        'msgpack-python',
         'nose',
         'gitpython',
     ],
@@ -0,0 +1,25 @@
+""" Helpers shared by the tests """
+
+import os
+import subprocess
+
+
+def git(cwd, *args):
+    """ Run git in `cwd` (as a throwaway user) and return its output """
+    return subprocess.check_output(
+        ('git', '-c', 'user.name=t', '-c', 'user.email=t@t') + args,
+        cwd=cwd, stderr=subprocess.DEVNULL).decode().strip()
+
+
+def write(path, content, mode='w'):
+    """ Write `content` to `path`, creating its directory if needed """
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(path, mode) as fh:
+        fh.write(content)
+
+
+def read(path, mode='r'):
+    with open(path, mode) as fh:
+        return fh.read()
@@ -0,0 +1,162 @@
+import shutil
+import tempfile
+import threading
+import unittest
+
+from ciex import core
+from ciex import aioworker
+from ciex import tasklog
+from ciex.worker import CIWorker, Command
+from ciex.contrib.workers.elixir import ElixirCIWorker
+
+
+class SleepWorker(CIWorker):
+
+    def sleep(self, task):
+        code = yield Command('sleep 0.2')
+        assert code == 0
+
+    def echo(self, task):
+        code = yield Command('echo hello')
+        assert code == 0
+
+    def plain(self, task):
+        return task.success()
+
+    async def coroutine(self, task):
+        return task.success()
+
+    async def no_return(self, task):
+        task.success()
+
+    def fail(self, task):
+        code = yield Command('exit 3')
+        assert code == 0
+
+
+class FakeShellEngine(aioworker.AsyncEngine):
+    """ Record commands instead of running them """
+
+    codes = {}
+
+    def __init__(self, *args, **kwargs):
+        super(FakeShellEngine, self).__init__(*args, **kwargs)
+        self.commands = []
+
+    async def sh(self, line, cwd=None, env=None, output=None, control=None):
+        self.commands.append((line, cwd, env))
+        return self.codes.get(line, 0)
+
+
+class TestAsyncEngine(unittest.TestCase):
+
+    engine_class = aioworker.AsyncEngine
+    worker_class = SleepWorker
+
+    def setUp(self):
+        apps_sts = {}
+        for i in range(20):
+            s = core.AppSetting(
+                'app{}'.format(i), src_path='/tmp/src', repo='repo')
+            apps_sts[s.name] = s
+        self.router = core.TaskRouter.new(apps_sts)
+        self.finished = threading.Semaphore(0)
+
+        put_finished = self.router.put_finished
+
+        def put_and_count(task):
+            put_finished(task)
+            self.finished.release()
+        self.router.put_finished = put_and_count
+
+        executors = {
+            name: self.worker_class(None, name, self.router)
+            for name in apps_sts
+        }
+        self.engine = self.engine_class(None, self.router, executors)
+        self.engine.daemon = True
+        self.engine.start()
+
+    def put(self, app_name, command):
+        task = core.Task(app_name, command)
+        task.env = self.router.apps_sts[app_name]
+        self.router.put_new(task)
+        return task
+
+    def wait(self, count):
+        for _ in range(count):
+            self.assertTrue(self.finished.acquire(timeout=5))
+
+
+class TestAsyncEngineSteps(TestAsyncEngine):
+
+    def test_concurrent_tasks(self):
+        tasks = [self.put(name, 'sleep') for name in self.router.new]
+        self.wait(len(tasks))
+
+        for t in tasks:
+            self.assertEqual(t.status, core.TaskStatus.success)
+        # All the 0.2s steps overlapped
+        elapsed = max(t.finish for t in tasks) - min(t.taken for t in tasks)
+        self.assertLess(elapsed, 2)
+
+    def test_plain_and_failing_steps(self):
+        plain = self.put('app0', 'plain')
+        coroutine = self.put('app1', 'coroutine')
+        fail = self.put('app2', 'fail')
+        missing = self.put('app3', 'missing')
+        self.wait(4)
+
+        self.assertEqual(plain.status, core.TaskStatus.success)
+        self.assertEqual(coroutine.status, core.TaskStatus.success)
+        self.assertEqual(fail.status, core.TaskStatus.failure)
+        self.assertEqual(missing.status, core.TaskStatus.failure)
+
+    def test_capture_output(self):
+        self.router.logs = tasklog.TaskLogs(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.router.logs.path)
+        task = self.put('app0', 'echo')
+        self.wait(1)
+
+        data, _, done = task.output.read()
+        self.assertEqual(data, b'$ echo hello\nhello\n')
+        self.assertTrue(done)
+
+    def test_operation_not_returning_task_frees_slot(self):
+        first = self.put('app0', 'no_return')
+        second = self.put('app0', 'plain')
+        self.wait(2)
+
+        self.assertEqual(first.status, core.TaskStatus.failure)
+        self.assertEqual(second.status, core.TaskStatus.success)
+        self.assertEqual(self.router.running['app0'], [])
+
+
+class TestAsyncElixirWorker(TestAsyncEngine):
+
+    engine_class = FakeShellEngine
+    worker_class = ElixirCIWorker
+
+    def tearDown(self):
+        FakeShellEngine.codes = {}
+
+    def test_build(self):
+        task = self.put('app0', 'build')
+        self.wait(1)
+
+        self.assertEqual(task.status, core.TaskStatus.success)
+        lines = [c[0] for c in self.engine.commands]
+        self.assertEqual(lines, ['mix deps.get', 'mix release'])
+        self.assertEqual(self.engine.commands[0][1], '/tmp/src/app0')
+        self.assertEqual(self.engine.commands[1][2]['MIX_ENV'], 'prod')
+
+    def test_failed_release(self):
+        FakeShellEngine.codes = {'mix release': 1}
+        task = self.put('app0', 'build')
+        self.wait(1)
+
+        self.assertEqual(task.status, core.TaskStatus.failure)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+import os
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+from ciex import core
+from ciex import context
+from ciex import artifacts
+from ciex.contrib.workers.elixir import ElixirCIWorker
+
+from helpers import git, write, read
+
+
+class TestArtifactStore(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.src = os.path.join(self.dir, 'rel')
+        self.store = artifacts.ArtifactStore(os.path.join(self.dir, 'app'))
+
+    def release(self, tag, files):
+        if os.path.exists(self.src):
+            shutil.rmtree(self.src)
+        for name, content in files.items():
+            write(os.path.join(self.src, name), content)
+        return self.store.add(tag, self.src)
+
+    def test_identical_files_are_stored_once(self):
+        self.release('v1', {'bin/app': 'run', 'lib/a.beam': 'a1'})
+        self.release('v2', {'bin/app': 'run', 'lib/a.beam': 'a2'})
+
+        v1 = os.stat(os.path.join(self.store.release_path('v1'), 'bin/app'))
+        v2 = os.stat(os.path.join(self.store.release_path('v2'), 'bin/app'))
+        self.assertEqual(v1.st_ino, v2.st_ino)
+        self.assertEqual(
+            read(os.path.join(self.store.release_path('v2'), 'lib/a.beam')),
+            'a2')
+        self.assertEqual(self.store.releases(), ['v1', 'v2'])
+
+    def test_permissions_are_kept(self):
+        write(os.path.join(self.src, 'bin/app'), 'run')
+        os.chmod(os.path.join(self.src, 'bin/app'), 0o755)
+        self.store.add('v1', self.src)
+
+        mode = os.stat(
+            os.path.join(self.store.release_path('v1'), 'bin/app')).st_mode
+        self.assertEqual(mode & 0o777, 0o755)
+
+    def test_activate_and_previous(self):
+        self.release('v1', {'a': '1'})
+        self.release('v2', {'a': '2'})
+        self.assertIsNone(self.store.current())
+
+        self.store.activate('v2')
+        self.assertEqual(self.store.current(), 'v2')
+        self.assertEqual(read(os.path.join(self.store.current_path, 'a')), '2')
+        self.assertEqual(self.store.previous(), 'v1')
+
+        self.store.activate('v1')
+        self.assertEqual(read(os.path.join(self.store.current_path, 'a')), '1')
+        self.assertIsNone(self.store.previous())
+
+        with self.assertRaises(ValueError):
+            self.store.activate('v3')
+
+    def test_gc(self):
+        for i in range(5):
+            self.release('v{}'.format(i), {'a': str(i), 'same': 'same'})
+        self.store.activate('v1')
+
+        removed = self.store.gc(keep=2)
+        self.assertEqual(self.store.releases(), ['v0', 'v1', 'v3', 'v4'])
+        self.assertEqual(removed, 1)  # the `a` of v2
+
+        self.store.activate('v4')
+        self.store.gc(keep=2)
+        self.assertEqual(self.store.releases(), ['v3', 'v4'])
+        objects = sum(
+            len(files) for _, _, files in os.walk(self.store.objects_path))
+        self.assertEqual(objects, 3)
+
+
+class TestElixirReleases(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.env = core.AppSetting(
+            'app', src_path=os.path.join(self.dir, 'src'),
+            install_path=os.path.join(self.dir, 'install'),
+            release_keep='2')
+        self.worker = ElixirCIWorker(None, 'app', None)
+        self.worker.sh = self.sh
+        self.builds = 0
+        self.repo = os.path.join(self.dir, 'src', 'app')
+        os.makedirs(self.repo)
+        git(self.repo, 'init', '-q')
+
+    def commit(self, message):
+        git(self.repo, 'commit', '-q', '--allow-empty', '-m', message)
+
+    def sh(self, line, cwd=None, env=None, output=None, control=None):
+        if line == 'mix release':
+            self.builds += 1
+            write(os.path.join(cwd, 'rel', 'app', 'bin', 'app'),
+                  'build {}'.format(self.builds))
+        return 0
+
+    def run_task(self, command):
+        task = core.Task('app', command, env=self.env)
+        return self.worker.execute(task)
+
+    def current_bin(self):
+        task = core.Task('app', 'start', env=self.env)
+        return read(os.path.join(context.release_bin_path(task), 'app'))
+
+    def test_upgrade_and_downgrade(self):
+        for message in ('one', 'two'):
+            self.commit(message)
+            self.assertEqual(
+                self.run_task('build').status, core.TaskStatus.success)
+
+        self.assertEqual(self.run_task('upgrade').status,
+                         core.TaskStatus.success)
+        self.assertEqual(self.current_bin(), 'build 2')
+
+        self.assertEqual(self.run_task('downgrade').status,
+                         core.TaskStatus.success)
+        self.assertEqual(self.current_bin(), 'build 1')
+
+        task = self.run_task('downgrade')
+        self.assertEqual(task.status, core.TaskStatus.failure)
+        self.assertEqual(task.error, 'no previous release')
+
+    def test_build_stores_releases(self):
+        for message in ('one', 'two', 'three'):
+            self.commit(message)
+            self.run_task('build')
+
+        store = artifacts.app_store(self.env)
+        head = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=self.repo).decode().strip()
+        self.assertEqual(len(store.releases()), 2)  # release_keep
+        self.assertEqual(store.releases()[-1], head[:12])
+
+    def test_upgrade_without_release(self):
+        task = self.run_task('upgrade')
+        self.assertEqual(task.status, core.TaskStatus.failure)
+        self.assertEqual(task.error, 'no release stored')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from ciex import core
+from ciex import buildcache
+from ciex.contrib.workers.elixir import ElixirCIWorker
+
+from helpers import git, write
+
+
+class TestElixirBuildCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.repo = os.path.join(self.dir, 'src', 'app')
+        os.makedirs(self.repo)
+        git(self.repo, 'init', '-q')
+        write(os.path.join(self.repo, 'mix.lock'), 'deps v1')
+        write(os.path.join(self.repo, '.gitignore'), 'deps\n')
+        self.commit('first')
+
+        self.env = core.AppSetting(
+            'app', src_path=os.path.join(self.dir, 'src'),
+            build_cache_path=os.path.join(self.dir, 'cache'))
+        self.worker = ElixirCIWorker(None, 'app', None)
+        self.worker.sh = self.sh
+        self.commands = []
+
+    def commit(self, message):
+        git(self.repo, 'add', '-A')
+        git(self.repo, 'commit', '-q', '-m', message)
+
+    def sh(self, line, cwd=None, env=None, output=None, control=None):
+        self.commands.append(line)
+        if line == 'mix deps.get':
+            deps = os.path.join(cwd, 'deps')
+            if not os.path.exists(deps):
+                os.makedirs(deps)
+            write(os.path.join(deps, 'dep.ex'), 'x' * 100)
+        return 0
+
+    def build(self):
+        self.commands = []
+        task = core.Task('app', 'build', env=self.env)
+        task = self.worker.execute(task)
+        self.assertEqual(task.status, core.TaskStatus.success)
+        return self.commands
+
+    def test_skip_same_commit(self):
+        self.assertEqual(self.build(), ['mix deps.get', 'mix release'])
+        self.assertEqual(self.build(), [])
+
+    def test_reuse_deps_when_only_code_changed(self):
+        self.build()
+        write(os.path.join(self.repo, 'app.ex'), 'code')
+        self.commit('code')
+        self.assertEqual(self.build(), ['mix release'])
+
+        # Deps are restored from the cache after a fresh checkout
+        shutil.rmtree(os.path.join(self.repo, 'deps'))
+        write(os.path.join(self.repo, 'app.ex'), 'more code')
+        self.commit('more code')
+        self.assertEqual(self.build(), ['mix release'])
+        self.assertTrue(
+            os.path.exists(os.path.join(self.repo, 'deps', 'dep.ex')))
+
+        # New lockfile: fetch deps again
+        write(os.path.join(self.repo, 'mix.lock'), 'deps v2')
+        self.commit('deps')
+        self.assertEqual(self.build(), ['mix deps.get', 'mix release'])
+
+    def test_lru_eviction(self):
+        cache = buildcache.BuildCache(os.path.join(self.dir, 'c'), 250)
+        deps = os.path.join(self.repo, 'deps')
+        os.makedirs(deps)
+        write(os.path.join(deps, 'dep.ex'), 'x' * 100)
+        for i in range(4):
+            write(os.path.join(self.repo, 'mix.lock'), 'v{}'.format(i))
+            cache.save_deps(self.repo, ['mix.lock'], ['deps'])
+
+        self.assertLessEqual(buildcache.dir_size(cache.deps_path), 250)
+        self.assertTrue(cache.restore_deps(self.repo, ['mix.lock'], ['deps']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+import oi
+
+from ciex import core
+from ciex import compat
+from ciex import config
+
+from helpers import write
+
+
+APP = '''
+[settings.app.{name}]
+repo = git@github.com:walkr/test.git
+src_path = /tmp/ciex
+install_path = /tmp/ciex/installs
+worker_dirpath = .
+worker_modname = .
+worker_classname = ElixirCIWorker
+{extra}
+'''
+
+
+class TestConfigFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'a.conf')
+        self.parsed = []
+
+    def parse(self, sections):
+        self.parsed.append([s.name for s in sections])
+        return len(self.parsed)
+
+    def test_parse_once_until_changed(self):
+        files = config.ConfigFiles()
+        write(self.path, '[one]\nx = 1\n')
+        self.assertEqual(files.load(self.path, self.parse), 1)
+        self.assertEqual(files.load(self.path, self.parse), 1)
+
+        write(self.path, '[one]\nx = 1\n[two]\n')
+        self.assertEqual(files.load(self.path, self.parse), 2)
+        self.assertEqual(self.parsed, [['one'], ['one', 'two']])
+
+    def test_keep_last_good_version(self):
+        files = config.ConfigFiles()
+        write(self.path, '[one]\n')
+        files.load(self.path, self.parse)
+
+        write(self.path, '[one]\n[one]\n')
+        self.assertEqual(files.load(self.path, self.parse), 1)
+        with self.assertRaises(compat.configparser.Error):
+            config.ConfigFiles().load(self.path, self.parse)
+
+    def test_expand(self):
+        for name in ('b.conf', 'a.conf', 'c.txt'):
+            write(os.path.join(self.dir, name), '')
+        paths = config.expand([
+            os.path.join(self.dir, '*.conf'), os.path.join(self.dir, 'a*')])
+        self.assertEqual(
+            [os.path.basename(p) for p in paths], ['a.conf', 'b.conf'])
+
+
+class TestIncludes(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.program = oi.Program('test program', None)
+        self.program.config = compat.configparser.ConfigParser()
+        self.program.config.read_string(
+            '[settings]\ninclude = {}\n'.format(
+                os.path.join(self.dir, '*.conf')) + APP.format(
+                name='main', extra=''))
+        self.core = core.Core(self.program)
+
+    def write_apps(self, name, apps, extra=''):
+        write(os.path.join(self.dir, name), ''.join(
+            APP.format(name=app, extra=extra) for app in apps))
+
+    def test_included_apps(self):
+        self.write_apps('a.conf', ['a1', 'a2'])
+        self.write_apps('b.conf', ['b1'])
+        self.core.initialize()
+        self.assertEqual(
+            sorted(self.core.list()), ['a1', 'a2', 'b1', 'main'])
+
+    def test_unchanged_files_keep_their_settings(self):
+        self.write_apps('a.conf', ['a1'])
+        self.write_apps('b.conf', ['b1'])
+        apps_sts = self.core.load_apps_sts(self.program.config)
+
+        time.sleep(0.01)
+        self.write_apps('b.conf', ['b1'], extra='weight = 2')
+        reloaded = self.core.load_apps_sts(self.program.config)
+        self.assertIs(reloaded['a1'], apps_sts['a1'])
+        self.assertEqual(reloaded['b1'].weight, 2)
+
+    def test_broken_sections_disable_their_app(self):
+        self.write_apps('a.conf', ['a1'])
+        self.write_apps('b.conf', ['b1'], extra='worker_concurrency = x')
+        self.write_apps('c.conf', ['a1', 'c1'])
+        write(os.path.join(self.dir, 'd.conf'), 'no section')
+
+        result = self.core.reload()
+        self.assertTrue(result.startswith('ok, disabled: '), result)
+        self.assertEqual(sorted(self.core.list()), ['a1', 'c1', 'main'])
+        self.assertEqual(
+            set(self.core.config_errors),
+            {'a1', 'b1', os.path.join(self.dir, 'd.conf')})
+
+    def test_broken_worker_disables_its_app(self):
+        self.write_apps('a.conf', ['a1'])
+        self.program.config['settings.app.main']['worker_classname'] = 'No'
+        self.core.initialize()
+
+        self.assertIn('main', self.core.config_errors)
+        self.assertIn('a1', self.core.app_workers)
+        ok, reason = self.core.create_task('main', 'build')
+        self.assertFalse(ok)
+        self.assertTrue(reason.startswith('Cannot load the worker'))
+
+
+if __name__ == '__main__':
+    unittest.main()
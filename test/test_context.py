@@ -0,0 +1,83 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from ciex import core
+from ciex import error
+from ciex import context
+from ciex.worker import CIWorker, Command
+
+
+class Section(dict):
+    name = 'settings.app.app'
+
+
+class TestCommandEnv(unittest.TestCase):
+
+    def test_layers(self):
+        env = core.AppSetting('app', command_env='PORT=4000, MIX_ENV=test')
+        task = core.Task('app', 'build', env=env)
+
+        variables = context.command_env(task, MIX_ENV='prod', LANG='C')
+        self.assertEqual(variables['PORT'], '4000')
+        self.assertEqual(variables['MIX_ENV'], 'test')
+        self.assertEqual(variables['LANG'], 'C')
+        self.assertEqual(variables['PATH'], os.environ['PATH'])
+
+    def test_parse(self):
+        self.assertEqual(core.parse_env(''), {})
+        self.assertEqual(
+            core.parse_env('A=1, B = x=y'), {'A': '1', 'B': 'x=y'})
+        with self.assertRaises(ValueError):
+            core.parse_env('A')
+
+    def test_validate(self):
+        section = Section(
+            repo='r', src_path='/s', install_path='/i', worker_dirpath='.',
+            worker_modname='m', worker_classname='C', command_env='A')
+        with self.assertRaises(error.AppSettingError):
+            core.AppSetting.validate(section)
+
+
+class PwdWorker(CIWorker):
+
+    def pwd(self, task):
+        yield Command('sleep 0.2; pwd > pwd; echo $APP_DIR > env',
+                      task.env.src_path)
+        task.success()
+
+
+class TestNoChdir(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def test_parallel_tasks_keep_their_cwd(self):
+        cwd = os.getcwd()
+        tasks = []
+        for i in range(4):
+            path = os.path.realpath(os.path.join(self.dir, str(i)))
+            os.makedirs(path)
+            env = core.AppSetting(
+                str(i), src_path=path, command_env='APP_DIR=' + path)
+            tasks.append(core.Task(str(i), 'pwd', env=env))
+
+        worker = PwdWorker(None, 'app', None)
+        threads = [threading.Thread(target=worker.execute, args=(t,))
+                   for t in tasks]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+
+        self.assertEqual(os.getcwd(), cwd)
+        for task in tasks:
+            self.assertEqual(task.status, core.TaskStatus.success)
+            for name in ('pwd', 'env'):
+                with open(os.path.join(task.env.src_path, name)) as fh:
+                    self.assertEqual(fh.read().strip(), task.env.src_path)
+
+
+if __name__ == '__main__':
+    unittest.main()
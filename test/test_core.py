@@ -1,10 +1,17 @@
+import os
 import time
+import shutil
+import tempfile
 import unittest
+import threading
 
 
 from ciex import core
 from ciex import error
 from ciex import compat
+from ciex import util
+from ciex import worker
+from ciex.contrib.workers import elixir
 
 import oi
 
@@ -32,6 +39,17 @@ class TestAppSetting(unittest.TestCase):
         with self.assertRaises(error.AppSettingError):
             core.AppSetting.new(section)
 
+    def test_options(self):
+        s = core.AppSetting('app', src_path='/src', worker_concurrency='2')
+        self.assertEqual(s.src_path, '/src')
+        self.assertEqual(s.worker_concurrency, 2)
+        self.assertIsNone(getattr(s, 'build_cache_path', None))
+        self.assertFalse(hasattr(s, '__dict__'))
+
+        self.assertEqual(s, core.AppSetting(
+            'app', src_path='/src', worker_concurrency='2'))
+        self.assertNotEqual(s, core.AppSetting('app', src_path='/other'))
+
 
 class TestTask(unittest.TestCase):
 
@@ -54,6 +72,11 @@ class TestTask(unittest.TestCase):
         self.assertEqual(self.t.status, core.TaskStatus.success)
         self.assertIsNotNone(self.t.finish)
 
+    def test_slots(self):
+        self.assertFalse(hasattr(self.t, '__dict__'))
+        with self.assertRaises(AttributeError):
+            self.t.unknown = 1
+
     def test_finished(self):
         time.sleep(0.01)
         self.t.finished()
@@ -87,6 +110,7 @@ class TaskRouter(unittest.TestCase):
         t = self.router.take_new('appname1')
         self.assertEqual(t.status, core.TaskStatus.pending)
         self.assertIsInstance(t, core.Task)
+        self.assertIsNotNone(t.taken)
 
     def test_put_finished_task(self):
         self.test_put_new()
@@ -101,6 +125,322 @@ class TaskRouter(unittest.TestCase):
             self.router.put_finished(t)
 
 
+class TestTaskRouterConcurrency(unittest.TestCase):
+
+    def new_router(self, **kwargs):
+        s = core.AppSetting('app', **kwargs)
+        return core.TaskRouter.new({'app': s})
+
+    def test_exclusive_by_default(self):
+        router = self.new_router(worker_concurrency='2')
+        router.put_new(core.Task('app', 'build'))
+        router.put_new(core.Task('app', 'stop'))
+
+        router.take_new('app')
+        self.assertFalse(router.runnable('app'))
+
+    def test_parallel_tasks(self):
+        router = self.new_router(
+            worker_concurrency='2', parallel_commands='*')
+        router.put_new(core.Task('app', 'build'))
+        router.put_new(core.Task('app', 'build'))
+        router.put_new(core.Task('app', 'build'))
+
+        router.take_new('app')
+        router.take_new('app')
+        self.assertEqual(len(router.running['app']), 2)
+        self.assertFalse(router.runnable('app'))
+
+    def test_exclusive_command(self):
+        router = self.new_router(
+            worker_concurrency='2', parallel_commands='build')
+        router.put_new(core.Task('app', 'build'))
+        router.put_new(core.Task('app', 'deploy'))
+
+        t = router.take_new('app')
+        self.assertFalse(router.runnable('app'))
+
+        router.put_finished(t.success())
+        self.assertTrue(router.runnable('app'))
+        self.assertEqual(router.take_new('app').command, 'deploy')
+
+    def test_last_is_newest_task(self):
+        router = self.new_router(
+            worker_concurrency='2', parallel_commands='build')
+        router.put_new(core.Task('app', 'build', start=1))
+        router.put_new(core.Task('app', 'build', start=2))
+
+        first = router.take_new('app')
+        second = router.take_new('app')
+        router.put_finished(first.success())
+        self.assertIs(router.last['app'], second)
+
+    def test_take_next_round_robin(self):
+        apps_sts = {
+            'a': core.AppSetting('a'),
+            'b': core.AppSetting('b'),
+        }
+        router = core.TaskRouter.new(apps_sts)
+        router.put_new(core.Task('a', 'build'))
+        router.put_new(core.Task('a', 'build'))
+        router.put_new(core.Task('b', 'build'))
+
+        names = [router.take_next().app_name for _ in range(2)]
+        self.assertEqual(sorted(names), ['a', 'b'])
+
+
+    def test_batch_max_parallel(self):
+        apps_sts = {n: core.AppSetting(n) for n in ('a', 'b', 'c')}
+        router = core.TaskRouter.new(apps_sts)
+        batch = core.Batch(2)
+        tasks = [core.Task(n, 'build', env=apps_sts[n]) for n in 'abc']
+        for task in tasks:
+            task.batch = batch
+        results = router.admit_all(tasks)
+        self.assertEqual([ok for ok, _ in results], [True] * 3)
+
+        first = router.take_next()
+        router.take_next()
+        self.assertFalse(any(router.runnable(n) for n in 'abc'))
+        router.put_finished(first.success())
+        self.assertEqual(sum(router.runnable(n) for n in 'abc'), 1)
+
+    def test_resource_budget(self):
+        apps_sts = {n: core.AppSetting(
+            n, command_cpu='build:3', command_memory_mb='*:512')
+            for n in 'abc'}
+        router = core.TaskRouter.new(apps_sts)
+        router.budget.configure(cpu=4, memory=2048)
+        for name in 'ab':
+            router.put_new(core.Task(name, 'build'))
+
+        first = router.take_next()
+        self.assertEqual(first.cost, (3, 512))
+        self.assertFalse(any(router.runnable(n) for n in 'ab'))
+
+        # A task without cpu cost fits next to it
+        router.put_new(core.Task('c', 'deploy'))
+        self.assertEqual(router.take_next().command, 'deploy')
+        self.assertEqual(router.budget.memory_used, 1024)
+
+        router.put_finished(first.success())
+        self.assertIsNone(first.cost)
+        self.assertEqual(router.budget.cpu_used, 0)
+        self.assertEqual(sum(router.runnable(n) for n in 'ab'), 1)
+
+    def test_expensive_task_not_starved(self):
+        apps_sts = {
+            'big': core.AppSetting('big', command_cpu='build:4'),
+            'a': core.AppSetting('a', command_cpu='build:1'),
+            'b': core.AppSetting('b', command_cpu='build:1')}
+        router = core.TaskRouter.new(apps_sts)
+        router.budget.configure(cpu=4)
+        router.budget.reserve_after = 2
+        for name in ['a', 'b', 'big']:
+            router.put_new(core.Task(name, 'build'))
+        running = [router.take_next(['a', 'b']) for _ in range(2)]
+
+        # Cheap tasks keep being taken while the expensive one waits...
+        for i in range(2):
+            self.assertFalse(router.runnable('big'))
+            done = running.pop(0)
+            router.put_finished(done.success())
+            router.put_new(core.Task(done.app_name, 'build'))
+            running.append(router.take_next(['a', 'b']))
+        # ...until the budget is kept for it
+        self.assertFalse(router.runnable('big'))
+        self.assertIs(router.budget.reserved, router.new['big'][0])
+        for task in running:
+            router.put_finished(task.success())
+            router.put_new(core.Task(task.app_name, 'build'))
+        self.assertFalse(router.runnable('a'))
+        self.assertEqual(router.take_next().app_name, 'big')
+        self.assertIsNone(router.budget.reserved)
+
+    def test_reservation_dropped_on_cancel(self):
+        apps_sts = {n: core.AppSetting(n, command_cpu='build:1')
+                    for n in 'ab'}
+        apps_sts['big'] = core.AppSetting('big', command_cpu='build:4')
+        router = core.TaskRouter.new(apps_sts)
+        router.budget.configure(cpu=4)
+        for name in ['a', 'big', 'b']:
+            router.put_new(core.Task(name, 'build'))
+        router.take_next(['a'])
+        router.budget.reserved = router.new['big'][0]
+        self.assertFalse(router.runnable('b'))
+
+        router.cancel('big')
+        self.assertTrue(router.runnable('b'))
+        self.assertIsNone(router.budget.reserved)
+
+
+class TestTaskRouterScheduling(unittest.TestCase):
+
+    def setUp(self):
+        self.apps_sts = {
+            'a': core.AppSetting('a', weight='3'),
+            'b': core.AppSetting('b'),
+        }
+        self.router = core.TaskRouter.new(self.apps_sts)
+
+    def test_priority_order(self):
+        for command in ['build', 'upgrade', 'stop', 'deploy', 'downgrade']:
+            self.router.put_new(core.Task('a', command))
+        commands = [t.command for t in self.router.new['a']]
+        self.assertEqual(
+            commands, ['stop', 'downgrade', 'build', 'upgrade', 'deploy'])
+
+    def test_urgent_task_first(self):
+        self.router.put_new(core.Task('a', 'build'))
+        self.router.put_new(core.Task('b', 'stop'))
+        self.assertEqual(self.router.take_next().app_name, 'b')
+
+    def test_weighted_fair_share(self):
+        for i in range(40):
+            self.router.put_new(core.Task('a', 'build{}'.format(i)))
+            self.router.put_new(core.Task('b', 'build{}'.format(i)))
+
+        names = []
+        for _ in range(20):
+            task = self.router.take_next()
+            names.append(task.app_name)
+            self.router.put_finished(task.success())
+        self.assertEqual(names.count('a'), 15)
+        self.assertEqual(names.count('b'), 5)
+
+    def test_queue_waits(self):
+        self.router.put_new(core.Task('a', 'build'))
+        self.router.take_next()
+        waits = self.router.queue_waits()
+        self.assertEqual(waits['a']['build']['count'], 1)
+        self.assertGreaterEqual(waits['a']['build']['p95'], 0)
+
+    def test_busy_app_is_passed(self):
+        self.router.put_new(core.Task('a', 'build'))
+        self.router.put_new(core.Task('a', 'deploy'))
+        self.router.put_new(core.Task('b', 'deploy'))
+
+        first = self.router.take_next()
+        self.assertEqual(first.app_name, 'a')
+        self.assertEqual(self.router.take_next().app_name, 'b')
+        self.router.put_finished(first.success())
+        self.assertEqual(self.router.take_next().command, 'deploy')
+
+    def test_priorities_changed(self):
+        self.router.put_new(core.Task('a', 'build'))
+        self.router.put_new(core.Task('b', 'deploy'))
+        self.router.set_priorities({'deploy': 0})
+        self.assertEqual(self.router.take_next().app_name, 'b')
+
+
+class TestTaskRouterWaiters(unittest.TestCase):
+    """ A new task only wakes the workers which can take it """
+
+    def setUp(self):
+        self.router = core.TaskRouter.new(
+            {n: core.AppSetting(n) for n in 'ab'})
+        self.taken = []
+        self.addCleanup(self.router.close)
+
+    def start(self, take, *args):
+        thread = threading.Thread(
+            target=lambda: self.taken.append(take(*args)))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def waiting(self, waiters, key, count):
+        for _ in range(500):
+            with self.router.cond:
+                if key in waiters and waiters[key][2] == count:
+                    return
+            time.sleep(0.01)
+        self.fail('{} workers are not waiting'.format(count))
+
+    def test_app_workers(self):
+        thread = self.start(self.router.take_new, 'a')
+        for _ in range(2):
+            self.start(self.router.take_new, 'b')
+        self.waiting(self.router.app_waiters, 'a', 1)
+        self.waiting(self.router.app_waiters, 'b', 2)
+        cond, wakes = self.router.app_waiters['b'][1], []
+        cond.notify = lambda n=1: wakes.append(n)
+
+        self.router.put_new(core.Task('a', 'build'))
+        thread.join(5)
+        self.assertEqual([t.app_name for t in self.taken], ['a'])
+        self.router.put_new(core.Task('b', 'build'))
+        self.assertEqual(wakes, [1])
+        del cond.notify
+
+    def test_pool_workers(self):
+        names = ['a']
+        thread = self.start(self.router.take_next, names)
+        self.waiting(self.router.pool_waiters, id(names), 1)
+
+        self.router.put_new(core.Task('b', 'build'))
+        self.waiting(self.router.pool_waiters, id(names), 1)
+        self.assertEqual(len(self.router.new['b']), 1)
+
+        self.router.put_new(core.Task('a', 'build'))
+        thread.join(5)
+        self.assertEqual([t.app_name for t in self.taken], ['a'])
+
+
+class TestCIWorker(unittest.TestCase):
+
+    def setUp(self):
+        self.commands = []
+        self.codes = {}
+        self.worker = elixir.ElixirCIWorker(None, 'app', None)
+        self.worker.sh = self.sh
+
+    def sh(self, line, cwd=None, env=None, output=None, control=None):
+        self.commands.append((line, cwd, env))
+        return self.codes.get(line, 0)
+
+    def new_task(self, command):
+        task = core.Task('app', command)
+        task.env = core.AppSetting('app', src_path='/tmp/src', repo='repo')
+        return task
+
+    def test_drive_command_steps(self):
+        task = self.worker.execute(self.new_task('build'))
+        self.assertEqual(task.status, core.TaskStatus.success)
+        self.assertEqual(
+            [c[0] for c in self.commands], ['mix deps.get', 'mix release'])
+        self.assertEqual(self.commands[0][1], '/tmp/src/app')
+
+    def test_failed_command_step(self):
+        self.codes['mix deps.get'] = 1
+        task = self.worker.execute(self.new_task('build'))
+        self.assertEqual(task.status, core.TaskStatus.failure)
+        self.assertEqual(len(self.commands), 1)
+
+
+class TestLoadWorker(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def write(self, source, mtime):
+        path = os.path.join(self.dir, 'reloaded_workers.py')
+        with open(path, 'w') as fh:
+            fh.write(source)
+        os.utime(path, (mtime, mtime))
+
+    def test_reimport_modified_module(self):
+        self.write('class W(object):\n    version = 1\n', 1000)
+        first = util.load_worker(self.dir, 'reloaded_workers', 'W')
+        same = util.load_worker(self.dir, 'reloaded_workers', 'W')
+        self.assertIs(first, same)
+
+        self.write('class W(object):\n    version = 22\n', 2000)
+        modified = util.load_worker(self.dir, 'reloaded_workers', 'W')
+        self.assertEqual(modified.version, 22)
+
+
 class TestCore(unittest.TestCase):
 
     def setUp(self):
@@ -127,14 +467,172 @@ class TestCore(unittest.TestCase):
         # Check workers
         workers = new_core.program.state.ci_workers
         self.assertEqual(len(workers), 2)
+        self.assertTrue(new_core.program.state.ci_ready.is_set())
+
+    def test_shared_worker_pool(self):
+        self.program.config['settings']['worker_pool'] = 'shared'
+        self.program.config['settings']['worker_pool_size'] = '3'
+        new_core = core.Core(self.program)
+        new_core.initialize()
+
+        workers = new_core.program.state.ci_workers
+        self.assertEqual(len(workers), 3)
+        self.assertIsInstance(workers[0], worker.CIPoolWorker)
+
+    def test_invalid_settings(self):
+        for key, value in [('worker_pool', 'shraed'),
+                           ('worker_pool_size', '-1'),
+                           ('async_max_tasks', '0'),
+                           ('cpu_budget', '-1'),
+                           ('memory_budget_mb', 'lots'),
+                           ('resource_probe', 'yes')]:
+            self.program.config['settings'][key] = value
+            with self.assertRaises(error.AppSettingError):
+                core.Core(self.program).initialize()
+            del self.program.config['settings'][key]
+
+    def test_control_worker_starts_and_reload_replaces_workers(self):
+        control = worker.CIControlWorker(self.program)
+        control.daemon = True
+        control.start()
+        self.addCleanup(self.core.task_router.close)
+
+        old_workers = self.program.state.ci_workers
+        self.wait_alive(old_workers)
+
+        # Nothing changed: the workers are kept
+        self.core.reload()
+        self.assertEqual(self.program.state.ci_workers, old_workers)
+
+        # Only the workers of the modified app are replaced
+        self.program.config['settings.app.appname1'][
+            'worker_concurrency'] = '2'
+        self.core.reload()
+        new_workers = self.program.state.ci_workers
+        self.assertEqual(len(new_workers), 3)
+        old1, old2 = sorted(old_workers, key=lambda w: w.app_name)
+        self.assertIn(old2, new_workers)
+        old1.join(timeout=5)
+        self.assertFalse(old1.is_alive())
+        self.wait_alive(new_workers)
+
+    def test_control_worker_initializes_the_core(self):
+        program = oi.Program('Test program', None)
+        program.config = self.program.config
+        program.config['settings']['metrics_address'] = '127.0.0.1:0'
+        self.addCleanup(program.config.remove_option,
+                        'settings', 'metrics_address')
+        ci_core = core.Core(program)
+        control = worker.CIControlWorker(program, ci_core)
+        control.daemon = True
+        control.start()
+
+        for _ in range(500):
+            if ci_core.initialized:
+                break
+            time.sleep(0.01)
+        self.addCleanup(ci_core.task_router.close)
+        self.wait_alive(program.state.ci_workers)
+        # Served without waiting for a command
+        self.addCleanup(ci_core.metrics_server.server_close)
+        self.addCleanup(ci_core.metrics_server.shutdown)
+
+    def wait_alive(self, workers):
+        for _ in range(500):
+            if all(w.is_alive() for w in workers):
+                break
+            time.sleep(0.01)
+        self.assertTrue(all(w.is_alive() for w in workers))
+
+    def test_reload_keeps_queued_tasks(self):
+        ok, task = self.core.create_task('appname2', 'build')
+        self.core.reload()
+        self.assertIn(task, self.core.task_router.new['appname2'])
+
+    def test_reload_keeps_running_tasks(self):
+        self.core.build('appname1')
+        task = self.core.task_router.take_new('appname1')
+        self.program.config['settings.app.appname1']['weight'] = '2'
+        self.core.reload()
+
+        self.core.task_router.put_finished(task.success())
+        self.assertIs(self.core.task_router.last['appname1'], task)
+        self.assertEqual(self.core.task_router.running['appname1'], [])
+
+    def test_reload_removes_apps(self):
+        self.core.build('appname2')
+        self.program.config.remove_section('settings.app.appname2')
+        self.core.reload()
+
+        self.assertEqual(self.core.list(), ['appname1'])
+        workers = self.program.state.ci_workers
+        self.assertEqual([w.app_name for w in workers], ['appname1'])
+        self.assertIsNone(self.core.task_router.take_new('appname2'))
+
+    def test_lazy_worker(self):
+        self.program.config['settings.app.appname2']['lazy'] = 'true'
+        new_core = core.Core(self.program)
+        new_core.initialize()
+        self.assertNotIn('appname2', new_core.app_workers)
 
-    def create_task(self):
+        ok, task = new_core.create_task('appname2', 'build')
+        self.assertTrue(ok)
+        self.assertIn('appname2', new_core.app_workers)
+        self.assertEqual(len(self.program.state.ci_workers), 2)
+
+    def test_create_task(self):
         ok, task = self.core.create_task('appname1', 'command')
         self.assertTrue(ok)
         self.assertIsNotNone(task.env)
 
-        ok, task = self.core.create_task('appname1', 'command')
+        # Identical queued task: coalesced
+        ok, same = self.core.create_task('appname1', 'command')
+        self.assertTrue(ok)
+        self.assertIs(same, task)
+        self.assertEqual(len(self.core.task_router.new['appname1']), 1)
+
+        # Identical pending task: rejected
+        self.core.task_router.take_new('appname1')
+        ok, res = self.core.create_task('appname1', 'command')
         self.assertFalse(ok)
+        self.assertFalse(self.core.task_router.approve_new(
+            core.Task('appname1', 'command')))
+        self.assertTrue(self.core.task_router.approve_new(
+            core.Task('appname1', 'other')))
+
+    def test_batch_commands(self):
+        res = self.core.build('appname*', 'missing')
+        self.assertEqual(sorted(res), ['appname1', 'appname2', 'missing'])
+        self.assertTrue(res['appname1'][0])
+        self.assertTrue(res['appname2'][0])
+        self.assertEqual(res['missing'], (False, 'No such app'))
+
+        # Already queued (coalesced), or refused once taken
+        self.core.task_router.take_new('appname1')
+        res = self.core.build('all', 'max_parallel=1')
+        self.assertFalse(res['appname1'][0])
+        self.assertTrue(res['appname2'][0])
+        # Coalesced into the task of the first batch (no limit)
+        queued = self.core.task_router.new['appname2'][0]
+        self.assertEqual(queued.batch.limit, 0)
+
+        res = self.core.upgrade('all', 'max_parallel=1')
+        batch = self.core.task_router.new['appname1'][-1].batch
+        self.assertEqual(batch.limit, 1)
+        self.assertIn('Err', self.core.upgrade('all', 'max_parallel=x'))
+
+    def test_max_queue(self):
+        router = self.core.task_router
+        router.apps_sts['appname1'].max_queue = 2
+        router.apps_sts['appname1'].coalesce = False
+
+        self.assertTrue(self.core.create_task('appname1', 'build')[0])
+        ok, res = self.core.create_task('appname1', 'build')
+        self.assertFalse(ok)
+        self.assertTrue(self.core.create_task('appname1', 'stop')[0])
+        ok, res = self.core.create_task('appname1', 'deploy')
+        self.assertFalse(ok)
+        self.assertIn('full', res)
 
     def test_ci_commands_with_tasks(self):
         app_name = 'appname1'
@@ -144,6 +642,54 @@ class TestCore(unittest.TestCase):
             self.assertTrue(ok)
             self.assertTrue('pending' in res)
 
+    def test_log(self):
+        res = self.core.log('appname1')
+        self.assertTrue(res['done'])
+
+        self.core.build('appname1')
+        task = self.core.task_router.take_new('appname1')
+        task.output.write(b'compiling')
+        res = self.core.log('appname1', '3')
+        self.assertEqual(res['data'], 'piling')
+        self.assertEqual(res['offset'], 9)
+        self.assertFalse(res['done'])
+
+        for offset in ('abc', '-1'):
+            self.assertTrue(
+                self.core.log('appname1', offset).startswith('Err'))
+        self.assertTrue(self.core.log('nope').startswith('Err'))
+
+    def test_metrics(self):
+        self.core.build('appname1')
+        text = self.core.metrics()
+        self.assertIn('ciex_queue_depth{app="appname1"} 1\n', text)
+        self.assertIn('ciex_workers 2\n', text)
+        self.assertIn('ciex_resources_used{resource="cpu"} 0', text)
+
+    def test_push_during_build_queues_one_more(self):
+        router = self.core.task_router
+        self.core.build('appname1')
+        running = router.take_new('appname1')
+        for commit in ('a' * 40, 'b' * 40):
+            self.core.webhook_trigger('appname1', 'build', commit)
+        self.assertEqual(
+            [t.command for t in router.new['appname1']], ['build'])
+        follow_up = router.new['appname1'][0]
+
+        # Only pushes get a follow-up, a build command is still refused
+        router.new['appname1'].clear()
+        ok, _ = self.core.create_task('appname1', 'build')
+        self.assertFalse(ok)
+
+        router.new['appname1'].append(follow_up)
+        router.put_finished(running.success())
+        self.assertIs(router.take_new('appname1'), follow_up)
+
+    def test_unknown_pipeline(self):
+        self.assertTrue(self.core.pipeline('appname1', 'nope').startswith(
+            'Err: '))
+        self.assertEqual(len(self.core.task_router.new['appname1']), 0)
+
     def test_ci_commands_other(self):
         # List apps
         items = self.core.list()
@@ -0,0 +1,95 @@
+import time
+import unittest
+
+from ciex import fleet
+
+
+class FakeClient(object):
+
+    def __init__(self, address, failing):
+        self.address = address
+        self.failing = failing
+        self.calls = []
+
+    def call(self, command, *args):
+        self.calls.append((command,) + args)
+        time.sleep(0.05)
+        if self.address in self.failing:
+            return [False, 'There is a current pending task'], None
+        return [True, 'ok'], None
+
+
+class TestFleet(unittest.TestCase):
+
+    def new_fleet(self, count, failing=(), concurrency=64):
+        self.clients = {}
+
+        def factory(address):
+            self.clients[address] = FakeClient(address, failing)
+            return self.clients[address]
+
+        addresses = ['tcp://127.0.0.1:{}'.format(5000 + i)
+                     for i in range(count)]
+        return fleet.Fleet(addresses, concurrency, client_factory=factory)
+
+    def test_all_concurrently(self):
+        f = self.new_fleet(50)
+        report = f.run('upgrade', 'app')
+
+        self.assertEqual(report['ok'], 50)
+        self.assertEqual(report['failed'], 0)
+        self.assertLess(report['elapsed'], 1)
+        for client in self.clients.values():
+            self.assertEqual(client.calls, [('upgrade', 'app')])
+
+    def test_rolling_stops_on_failures(self):
+        f = self.new_fleet(10, failing=['tcp://127.0.0.1:5003'])
+        report = f.run('upgrade', 'app', mode='rolling', batch_size=2)
+
+        self.assertTrue(report['aborted'])
+        self.assertEqual(len(report['batches']), 2)
+        self.assertEqual(report['failed'], 1)
+        self.assertEqual(report['skipped'], 6)
+
+    def test_rolling_tolerates_max_failures(self):
+        f = self.new_fleet(10, failing=['tcp://127.0.0.1:5003'])
+        report = f.run(
+            'upgrade', 'app', mode='rolling', batch_size=2, max_failures=1)
+
+        self.assertFalse(report['aborted'])
+        self.assertEqual(report['ok'], 9)
+
+    def test_failed_canary_aborts(self):
+        f = self.new_fleet(10, failing=['tcp://127.0.0.1:5000'])
+        report = f.run('upgrade', 'app', mode='canary', max_failures=5)
+
+        self.assertTrue(report['aborted'])
+        self.assertEqual(report['skipped'], 9)
+        self.assertEqual(len(self.clients), 1)
+
+    def test_canary_then_batches(self):
+        f = self.new_fleet(7)
+        report = f.run('upgrade', 'app', mode='canary', batch_size=3)
+
+        self.assertEqual(
+            [b['size'] for b in report['batches']], [1, 3, 3])
+        self.assertEqual(report['ok'], 7)
+
+    def test_unreachable_daemon(self):
+        def factory(address):
+            raise RuntimeError('connection refused')
+        f = fleet.Fleet(['tcp://127.0.0.1:1'], client_factory=factory)
+        report = f.run('ping')
+
+        result = report['results']['tcp://127.0.0.1:1']
+        self.assertFalse(result['ok'])
+        self.assertEqual(result['err'], 'connection refused')
+
+    def test_read_addresses(self):
+        self.assertEqual(
+            fleet.read_addresses('tcp://a:1, tcp://b:2'),
+            ['tcp://a:1', 'tcp://b:2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from ciex import core
+from ciex import compat
+from ciex import history
+
+import oi
+
+
+def finished_task(app_name, command, ok, start, duration, wait=0):
+    task = core.Task(app_name, command, start=start, taken=start + wait)
+    task.success() if ok else task.failure()
+    task.finish = task.taken + duration
+    return task
+
+
+class TestMemoryHistory(unittest.TestCase):
+
+    def new_history(self):
+        return history.TaskHistory(memory_size=100)
+
+    def setUp(self):
+        self.history = self.new_history()
+        for i in range(40):
+            app_name = 'web' if i % 2 else 'api'
+            command = 'build' if i % 4 < 2 else 'upgrade'
+            self.history.add(
+                finished_task(app_name, command, i % 5, 1000 + i, i))
+
+    def tearDown(self):
+        self.history.close()
+
+    def test_query(self):
+        rows = self.history.query(app_name='web', limit=5)
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(rows[0]['start'], 1039)
+        self.assertTrue(all(r['app_name'] == 'web' for r in rows))
+
+        page2 = self.history.query(app_name='web', limit=5, offset=5)
+        self.assertEqual(page2[0]['start'], 1029)
+
+    def test_duration_without_queue_wait(self):
+        self.history.add(finished_task('db', 'build', True, 2000, 7, wait=5))
+        row = self.history.query(app_name='db')[0]
+        self.assertEqual(row['duration'], 7)
+        self.assertEqual(self.history.stats(app_name='db')['db']['p50'], 7)
+
+    def test_filters(self):
+        rows = self.history.query(status='failure', limit=100)
+        self.assertEqual(len(rows), 8)
+
+        rows = self.history.query(command='upgrade', since=1030, limit=100)
+        self.assertEqual(len(rows), 13)
+
+    def test_stats(self):
+        stats = self.history.stats()
+        self.assertEqual(sorted(stats), ['api', 'web'])
+        self.assertEqual(stats['web']['count'], 20)
+        self.assertEqual(stats['web']['p50'], 21)
+        self.assertEqual(stats['web']['p95'], 39)
+        self.assertEqual(stats['api']['failure'], 4)
+
+
+class TestDiskHistory(TestMemoryHistory):
+
+    def new_history(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        path = os.path.join(self.dir, 'history.db')
+        # A tiny ring buffer: queries must be answered from disk
+        return history.TaskHistory(path, memory_size=1, batch_size=7)
+
+    def test_compact(self):
+        self.history.max_age = time.time()
+        self.history.max_rows = 10
+        self.history.compact()
+        self.assertEqual(len(self.history.query(limit=100)), 10)
+
+        # All the (fake) tasks are older than max_age
+        self.history.max_age = 3600
+        self.history.compact()
+        self.assertEqual(self.history.query(limit=100), [])
+
+
+class TestCoreHistory(unittest.TestCase):
+
+    def setUp(self):
+        self.program = oi.Program('test program', None)
+        self.program.config = compat.configparser.ConfigParser()
+        self.program.config.read('test/samples/etc/ciex.config.sample')
+        self.core = core.Core(self.program)
+        self.core.initialize()
+
+    def test_history_commands(self):
+        router = self.core.task_router
+        for _ in range(3):
+            self.core.build('appname1')
+            router.put_finished(router.take_new('appname1').success())
+
+        rows = self.core.history('app=appname1', 'limit=2')
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[0]['command'], 'build')
+
+        stats = self.core.stats('since=60')
+        self.assertEqual(stats['appname1']['count'], 3)
+
+        self.assertTrue(self.core.history('bad').startswith('Err'))
+        for args in [('limit=abc',), ('page=0',), ('limit=0',),
+                     ('since=soon',)]:
+            self.assertTrue(self.core.history(*args).startswith('Err'))
+        self.assertTrue(self.core.stats('limit=2').startswith('Err'))
+
+
+if __name__ == '__main__':
+    unittest.main()
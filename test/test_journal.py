@@ -0,0 +1,147 @@
+import os
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+
+from ciex import core
+from ciex import compat
+from ciex import journal
+
+import oi
+
+
+class TestTaskJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'journal.log')
+        self.journal = journal.TaskJournal(self.path).open()
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.dir)
+
+    def record(self, event, task_id, app_name='app'):
+        task = core.Task(app_name, 'build', task_id=task_id)
+        return task.to_record(event)
+
+    def test_append_and_replay(self):
+        self.journal.append(self.record('new', 'a'))
+        self.journal.append(self.record('new', 'b'))
+        self.journal.append(self.record('new', 'c'))
+        self.journal.append(self.record('take', 'a'))
+        seq = self.journal.append(self.record('take', 'b'))
+        self.journal.sync(seq)
+        self.journal.append(self.record('done', 'b'))
+        self.journal.close()
+
+        queued, running, last = journal.TaskJournal(self.path).replay()
+        self.assertEqual([r['id'] for r in queued], ['c'])
+        self.assertEqual([r['id'] for r in running], ['a'])
+        self.assertEqual(last['app']['id'], 'b')
+
+    def test_truncated_record(self):
+        seq = self.journal.append(self.record('new', 'a'))
+        self.journal.sync(seq)
+        with open(self.path, 'ab') as fh:
+            fh.write(journal.pack(self.record('new', 'b'))[:-5])
+
+        queued, _, _ = journal.TaskJournal(self.path).replay()
+        self.assertEqual([r['id'] for r in queued], ['a'])
+
+    def test_compact_binary_records(self):
+        record = self.record('done', 'a')
+        record['steps'] = [{'name': 'pull', 'status': 'success'}]
+        self.assertLess(
+            len(journal.pack(record)), len(json.dumps(record)))
+        self.assertEqual(journal.unpack(
+            journal.msgpack.unpackb(journal.pack(record), raw=False)), record)
+
+    def test_group_commit(self):
+        fsyncs = []
+        fsync = os.fsync
+
+        def counting_fsync(fd):
+            fsyncs.append(fd)
+            fsync(fd)
+        journal.os.fsync = counting_fsync
+        self.addCleanup(setattr, journal.os, 'fsync', fsync)
+
+        def submit(i):
+            self.journal.sync(self.journal.append(self.record('new', i)))
+
+        threads = [
+            threading.Thread(target=submit, args=(str(i),))
+            for i in range(50)
+        ]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+
+        self.assertLess(len(fsyncs), 50)
+
+
+    def test_compact_while_running(self):
+        self.journal.close()
+        small = journal.TaskJournal(self.path, 0, compact_records=20).open()
+        self.addCleanup(small.close)
+        for i in range(30):
+            for event in ('new', 'take', 'done'):
+                small.append(self.record(event, str(i)))
+        small.append(self.record('new', 'queued'))
+        small.sync(small.append(self.record('new', 'other', 'app2')))
+
+        self.assertLess(small.records, 20)
+        queued, running, last = journal.TaskJournal(self.path).replay()
+        self.assertEqual([r['id'] for r in queued], ['queued', 'other'])
+        self.assertEqual(running, [])
+        self.assertEqual(last['app']['id'], '29')
+
+
+class TestCoreJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def new_core(self):
+        program = oi.Program('test program', None)
+        program.config = compat.configparser.ConfigParser()
+        program.config.read('test/samples/etc/ciex.config.sample')
+        program.config['settings']['journal_path'] = os.path.join(
+            self.dir, 'journal.log')
+        ci_core = core.Core(program)
+        ci_core.initialize()
+        self.addCleanup(ci_core.journal.close)
+        return ci_core
+
+    def test_restart(self):
+        ci_core = self.new_core()
+        router = ci_core.task_router
+        ci_core.build('appname1')
+        ci_core.deploy('appname1')
+        ci_core.build('appname2')
+        ci_core.deploy('appname2')
+
+        # appname1: build is running; appname2: build finished
+        router.take_new('appname1')
+        done = router.take_new('appname2')
+        router.put_finished(done.success())
+        ci_core.journal.close()
+
+        restarted = self.new_core()
+        router = restarted.task_router
+        self.assertEqual(
+            [t.command for t in router.new['appname1']], ['deploy'])
+        self.assertEqual(
+            [t.command for t in router.new['appname2']], ['deploy'])
+        self.assertEqual(router.last['appname1'].command, 'build')
+        self.assertEqual(
+            router.last['appname1'].status, core.TaskStatus.failure)
+        self.assertEqual(router.last['appname2'].id, done.id)
+        self.assertIsNotNone(router.new['appname1'][0].env)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import unittest
+
+from ciex import core
+from ciex import compat
+from ciex import metrics
+
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_render(self):
+        registry = metrics.Registry()
+        counter = registry.counter('c_total', 'A counter', ('app',))
+        histogram = registry.histogram(
+            'h_seconds', 'A histogram', ('app',), buckets=(1, 10))
+        counter.inc(('a',))
+        counter.inc(('a',), 2)
+        histogram.observe(('a',), 0.5)
+        histogram.observe(('a',), 5)
+        histogram.observe(('a',), 50)
+
+        text = registry.render()
+        self.assertIn('# TYPE c_total counter\nc_total{app="a"} 3\n', text)
+        self.assertIn('h_seconds_bucket{app="a",le="1"} 1\n', text)
+        self.assertIn('h_seconds_bucket{app="a",le="10"} 2\n', text)
+        self.assertIn('h_seconds_bucket{app="a",le="+Inf"} 3\n', text)
+        self.assertIn('h_seconds_sum{app="a"} 55.5\n', text)
+        self.assertIn('h_seconds_count{app="a"} 3\n', text)
+
+    def test_router_metrics(self):
+        s = core.AppSetting('metrics_app', coalesce='true')
+        router = core.TaskRouter.new({s.name: s})
+        key = (s.name, 'build')
+        queued = metrics.tasks_queued.get(key)
+        finished = metrics.tasks_finished.get(key + ('success',))
+        waits = metrics.task_wait.count(key)
+
+        router.admit(core.Task(s.name, 'build', env=s))
+        router.admit(core.Task(s.name, 'build', env=s))
+        task = router.take_new(s.name)
+        router.put_finished(task.success())
+
+        self.assertEqual(metrics.tasks_queued.get(key), queued + 1)
+        self.assertEqual(metrics.tasks_coalesced.get(key), 1)
+        self.assertEqual(metrics.task_wait.count(key), waits + 1)
+        self.assertEqual(
+            metrics.tasks_finished.get(key + ('success',)), finished + 1)
+
+    def test_http_endpoint(self):
+        server = metrics.serve('127.0.0.1', 0)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        url = 'http://127.0.0.1:{}/metrics'.format(server.server_address[1])
+        body = urlopen(url, timeout=5).read().decode()
+        self.assertIn('# TYPE ciex_tasks_queued_total counter', body)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from ciex import core
+from ciex import mirror
+from ciex.contrib.workers.elixir import ElixirCIWorker
+
+from helpers import git
+
+
+class TestMirror(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.remote = os.path.join(self.dir, 'remote')
+        os.makedirs(self.remote)
+        git(self.remote, 'init', '-q')
+        self.commit('first')
+
+        self.mirrors = os.path.join(self.dir, 'mirrors')
+        self.src = os.path.join(self.dir, 'src')
+        self.worker = ElixirCIWorker(None, 'app', None)
+
+    def commit(self, message):
+        with open(os.path.join(self.remote, 'file'), 'w') as fh:
+            fh.write(message)
+        git(self.remote, 'add', '-A')
+        git(self.remote, 'commit', '-q', '-m', message)
+
+    def run_task(self, app_name, command):
+        env = core.AppSetting(
+            app_name, repo=self.remote, src_path=self.src,
+            mirror_path=self.mirrors)
+        task = self.worker.execute(core.Task(app_name, command, env=env))
+        self.assertEqual(task.status, core.TaskStatus.success, task.error)
+
+    def test_apps_share_one_mirror(self):
+        self.run_task('app1', 'deploy')
+        self.run_task('app2', 'deploy')
+
+        mirrors = [m for m in os.listdir(self.mirrors) if m.endswith('.git')]
+        self.assertEqual(mirrors, [os.path.basename(
+            mirror.mirror_path(self.mirrors, self.remote))])
+        for app_name in ('app1', 'app2'):
+            alternates = os.path.join(
+                self.src, app_name, '.git', 'objects', 'info', 'alternates')
+            self.assertTrue(os.path.exists(alternates))
+
+    def test_pull_fetches_into_mirror(self):
+        self.run_task('app1', 'deploy')
+        self.commit('second')
+        self.run_task('app1', 'pull')
+
+        head = git(os.path.join(self.src, 'app1'), 'log', '-1', '--format=%s')
+        self.assertEqual(head, 'second')
+
+
+if __name__ == '__main__':
+    unittest.main()
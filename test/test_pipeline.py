@@ -0,0 +1,141 @@
+import time
+import threading
+import unittest
+
+from ciex import core
+from ciex import aioworker
+from ciex.pipeline import Pipeline, Step
+from ciex.worker import CIWorker, Command
+
+
+class PipelineWorker(CIWorker):
+
+    pipelines = {
+        'ci': [Step('pull'), Step('lint', after=['pull']),
+               Step('test', after=['pull']),
+               Step('build', after=['lint', 'test'])],
+        'broken': [Step('pull'), Step('fail', after=['pull']),
+                   Step('build', after=['fail']),
+                   Step('test', after=['pull'])],
+        'cycle': [Step('a', 'pull', after=['b']),
+                  Step('b', 'pull', after=['a'])],
+    }
+
+    def pull(self, task):
+        return task.success()
+
+    def lint(self, task):
+        time.sleep(0.2)
+        return task.success()
+
+    def test(self, task):
+        code = yield Command('sleep 0.2')
+        assert code == 0
+
+    def build(self, task):
+        return task.success()
+
+    def fail(self, task):
+        code = yield Command('exit 1')
+        if code != 0:
+            # Not an assert: pytest rewrites their messages
+            raise RuntimeError('exit code {}'.format(code))
+
+
+class TestPipeline(unittest.TestCase):
+
+    def test_validation(self):
+        with self.assertRaises(ValueError):
+            Pipeline([Step('a', after=['missing'])])
+        with self.assertRaises(ValueError):
+            Pipeline([Step('a'), Step('a')])
+        with self.assertRaises(ValueError):
+            Pipeline(PipelineWorker.pipelines['cycle'])
+
+
+class TestThreadPipeline(unittest.TestCase):
+
+    def execute(self, command, **settings):
+        env = core.AppSetting('app', **settings)
+        task = core.Task('app', command, env=env)
+        return self.run_task(task)
+
+    def run_task(self, task):
+        return PipelineWorker(None, 'app', None).execute(task)
+
+    def test_parallel_steps(self):
+        task = self.execute('ci')
+
+        self.assertEqual(task.status, core.TaskStatus.success)
+        steps = {s['name']: s for s in task.steps}
+        self.assertEqual(
+            [s['status'] for s in task.steps], ['success'] * 4)
+        # lint and test overlapped, build waited for both
+        self.assertLess(steps['lint']['start'], steps['test']['finish'])
+        self.assertLess(steps['test']['start'], steps['lint']['finish'])
+        self.assertGreaterEqual(
+            steps['build']['start'],
+            max(steps['lint']['finish'], steps['test']['finish']))
+
+    def test_bounded_parallelism(self):
+        task = self.execute('ci', parallel_steps=1)
+
+        steps = {s['name']: s for s in task.steps}
+        self.assertEqual(task.status, core.TaskStatus.success)
+        first, second = sorted(
+            [steps['lint'], steps['test']], key=lambda s: s['start'])
+        self.assertGreaterEqual(second['start'], first['finish'])
+
+    def test_failure_cancels_dependents(self):
+        task = self.execute('broken')
+
+        self.assertEqual(task.status, core.TaskStatus.failure)
+        self.assertEqual(task.error, 'step fail failed: exit code 1')
+        self.assertEqual(
+            [s['status'] for s in task.steps],
+            ['success', 'failure', 'cancelled', 'success'])
+
+    def test_invalid_pipeline(self):
+        task = self.execute('cycle')
+
+        self.assertEqual(task.status, core.TaskStatus.failure)
+        self.assertEqual(task.error, 'the steps have a cycle')
+
+    def test_unknown_command(self):
+        task = self.execute('nope')
+        self.assertEqual(task.status, core.TaskStatus.failure)
+
+
+class TestWorkerLoop(unittest.TestCase):
+
+    def test_unknown_command_is_handed_back(self):
+        router = core.TaskRouter.new({'app': core.AppSetting('app')})
+        worker = PipelineWorker(None, 'app', router)
+        thread = threading.Thread(target=worker.run)
+        thread.start()
+        router.put_new(core.Task('app', 'nope'))
+        router.put_new(core.Task('app', 'build'))
+
+        deadline = time.time() + 5
+        while time.time() < deadline and not (
+                router.last['app'].command == 'build' and
+                router.last['app'].finish is not None):
+            time.sleep(0.01)
+        router.close()
+        thread.join()
+        self.assertEqual(router.last['app'].status, core.TaskStatus.success)
+        self.assertEqual(router.running['app'], [])
+
+
+class TestAsyncPipeline(TestThreadPipeline):
+
+    def run_task(self, task):
+        worker = PipelineWorker(None, 'app', None)
+        engine = aioworker.AsyncEngine(None, None, {'app': worker})
+        loop = aioworker.asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        return loop.run_until_complete(engine.execute(worker, task))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+from ciex import core
+from ciex import aioworker
+from ciex.worker import CIWorker, Command
+
+
+class SlowWorker(CIWorker):
+
+    def hang(self, task):
+        # A command starting a child which would outlive the shell
+        pidfile = os.path.join(task.env.src_path, 'child.pid')
+        code = yield Command(
+            'sleep 30 & echo $! > {}; wait'.format(pidfile))
+        assert code == 0
+        yield Command('touch {}'.format(
+            os.path.join(task.env.src_path, 'after')))
+
+    def quick(self, task):
+        code = yield Command('true')
+        assert code == 0
+
+
+def process_alive(pid):
+    try:
+        with open('/proc/{}/stat'.format(pid)) as fh:
+            return fh.read().split(')')[-1].split()[0] != 'Z'
+    except IOError:
+        return False
+
+
+class TestTimeoutAndCancel(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.env = core.AppSetting(
+            'app', src_path=self.dir, command_timeouts='hang:0.5')
+        self.worker = SlowWorker(None, 'app', None)
+
+    def execute(self, task):
+        return self.worker.execute(task)
+
+    def child_pid(self):
+        for _ in range(100):
+            path = os.path.join(self.dir, 'child.pid')
+            if os.path.exists(path) and os.path.getsize(path):
+                with open(path) as fh:
+                    return int(fh.read())
+            time.sleep(0.05)
+
+    def assert_killed(self, task, status):
+        self.assertEqual(task.status, status)
+        self.assertFalse(os.path.exists(os.path.join(self.dir, 'after')))
+        pid = self.child_pid()
+        for _ in range(100):
+            if not process_alive(pid):
+                break
+            time.sleep(0.05)
+        self.assertFalse(process_alive(pid))
+
+    def test_timeout_kills_process_group(self):
+        begin = time.time()
+        task = self.execute(core.Task('app', 'hang', env=self.env))
+
+        self.assertLess(time.time() - begin, 10)
+        self.assert_killed(task, core.TaskStatus.timeout)
+        self.assertEqual(task.error, 'timed out')
+
+    def test_no_timeout_for_other_commands(self):
+        task = self.execute(core.Task('app', 'quick', env=self.env))
+        self.assertEqual(task.status, core.TaskStatus.success)
+
+    def test_cancel(self):
+        env = core.AppSetting('app', src_path=self.dir)
+        router = core.TaskRouter.new({'app': env})
+        router.put_new(core.Task('app', 'hang', env=env))
+        router.put_new(core.Task('app', 'quick', env=env))
+        running = router.take_new('app')
+        thread = threading.Thread(target=self.execute, args=(running,))
+        thread.start()
+        self.child_pid()
+
+        self.assertEqual(router.cancel('app'), (1, 1))
+        thread.join(timeout=10)
+        self.assertFalse(thread.is_alive())
+        self.assert_killed(running, core.TaskStatus.cancelled)
+        self.assertEqual(
+            router.last['app'].status, core.TaskStatus.cancelled)
+        self.assertFalse(router.new['app'])
+
+
+class TestAsyncTimeoutAndCancel(TestTimeoutAndCancel):
+
+    def execute(self, task):
+        engine = aioworker.AsyncEngine(None, None, {'app': self.worker})
+        loop = aioworker.asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(engine.execute(self.worker, task))
+        finally:
+            loop.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
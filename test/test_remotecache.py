@@ -0,0 +1,149 @@
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+from ciex import core
+from ciex import artifacts
+from ciex import remotecache
+from ciex.contrib.workers.elixir import ElixirCIWorker
+
+from helpers import git, write, read
+
+
+class TestFileStore(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.src = os.path.join(self.dir, 'rel')
+        write(os.path.join(self.src, 'bin', 'app'), 'run')
+        # Larger than a chunk, to go through several reads and writes
+        self.blob = os.urandom(remotecache.CHUNK * 2 + 10)
+        write(os.path.join(self.src, 'lib', 'blob'), self.blob, 'wb')
+        os.symlink('bin/app', os.path.join(self.src, 'app'))
+        self.cache = remotecache.RemoteCache(self.new_store(), 'app')
+
+    def new_store(self):
+        return remotecache.FileStore(os.path.join(self.dir, 'store'))
+
+    def test_publish_and_fetch(self):
+        self.assertTrue(self.cache.publish('k1', self.src))
+        self.assertFalse(self.cache.publish('k1', self.src))
+
+        dest = os.path.join(self.dir, 'fetched')
+        write(os.path.join(dest, 'stale'), 'x')
+        self.assertTrue(self.cache.fetch('k1', dest))
+        self.assertEqual(read(os.path.join(dest, 'bin', 'app')), 'run')
+        self.assertEqual(
+            read(os.path.join(dest, 'lib', 'blob'), 'rb'), self.blob)
+        self.assertEqual(os.readlink(os.path.join(dest, 'app')), 'bin/app')
+        self.assertFalse(os.path.exists(os.path.join(dest, 'stale')))
+
+    def test_miss(self):
+        self.assertFalse(
+            self.cache.fetch('k2', os.path.join(self.dir, 'fetched')))
+
+    def test_corrupted_release(self):
+        self.cache.publish('k1', self.src)
+        self.cache.store.write(
+            self.cache.name('k1'), io.BytesIO(b'not the release'))
+        with self.assertRaises(ValueError):
+            self.cache.fetch('k1', os.path.join(self.dir, 'fetched'))
+
+    def test_unsafe_tarball(self):
+        path = os.path.join(self.dir, 'bad.tar.gz')
+        with tarfile.open(path, 'w:gz') as tar:
+            tar.add(os.path.join(self.src, 'bin', 'app'), arcname='../x')
+        with self.assertRaises(ValueError):
+            remotecache.unpack(path, os.path.join(self.dir, 'out'))
+        self.assertFalse(os.path.exists(os.path.join(self.dir, 'x')))
+
+    def test_symlink_out_of_the_release(self):
+        path = os.path.join(self.dir, 'bad.tar.gz')
+        with tarfile.open(path, 'w:gz') as tar:
+            link = tarfile.TarInfo('lib')
+            link.type = tarfile.SYMTYPE
+            link.linkname = '../../outside'
+            tar.addfile(link)
+            tar.add(os.path.join(self.src, 'bin', 'app'), arcname='lib/x')
+        with self.assertRaises(ValueError):
+            remotecache.unpack(path, os.path.join(self.dir, 'out'))
+        self.assertFalse(os.path.exists(os.path.join(self.dir, 'outside')))
+
+
+class TestHTTPStore(TestFileStore):
+
+    def new_store(self):
+        self.server = remotecache.serve(
+            os.path.join(self.dir, 'served'), '127.0.0.1', 0)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        return remotecache.store_for('http://127.0.0.1:{}/cache'.format(
+            self.server.server_address[1]))
+
+    def test_bad_names(self):
+        with self.assertRaises(ValueError):
+            self.cache.store.read('../etc/passwd', io.BytesIO())
+
+
+class TestSharedBuilds(unittest.TestCase):
+    """ Two daemons building the same commit of an app """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        origin = os.path.join(self.dir, 'origin')
+        os.makedirs(origin)
+        git(origin, 'init', '-q')
+        write(os.path.join(origin, 'mix.lock'), 'deps')
+        git(origin, 'add', '-A')
+        git(origin, 'commit', '-q', '-m', 'first')
+
+        self.commands = []
+        self.envs = []
+        for host in ('a', 'b'):
+            src = os.path.join(self.dir, host, 'src')
+            os.makedirs(src)
+            git(src, 'clone', '-q', origin, 'app')
+            self.envs.append(core.AppSetting(
+                'app', src_path=src,
+                install_path=os.path.join(self.dir, host, 'install'),
+                remote_cache=os.path.join(self.dir, 'shared')))
+
+    def sh(self, line, cwd=None, env=None, output=None, control=None):
+        self.commands.append(line)
+        if line == 'mix release':
+            write(os.path.join(cwd, 'rel', 'app', 'bin', 'app'), 'built')
+        return 0
+
+    def build(self, env):
+        self.commands = []
+        worker = ElixirCIWorker(None, 'app', None)
+        worker.sh = self.sh
+        task = worker.execute(core.Task('app', 'build', env=env))
+        self.assertEqual(task.status, core.TaskStatus.success)
+        return self.commands
+
+    def test_second_daemon_downloads_the_release(self):
+        self.assertEqual(self.build(self.envs[0]),
+                         ['mix deps.get', 'mix release'])
+        self.assertEqual(self.build(self.envs[1]), [])
+
+        store = artifacts.app_store(self.envs[1])
+        self.assertEqual(len(store.releases()), 1)
+        path = store.release_path(store.releases()[0])
+        self.assertEqual(read(os.path.join(path, 'bin', 'app')), 'built')
+
+    def test_unreachable_cache_builds(self):
+        self.envs[1] = core.AppSetting(
+            'app', src_path=self.envs[1].src_path,
+            remote_cache='http://127.0.0.1:1/')
+        self.assertEqual(self.build(self.envs[1]),
+                         ['mix deps.get', 'mix release'])
+
+
+if __name__ == '__main__':
+    unittest.main()
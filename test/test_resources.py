@@ -0,0 +1,134 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from ciex import core
+from ciex import resources
+
+from helpers import write
+
+
+class TestProbes(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.proc = os.path.join(self.dir, 'proc')
+        self.cgroup = os.path.join(self.dir, 'cgroup')
+        write(os.path.join(self.proc, 'loadavg'),
+              '3.50 2.00 1.00 4/500 1234\n')
+        write(os.path.join(self.proc, 'meminfo'),
+              'MemTotal:        8388608 kB\n'
+              'MemFree:         1048576 kB\n'
+              'MemAvailable:    4194304 kB\n')
+
+    def test_host(self):
+        self.assertEqual(resources.loadavg(self.proc), 3.5)
+        self.assertEqual(
+            resources.memory_limit_mb(self.proc, self.cgroup), 8192)
+        self.assertEqual(
+            resources.memory_available_mb(self.proc, self.cgroup), 4096)
+
+    def test_cgroup_v2(self):
+        write(os.path.join(self.cgroup, 'memory.max'), str(2 ** 31))
+        write(os.path.join(self.cgroup, 'memory.current'), str(2 ** 30))
+        self.assertEqual(
+            resources.memory_limit_mb(self.proc, self.cgroup), 2048)
+        self.assertEqual(
+            resources.memory_available_mb(self.proc, self.cgroup), 1024)
+
+    def test_cgroup_v2_without_limit(self):
+        write(os.path.join(self.cgroup, 'memory.max'), 'max')
+        write(os.path.join(self.cgroup, 'memory.current'), str(2 ** 30))
+        self.assertEqual(
+            resources.memory_limit_mb(self.proc, self.cgroup), 8192)
+
+    def test_cgroup_v1(self):
+        memory = os.path.join(self.cgroup, 'memory')
+        write(os.path.join(memory, 'memory.limit_in_bytes'), str(2 ** 62))
+        write(os.path.join(memory, 'memory.usage_in_bytes'), str(2 ** 30))
+        self.assertEqual(resources.cgroup_memory(self.cgroup), (None, None))
+
+        write(os.path.join(memory, 'memory.limit_in_bytes'), str(2 ** 32))
+        self.assertEqual(
+            resources.cgroup_memory(self.cgroup), (4096, 1024))
+        self.assertEqual(
+            resources.memory_available_mb(self.proc, self.cgroup), 3072)
+
+    def test_missing_files(self):
+        self.assertIsNone(resources.loadavg(self.cgroup))
+        self.assertIsNone(
+            resources.memory_limit_mb(self.cgroup, self.cgroup))
+
+
+class TestBudget(unittest.TestCase):
+
+    def test_cpu_and_memory(self):
+        budget = resources.Budget(cpu=4, memory=4096)
+        budget.acquire((3, 1024))
+        self.assertTrue(budget.fits((1, 3072)))
+        self.assertFalse(budget.fits((2, 0)))
+        self.assertFalse(budget.fits((0, 4000)))
+        self.assertTrue(budget.fits((0, 0)))
+
+        budget.release((3, 1024))
+        self.assertTrue(budget.fits((8, 8192)))  # alone, even too big
+
+    def test_no_limits(self):
+        budget = resources.Budget()
+        budget.acquire((16, 65536))
+        self.assertTrue(budget.fits((16, 65536)))
+
+    def test_probe(self):
+        samples = [(3.5, 1000.0)]
+        budget = resources.Budget(
+            cpu=4, probe=lambda: samples[0], interval=60)
+        self.assertEqual(budget.wait_timeout, 60)
+        budget.acquire((1, 0))
+        self.assertFalse(budget.fits((1, 0)))  # busy with other work
+        self.assertFalse(budget.fits((0, 2000)))
+        self.assertTrue(budget.fits((0, 500)))
+
+        samples[0] = (0.0, 4000.0)  # only sampled once per interval
+        self.assertFalse(budget.fits((1, 0)))
+        budget.sampled = 0
+        self.assertTrue(budget.fits((3, 2000)))
+
+    def test_probe_alone(self):
+        samples = [(3.5, 1000.0)]
+        budget = resources.Budget(
+            cpu=4, memory=4096, probe=lambda: samples[0], interval=0)
+        self.assertFalse(budget.fits((1, 0)))  # busy outside the daemon
+        self.assertFalse(budget.fits((0, 1500)))
+
+        samples[0] = (1.5, 3000.0)  # half of the budget is free
+        self.assertTrue(budget.fits((8, 8192)))
+        samples[0] = (2.5, 3000.0)
+        self.assertFalse(budget.fits((8, 0)))
+        self.assertTrue(budget.fits((1, 0)))
+
+    def test_reserve(self):
+        budget = resources.Budget(cpu=4)
+        budget.reserve_after = 2
+        big, small = core.Task('a', 'build'), core.Task('b', 'build')
+        budget.acquire((2, 0))
+        self.assertFalse(budget.admits(big, (4, 0)))
+        for _ in range(2):
+            self.assertTrue(budget.admits(small, (1, 0)))
+            budget.acquire((1, 0), small)
+            self.assertFalse(budget.admits(big, (4, 0)))
+        self.assertIs(budget.reserved, big)
+        self.assertFalse(budget.admits(small, (0.5, 0)))
+        self.assertTrue(budget.admits(small, (0, 0)))
+
+        budget.release((2, 0))
+        budget.release((1, 0))
+        budget.release((1, 0))
+        self.assertTrue(budget.admits(big, (4, 0)))
+        budget.acquire((4, 0), big)
+        self.assertIsNone(budget.reserved)
+
+
+if __name__ == '__main__':
+    unittest.main()
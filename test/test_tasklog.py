@@ -0,0 +1,66 @@
+import shutil
+import tempfile
+import unittest
+
+from ciex import core
+from ciex import tasklog
+from ciex.worker import CIWorker, Command
+
+
+class EchoWorker(CIWorker):
+
+    def echo(self, task):
+        code = yield Command('echo hello; echo oops >&2')
+        assert code == 0
+
+
+class TestTaskLog(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.logs = tasklog.TaskLogs(self.dir, keep=2, max_memory=100)
+
+    def test_read_from_offsets(self):
+        log = self.logs.new(core.Task('app', 'build'))
+        for i in range(50):
+            log.write('line {:02d}\n'.format(i).encode())
+        self.assertGreater(log.start, 0)  # older output spilled to disk
+
+        data, offset = b'', 0
+        while True:
+            chunk, offset, done = log.read(offset, limit=64)
+            data += chunk
+            if not chunk:
+                break
+        self.assertFalse(done)
+        self.assertEqual(data.count(b'\n'), 50)
+        self.assertTrue(data.startswith(b'line 00\nline 01'))
+
+        log.close()
+        self.assertTrue(log.read(offset)[2])
+
+    def test_keep_recent_logs(self):
+        tasks = [core.Task('app', 'build') for _ in range(3)]
+        for task in tasks:
+            self.logs.new(task).write(b'x' * 500)
+        self.assertIsNone(self.logs.get(tasks[0].id))
+        self.assertIsNotNone(self.logs.get(tasks[2].id))
+
+    def test_capture_command_output(self):
+        apps_sts = {'app': core.AppSetting('app')}
+        router = core.TaskRouter.new(apps_sts)
+        router.logs = self.logs
+        router.put_new(core.Task('app', 'echo'))
+
+        task = router.take_new('app')
+        task = EchoWorker(None, 'app', router).execute(task)
+        router.put_finished(task)
+
+        data, _, done = task.output.read()
+        self.assertEqual(data, b'$ echo hello; echo oops >&2\nhello\noops\n')
+        self.assertTrue(done)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from ciex import core
+from ciex import error
+from ciex import context
+from ciex import toolchain
+from ciex.contrib.workers.elixir import ElixirCIWorker
+
+from helpers import git, write
+
+
+class Section(dict):
+    name = 'settings.app.app'
+
+
+class TestToolchain(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        for tool, version in [('erlang', '26.2'), ('elixir', '1.15.7')]:
+            os.makedirs(os.path.join(self.dir, tool, version, 'bin'))
+
+    def test_versions_and_paths(self):
+        env = core.AppSetting(
+            'app', toolchain_root=self.dir, toolchain_path='/opt/tools',
+            toolchain_versions='erlang:26.2, elixir:1.15.7',
+            command_env='MIX_ENV=test')
+        chain = toolchain.Toolchain(env)
+        variables = chain.environment({'MIX_ENV': 'prod', 'LANG': 'C'})
+        self.assertEqual(variables['PATH'].split(os.pathsep)[:3], [
+            os.path.join(self.dir, 'erlang', '26.2', 'bin'),
+            os.path.join(self.dir, 'elixir', '1.15.7', 'bin'),
+            '/opt/tools'])
+        self.assertEqual(variables['MIX_ENV'], 'test')
+        self.assertEqual(variables['LANG'], 'C')
+        self.assertIsNotNone(chain.fingerprint)
+        self.assertIsNone(toolchain.Toolchain(None).fingerprint)
+
+    def test_missing_version(self):
+        env = core.AppSetting(
+            'app', toolchain_root=self.dir, toolchain_versions='erlang:25')
+        with self.assertRaises(error.AppSettingError):
+            toolchain.Toolchain(env)
+
+    def test_inherit_env(self):
+        os.environ['CIEX_TEST_VARIABLE'] = '1'
+        self.addCleanup(os.environ.pop, 'CIEX_TEST_VARIABLE')
+        variables = toolchain.Toolchain(
+            core.AppSetting('app', inherit_env='false')).environment()
+        self.assertNotIn('CIEX_TEST_VARIABLE', variables)
+        self.assertEqual(variables['PATH'], os.environ['PATH'])
+        self.assertIn(
+            'CIEX_TEST_VARIABLE',
+            toolchain.Toolchain(core.AppSetting('app')).environment())
+
+    def test_resolved_once_per_settings(self):
+        env = core.AppSetting('app', command_env='A=1')
+        chain = toolchain.for_app(env)
+        self.assertIs(context.toolchain(core.Task('app', 'build', env=env)),
+                      chain)
+        self.assertIsNot(
+            toolchain.for_app(core.AppSetting('app', command_env='A=2')),
+            chain)
+
+    def test_validate(self):
+        section = Section(
+            repo='r', src_path='/s', install_path='/i', worker_dirpath='.',
+            worker_modname='m', worker_classname='C')
+        core.AppSetting.validate(section)
+        for key, value in [('toolchain_versions', 'erlang'),
+                           ('toolchain_versions', 'erlang:26'),
+                           ('inherit_env', 'no')]:
+            with self.assertRaises(error.AppSettingError):
+                core.AppSetting.validate(dict(section, **{key: value}))
+
+
+class TestToolchainSetup(unittest.TestCase):
+    """ The toolchain prefix of an app is prepared once per lockfiles """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        src = os.path.join(self.dir, 'src')
+        self.repo = os.path.join(src, 'app')
+        os.makedirs(self.repo)
+        git(self.repo, 'init', '-q')
+        self.commit('deps')
+        self.env = core.AppSetting(
+            'app', src_path=src,
+            install_path=os.path.join(self.dir, 'install'),
+            toolchain_setup='mix local.hex --force')
+        self.commands = []
+
+    def commit(self, lock):
+        write(os.path.join(self.repo, 'mix.lock'), lock)
+        write(os.path.join(self.repo, 'lib.ex'), str(os.urandom(4)))
+        git(self.repo, 'add', '-A')
+        git(self.repo, 'commit', '-q', '-m', 'commit')
+
+    def sh(self, line, cwd=None, env=None, output=None, control=None):
+        self.commands.append((line, env))
+        if line == 'mix release':
+            write(os.path.join(cwd, 'rel', 'app', 'bin', 'app'), 'built')
+        return 0
+
+    def build(self):
+        self.commands = []
+        worker = ElixirCIWorker(None, 'app', None)
+        worker.sh = self.sh
+        task = worker.execute(core.Task('app', 'build', env=self.env))
+        self.assertEqual(task.status, core.TaskStatus.success, task.error)
+        return [line for line, _ in self.commands]
+
+    def test_setup_once_per_lockfiles(self):
+        self.assertEqual(self.build(), [
+            'mix local.hex --force', 'mix deps.get', 'mix release'])
+        setup_env = self.commands[0][1]
+        prefix = setup_env['CIEX_TOOLCHAIN_PREFIX']
+        self.assertEqual(setup_env['MIX_HOME'], os.path.join(prefix, 'mix'))
+        self.assertEqual(
+            self.commands[2][1]['MIX_HOME'], setup_env['MIX_HOME'])
+        self.assertEqual(self.commands[2][1]['MIX_ENV'], 'prod')
+        self.assertNotIn('MIX_HOME', os.environ)
+
+        self.commit('deps')
+        self.assertEqual(self.build(), ['mix deps.get', 'mix release'])
+        self.assertEqual(
+            self.commands[1][1]['MIX_HOME'], setup_env['MIX_HOME'])
+
+        self.commit('new deps')
+        self.assertEqual(self.build()[0], 'mix local.hex --force')
+        self.assertNotEqual(
+            self.commands[0][1]['CIEX_TOOLCHAIN_PREFIX'], prefix)
+
+    def test_failed_setup_runs_again(self):
+        worker = ElixirCIWorker(None, 'app', None)
+        worker.sh = lambda line, *args, **kwargs: 1
+        task = worker.execute(core.Task('app', 'build', env=self.env))
+        self.assertEqual(task.status, core.TaskStatus.failure)
+
+        self.assertEqual(self.build()[0], 'mix local.hex --force')
+
+
+if __name__ == '__main__':
+    unittest.main()
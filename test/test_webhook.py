@@ -0,0 +1,189 @@
+import hmac
+import json
+import time
+import hashlib
+import threading
+import unittest
+
+try:
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError
+except ImportError:
+    from urllib2 import Request, urlopen, HTTPError
+
+from ciex import core
+from ciex import webhook
+
+
+def github_push(branch='master', commit='a' * 40):
+    return {
+        'ref': 'refs/heads/' + branch, 'after': commit,
+        'repository': {
+            'clone_url': 'https://github.com/walkr/ciex.git',
+            'ssh_url': 'git@github.com:walkr/ciex.git',
+        },
+    }
+
+
+class TestPayloads(unittest.TestCase):
+
+    def test_repo_key(self):
+        keys = set(webhook.repo_key(url) for url in [
+            'git@github.com:walkr/ciex.git',
+            'https://github.com/walkr/ciex.git',
+            'https://GitHub.com/walkr/ciex/',
+            'ssh://git@github.com/walkr/ciex.git',
+        ])
+        self.assertEqual(keys, {'github.com/walkr/ciex'})
+
+    def test_github(self):
+        repos, branch, commit = webhook.parse_push(github_push('dev'))
+        self.assertEqual(repos, {'github.com/walkr/ciex'})
+        self.assertEqual((branch, commit), ('dev', 'a' * 40))
+
+    def test_gitlab(self):
+        repos, branch, commit = webhook.parse_push({
+            'ref': 'refs/heads/master', 'checkout_sha': 'b' * 40,
+            'project': {'git_ssh_url': 'git@gitlab.com:walkr/ciex.git'},
+        })
+        self.assertEqual(repos, {'gitlab.com/walkr/ciex'})
+        self.assertEqual((branch, commit), ('master', 'b' * 40))
+
+    def test_tags_and_deleted_branches(self):
+        payload = github_push()
+        payload['ref'] = 'refs/tags/v1'
+        self.assertIsNone(webhook.parse_push(payload)[1])
+        self.assertIsNone(webhook.parse_push(github_push(commit='0' * 40))[1])
+
+
+class TestDebouncer(unittest.TestCase):
+
+    def test_burst_triggers_once_with_last_value(self):
+        calls = []
+        debouncer = webhook.Debouncer(
+            lambda key, value: calls.append((key, value)), 0.2, 10)
+        self.addCleanup(debouncer.stop)
+        for i in range(30):
+            debouncer.push('app', i)
+            debouncer.push('other', i)
+            time.sleep(0.01)
+        time.sleep(0.5)
+        self.assertEqual(sorted(calls), [('app', 29), ('other', 29)])
+
+    def test_max_delay(self):
+        calls = []
+        debouncer = webhook.Debouncer(
+            lambda key, value: calls.append(value), 0.2, 0.3)
+        self.addCleanup(debouncer.stop)
+        begin = time.time()
+        while time.time() - begin < 0.6:
+            debouncer.push('app', time.time())
+            time.sleep(0.05)
+        self.assertGreaterEqual(len(calls), 1)
+
+
+class FakeProgram(object):
+
+    def __init__(self, apps_sts):
+        self.state = type('State', (), {})()
+        self.state.apps_sts = apps_sts
+
+
+class TestReceiver(unittest.TestCase):
+
+    secret = None
+
+    def setUp(self):
+        apps_sts = {
+            'web': core.AppSetting(
+                'web', repo='git@github.com:walkr/ciex.git'),
+            'docs': core.AppSetting(
+                'docs', repo='https://github.com/walkr/ciex',
+                webhook_branch='gh-pages', webhook_command='publish'),
+            'other': core.AppSetting(
+                'other', repo='git@github.com:walkr/other.git'),
+        }
+        self.core = core.Core.__new__(core.Core)
+        self.core.program = FakeProgram(apps_sts)
+        self.core.repo_index = (None, {})
+        self.triggered = []
+        self.receiver = webhook.WebhookReceiver(
+            self.core.webhook_targets,
+            lambda *args: self.triggered.append(args),
+            delay=0.2, secret=self.secret)
+        server = self.receiver.serve('127.0.0.1', 0)
+        self.addCleanup(self.receiver.stop)
+        self.url = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+
+    def post(self, payload, headers=None):
+        return self.send(json.dumps(payload).encode(), headers)
+
+    def send(self, body, headers=None):
+        request = Request(self.url, body, headers or {})
+        try:
+            response = urlopen(request, timeout=10)
+        except HTTPError as e:
+            return e.code, None
+        return response.getcode(), json.loads(response.read().decode())
+
+    def test_bad_payload(self):
+        self.assertEqual(self.send(b'not json'), (400, None))
+
+    def test_push_matches_repo_and_branch(self):
+        self.assertEqual(self.post(github_push()), (202, {'apps': ['web']}))
+        self.assertEqual(
+            self.post(github_push('gh-pages')),
+            (202, {'apps': ['docs', 'web']}))
+        time.sleep(0.4)
+        self.assertEqual(sorted(self.triggered), [
+            ('docs', 'publish', 'a' * 40), ('web', 'build', 'a' * 40)])
+
+    def test_concurrent_pushes_become_one_task(self):
+        debouncer = self.receiver.debouncer
+        debouncer.delay = debouncer.max_delay = 60
+        codes = []
+
+        def push(i):
+            code, _ = self.post(github_push(commit='{:040d}'.format(i + 1)))
+            codes.append(code)
+
+        threads = [threading.Thread(target=push, args=(i,))
+                   for i in range(200)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        self.assertEqual(codes, [202] * 200)
+        self.post(github_push(commit='f' * 40))
+
+        with debouncer.cond:
+            self.assertEqual(list(debouncer.pending), [('web', 'build')])
+            debouncer.pending[('web', 'build')][0] = 0
+            debouncer.cond.notify()
+        time.sleep(0.2)
+        self.assertEqual(self.triggered, [('web', 'build', 'f' * 40)])
+
+
+class TestSignedReceiver(TestReceiver):
+
+    secret = 's3cret'
+
+    def send(self, body, headers=None):
+        if headers is None:
+            digest = hmac.new(
+                self.secret.encode(), body, hashlib.sha256).hexdigest()
+            headers = {'X-Hub-Signature-256': 'sha256=' + digest}
+        return super(TestSignedReceiver, self).send(body, headers)
+
+    def test_bad_signature(self):
+        code, _ = self.post(
+            github_push(), {'X-Hub-Signature-256': 'sha256=00'})
+        self.assertEqual(code, 403)
+        code, _ = self.post(github_push(), {})
+        self.assertEqual(code, 403)
+
+    def test_gitlab_token(self):
+        code, _ = self.post(github_push(), {'X-Gitlab-Token': self.secret})
+        self.assertEqual(code, 202)
+
+
+if __name__ == '__main__':
+    unittest.main()